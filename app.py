@@ -42,6 +42,8 @@ MAX_WORKERS = 3
 MAX_UPLOAD_MB = 20 
 MAX_UPLOAD_BYTES = MAX_UPLOAD_MB * 1024 * 1024
 ALLOWED_DOMAIN = "sc.com" 
+QUEUE_STATUS_REFRESH_SECONDS = 10 # How often a queued user's status log shows their position
+JOB_BACKEND = os.environ.get("PROFILEDASH_JOB_BACKEND", "thread") # "thread" (runs in this process) or "sqlite" (python -m src.worker processes)
 
 # --- Get Google API Key ---
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY') # Fetch the key from environment/secrets
@@ -83,7 +85,17 @@ try:
     from src.prompts import persona, analysis_specs, output_format
     # API client functions (will be configured dynamically)
     from src.api_client import create_insight_model
-
+    # Local PDF structure checks (run before any API call)
+    from src.pdf_validation import validate_pdf_files, format_validation_errors
+    # Global run queue (bounded, fair-share across users)
+    from src.job_queue import JobQueue, QueueFullError, queue_status_message
+    from src.durable_queue import DurableJobQueue
+    # Run checkpoints (resume after a restart)
+    from src.run_store import (create_run_checkpoint, resume_unfinished_runs, prune_runs, run_output_dir, load_run_meta, user_runs,
+                               unfinished_sections, create_regeneration_checkpoint, prepare_resume)
+    # Partial runs: named section groups and selections like "7-9, 23"
+    from src.section_definitions import section_groups
+    from src.section_dag import parse_section_selection
     # For API key and SendGrid key loading
     from dotenv import load_dotenv
     load_dotenv() # Load .env file for local development
@@ -119,6 +131,12 @@ except Exception as general_e:
     traceback.print_exc()
     raise
 
+# One queue for all sessions: bounds concurrent runs, fair-share across users.
+# "sqlite" hands runs to separate worker processes via a durable queue instead.
+job_queue = DurableJobQueue() if JOB_BACKEND == "sqlite" else JobQueue()
+# Choices of the section selectors: group names first, then "N. Title" per section
+SECTION_CHOICES = list(section_groups) + [f"{section['number']}. {section['title']}" for section in sections]
+
 # ----------------------------------------------------------------------------
 # Helper Functions
 # ----------------------------------------------------------------------------
@@ -195,6 +213,30 @@ def get_permitted_users():
         return fallback_config
 
 
+def is_email_permitted(email):
+    """
+    Checks an email address against the permitted users file (UI login and HTTP API).
+
+    Returns:
+        bool or None: True/False, or None if the permitted users configuration is unavailable
+    """
+    print(f"Checking permissions for email: {email}")
+    email_lower = email.lower()
+    permitted_users_config = get_permitted_users()
+    if not permitted_users_config:
+        print("CRITICAL ERROR: Could not retrieve permitted users configuration.")
+        return None
+    allowed_emails = permitted_users_config.get("allowed_emails", [])
+    allowed_domains = permitted_users_config.get("allowed_domains", [])
+    if email_lower in allowed_emails:
+        print(f"Email {email} permitted via allowed_emails list.")
+        return True
+    domain = email_lower.split('@')[1] if '@' in email_lower else ""
+    if domain in allowed_domains:
+        print(f"Email {email} permitted via allowed_domains list ({domain}).")
+        return True
+    return False
+
 def verify_email_and_check_key(email, auth_state):
     """
     Validates user email and API key configuration for authentication.
@@ -213,28 +255,8 @@ def verify_email_and_check_key(email, auth_state):
         return "Please enter a valid email address.", auth_state, gr.update(visible=True), gr.update(visible=False), gr.update(visible=False)
 
     # 2. Check Permission using Dataset File
-    print(f"Checking permissions for email: {email}")
-    email_lower = email.lower()
-    is_permitted = False
-    permitted_users_config = get_permitted_users()
-
-    if permitted_users_config:
-        allowed_emails = permitted_users_config.get("allowed_emails", [])
-        allowed_domains = permitted_users_config.get("allowed_domains", [])
-        if email_lower in allowed_emails:
-            is_permitted = True
-            print(f"Email {email} permitted via allowed_emails list.") # Added print
-        else:
-            try:
-                domain = email_lower.split('@')[1]
-                if domain in allowed_domains:
-                    is_permitted = True
-                    print(f"Email {email} permitted via allowed_domains list ({domain}).") # Added print
-            except IndexError:
-                 print(f"Invalid email format encountered during domain check: {email}") # Added print
-                 is_permitted = False
-    else:
-        print("CRITICAL ERROR: Could not retrieve permitted users configuration.")
+    is_permitted = is_email_permitted(email)
+    if is_permitted is None:
         # Return: Error status, original state, keep email visible, keep main app hidden
         return "Error checking permissions. Please try again later.", auth_state, gr.update(visible=True), gr.update(visible=False), gr.update(visible=False)
 
@@ -289,13 +311,100 @@ def reset_interface():
         gr.update(visible=False)              # status_container (hide)
     ) # Now returns 7 values
 
-def handle_generate_click(file_paths, auth_state):
+def submit_profile_run(run_id, user_email, file_paths, record_checkpoint=True, section_numbers=None, base_run_id=None, force_regenerate=False, sla_minutes=None):
+    """
+    Queues a profile run on the configured job backend: a thread in this process, or
+    the durable queue drained by separate worker processes (python -m src.worker).
+    section_numbers, if given, limits the run to those sections (and the ones they build on).
+    base_run_id, if given, makes it a delta run: only sections affected by the documents that
+    changed since that run are regenerated, the rest is carried over.
+    force_regenerate skips the run cache (identical documents are otherwise restored from it).
+    sla_minutes overrides the run's time budget (PROFILEDASH_RUN_SLA_MINUTES) for deadline degradation.
+
+    Returns:
+        int: Queue position (0 if the run started immediately)
+
+    Raises:
+        QueueFullError: If the queue rejects the run (backpressure)
+    """
+    if JOB_BACKEND == "sqlite":
+        # Workers may run on other hosts: hand them copies of the uploads, not this process's temp files
+        payload = {"run_id": run_id, "user_email": user_email, "file_paths": job_queue.spool_uploads(run_id, file_paths),
+                   "dataset_repo_id": DATASET_REPO_ID, "sender_email": SENDER_EMAIL, "app_version": APP_VERSION,
+                   "max_workers": MAX_WORKERS, "max_upload_bytes": MAX_UPLOAD_BYTES, "output_dir": run_output_dir(run_id),
+                   "section_numbers": section_numbers, "base_run_id": base_run_id, "force_regenerate": force_regenerate,
+                   "sla_minutes": sla_minutes}
+        try:
+            return job_queue.submit(run_id, user_email, payload)
+        except QueueFullError:
+            job_queue.discard_uploads(run_id)
+            raise
+    # Record the run before queueing it, so a restart of this process re-queues it
+    checkpoint = create_run_checkpoint(run_id, user_email, file_paths, APP_VERSION, section_numbers) if record_checkpoint else None
+    try:
+        return job_queue.submit(
+            run_id, user_email,
+            execute_full_profile_workflow,
+            run_id, user_email, GOOGLE_API_KEY, file_paths,
+            sg, api, HF_TOKEN, DATASET_REPO_ID, SENDER_EMAIL, APP_VERSION, MAX_WORKERS, MAX_UPLOAD_BYTES,
+            progress_func=lambda message: job_queue.set_progress(run_id, message), output_dir=run_output_dir(run_id),
+            section_numbers=section_numbers, base_run_id=base_run_id, force_regenerate=force_regenerate, sla_minutes=sla_minutes
+        )
+    except QueueFullError:
+        if checkpoint: checkpoint.finish("failed")
+        raise
+
+def regenerate_run_sections(parent_run_id, user_email, section_numbers=None, mode="generate"):
+    """
+    Queues a new run that redoes selected sections of a finished run and rebuilds its
+    profiles; every other section is reused from the parent run's checkpoint and the
+    documents come from the document store.
+
+    Args:
+        parent_run_id (str): The finished run
+        user_email (str): Must be the parent run's user
+        section_numbers (list): Sections to redo (default: the ones that failed)
+        mode (str): 'generate' (new initial content, then refinement) or 'refine' (refinement only)
+
+    Returns:
+        tuple: (new run id, queue position)
+
+    Raises:
+        ValueError: If the run cannot be regenerated; QueueFullError on backpressure
+    """
+    parent = load_run_meta(parent_run_id)
+    if parent is None or parent.get("userEmail") != user_email:
+        raise ValueError(f"Run {parent_run_id} not found for {user_email}.")
+    section_numbers = section_numbers or unfinished_sections(parent)
+    if not section_numbers:
+        raise ValueError(f"Run {parent_run_id} has no failed sections. Select the sections to regenerate.")
+    run_id = str(uuid.uuid4())
+    checkpoint = create_regeneration_checkpoint(parent_run_id, run_id, section_numbers, mode, user_email, APP_VERSION)
+    file_paths = prepare_resume(checkpoint.meta)
+    if file_paths is None:
+        checkpoint.finish("failed")
+        raise ValueError(f"The documents of run {parent_run_id} are no longer in the document store. Please upload them again.")
+    try:
+        queue_position = submit_profile_run(run_id, user_email, file_paths, record_checkpoint=False)
+    except QueueFullError:
+        checkpoint.finish("failed")
+        raise
+    try:
+        log_event = {"event": "RunRegenerationSubmitted", "runId": run_id, "parentRunId": parent_run_id, "sections": sorted(section_numbers), "mode": mode, "queuePosition": queue_position}
+        save_log_entry_hf_dataset(user_email=user_email, event_data=log_event, api=api, HF_TOKEN=HF_TOKEN, DATASET_REPO_ID=DATASET_REPO_ID)
+    except Exception as log_regen_e: print(f"Error logging RunRegenerationSubmitted: {log_regen_e}")
+    return run_id, queue_position
+
+def handle_generate_click(file_paths, auth_state, selected_sections=None, base_run_id=None, force_regenerate=False):
     """
     Initiates the profile generation process in a background thread.
     
     Args:
         file_paths (list): List of paths to uploaded PDF files
         auth_state (dict): Current authentication state
+        selected_sections (list): Optional section labels / group names (partial run)
+        base_run_id (str): Optional previous run to update incrementally (delta run)
+        force_regenerate (bool): Ignore cached results of identical earlier runs
         
     Returns:
         tuple: Updated states for UI components and generation status
@@ -312,31 +421,48 @@ def handle_generate_click(file_paths, auth_state):
     # Make a copy of temp file paths if passing paths
     temp_paths_copy = list(file_paths) if isinstance(file_paths, list) else [file_paths]
 
-    print(f"UI Thread: Starting background task for run {run_id} for user {user_email}")
-    try:
-        # Create and start the background thread
-
-        thread = threading.Thread(
-            target=execute_full_profile_workflow, # <<< NEW Function Name from background_processor.py
-            args=(
-                # --- Original args needed by the workflow ---
-                run_id,
-                user_email,
-                GOOGLE_API_KEY,
-                temp_paths_copy,
-                # --- Dependencies needed by the workflow (pass global objects/constants from app.py) ---
-                sg, # Pass the initialized SendGrid client
-                api, # Pass the initialized HfApi client
-                HF_TOKEN, # Pass the Hugging Face Token
-                DATASET_REPO_ID, # Pass the Dataset Repo ID
-                SENDER_EMAIL, # Pass the Sender Email
-                APP_VERSION, # Pass the App Version
-                MAX_WORKERS, # Pass Max Workers
-                MAX_UPLOAD_BYTES # Pass Max Upload Bytes
-            ),
-            daemon=True # Keep daemon True
+    # Reject encrypted, corrupt or image-only PDFs before the background run starts
+    validation_results = validate_pdf_files(temp_paths_copy)
+    validation_error = format_validation_errors(validation_results)
+    print(f"UI Thread: Validated {len(validation_results)} files in {max([r['duration_ms'] for r in validation_results] or [0])} ms")
+    if validation_error:
+        print(f"UI Thread: Run {run_id} rejected by PDF validation for user {user_email}:\n{validation_error}")
+        try:
+            log_event = {"event": "RunRejected", "runId": run_id, "reason": "PDFValidation", "errors": {r["filename"]: r["errors"] for r in validation_results if not r["ok"]}}
+            save_log_entry_hf_dataset(user_email=user_email, event_data=log_event, api=api, HF_TOKEN=HF_TOKEN, DATASET_REPO_ID=DATASET_REPO_ID)
+        except Exception as log_reject_e: print(f"Error logging RunRejected: {log_reject_e}")
+        return (
+            gr.update(),                          # pdf_upload (no change, user can replace files)
+            gr.update(),                          # generate_row (no change)
+            gr.update(visible=False),             # generation_inprogress_message
+            validation_error + "\n\nPlease fix or remove these files and click Generate Profile again.", # status_output
+            None,                                 # download_output
+            gr.update(visible=False),             # reset_button
+            gr.update(visible=False)              # generate_loading
         )
-        thread.start()
+
+    section_numbers = parse_section_selection(selected_sections, sections, section_groups) if selected_sections else None
+    print(f"UI Thread: Submitting run {run_id} for user {user_email} to the job queue" + (f" (sections {section_numbers})" if section_numbers else ""))
+    try:
+        # Queue the run; it starts once a slot is free (fair-share across users)
+        try:
+            queue_position = submit_profile_run(run_id, user_email, temp_paths_copy, section_numbers=section_numbers, base_run_id=base_run_id or None,
+                                                force_regenerate=bool(force_regenerate))
+        except QueueFullError as queue_full_e:
+            print(f"UI Thread: Run {run_id} rejected by job queue for user {user_email}: {queue_full_e}")
+            try:
+                log_event = {"event": "RunRejected", "runId": run_id, "reason": "QueueFull", "queue": job_queue.stats()}
+                save_log_entry_hf_dataset(user_email=user_email, event_data=log_event, api=api, HF_TOKEN=HF_TOKEN, DATASET_REPO_ID=DATASET_REPO_ID)
+            except Exception as log_reject_e: print(f"Error logging RunRejected: {log_reject_e}")
+            return (
+                gr.update(),                          # pdf_upload (no change, user can retry)
+                gr.update(),                          # generate_row (no change)
+                gr.update(visible=False),             # generation_inprogress_message
+                f"{queue_full_e}",                    # status_output
+                None,                                 # download_output
+                gr.update(visible=False),             # reset_button
+                gr.update(visible=False)              # generate_loading
+            )
 
         # --- Log RunSubmitted (optional but good) ---
         try:
@@ -344,13 +470,15 @@ def handle_generate_click(file_paths, auth_state):
             input_file_metadata = [{"name": os.path.basename(fp) if fp else "None"} for fp in temp_paths_copy]
             first_valid_filename = next((meta['name'] for meta in input_file_metadata if meta['name'] != "None"), "Unknown_Company")
             run_company_name = os.path.splitext(first_valid_filename)[0].replace('_', ' ')
-            log_event = {"event": "RunSubmitted", "runId": run_id, "companyName": run_company_name}
+            log_event = {"event": "RunSubmitted", "runId": run_id, "companyName": run_company_name, "queuePosition": queue_position}
             save_log_entry_hf_dataset(user_email=user_email, event_data=log_event)
         except Exception as log_submit_e: print(f"Error logging RunSubmitted: {log_submit_e}")
         # --- End Log RunSubmitted ---
 
         # Update the status message string below:
         status_message = f"Profile generation has started. The profile will be emailed to {user_email} upon completion (approx. 10-20 mins). You can close this window now."
+        if queue_position:
+            status_message = queue_status_message(job_queue, user_email, run_id) or status_message
 
         # Return values to update UI (remains the same structure)
         return (
@@ -366,7 +494,7 @@ def handle_generate_click(file_paths, auth_state):
     except Exception as thread_e:
         # Return values on error need to be adjusted too, to match the expected number (7)
         # Keep inputs visible, show error in status, hide message/download/reset/loading
-        print(f"UI Thread: Error starting background thread for run {run_id}: {thread_e}")
+        print(f"UI Thread: Error submitting run {run_id} to the job queue: {thread_e}")
         traceback.print_exc()
         error_message = f"Error: Could not start generation process. {thread_e}"
         return (
@@ -379,19 +507,115 @@ def handle_generate_click(file_paths, auth_state):
             gr.update(visible=False)              # generate_loading
         )
 
-def handle_generate_click_with_status(file_paths, auth_state):
+def refresh_queue_status(auth_state):
+    """
+    Periodic refresh of the status log: queue position while the user's run waits,
+    then the latest progress line reported by the run (from this process or a worker).
+
+    Args:
+        auth_state (dict): Current authentication state
+
+    Returns:
+        Updated status_output (unchanged unless the user has an active run)
+    """
+    user_email = (auth_state or {}).get('email')
+    if not user_email:
+        return gr.update()
+    message = queue_status_message(job_queue, user_email)
+    if message:
+        return message
+    running = [job for job in job_queue.user_jobs(user_email) if job["position"] == 0 and job["progress"]]
+    if running:
+        return f"Profile generation in progress. The profile will be emailed to {user_email} upon completion. You can close this window now.\n\nLatest step: {running[0]['progress']}"
+    return gr.update()
+
+def resume_interrupted_runs():
+    """
+    Re-queues runs that were queued or in progress when the process stopped. Each
+    resumes from its checkpoint (see src/run_store.py) instead of starting over.
+    """
+    def submit_resumed_run(meta, file_paths):
+        submit_profile_run(meta["runId"], meta["userEmail"], file_paths, record_checkpoint=False)
+        try:
+            log_event = {"event": "RunResumed", "runId": meta["runId"], "companyName": meta.get("companyName"), "sectionsWithCheckpoints": len(meta.get("sections", {})), "resumeCount": meta.get("resumeCount", 0)}
+            save_log_entry_hf_dataset(user_email=meta["userEmail"], event_data=log_event, api=api, HF_TOKEN=HF_TOKEN, DATASET_REPO_ID=DATASET_REPO_ID)
+        except Exception as log_resume_e: print(f"Error logging RunResumed: {log_resume_e}")
+
+    try:
+        prune_runs()
+        resumed, abandoned = resume_unfinished_runs(submit_resumed_run)
+        if resumed or abandoned: print(f"Startup: Resumed {len(resumed)} interrupted runs ({len(abandoned)} could not be resumed).")
+    except Exception as resume_e:
+        print(f"Startup: Error resuming interrupted runs: {resume_e}")
+        traceback.print_exc()
+
+def list_previous_runs(auth_state):
+    """
+    Fills the previous-run selector with the user's finished runs (newest first).
+
+    Args:
+        auth_state (dict): Current authentication state
+
+    Returns:
+        Updated choices of the run dropdown
+    """
+    user_email = (auth_state or {}).get('email')
+    if not user_email:
+        return gr.update(choices=[], value=None)
+    choices = []
+    for meta in user_runs(user_email):
+        if meta.get("status") not in ("completed", "failed") or not meta.get("documents"):
+            continue
+        failed = unfinished_sections(meta)
+        submitted = datetime.fromtimestamp(meta.get("submittedAt") or meta.get("createdAt", 0)).strftime("%Y-%m-%d %H:%M")
+        choices.append((f"{meta.get('companyName') or 'Unknown company'} ({submitted}, {meta['status']}"
+                        f"{f', {len(failed)} sections to redo' if failed else ''}, run {meta['runId'][:8]})", meta["runId"]))
+    return gr.update(choices=choices, value=None)
+
+def handle_regenerate_click(parent_run_id, selected_sections, mode, auth_state):
+    """
+    Queues the regeneration of selected sections of a previous run.
+
+    Args:
+        parent_run_id (str): Selected previous run
+        selected_sections (list): Section labels / group names (empty: the sections that failed)
+        mode (str): 'generate' or 'refine'
+        auth_state (dict): Current authentication state
+
+    Returns:
+        str: Status message
+    """
+    user_email = (auth_state or {}).get('email')
+    if not (auth_state or {}).get('authenticated') or not user_email:
+        return "Error: Not authenticated."
+    if not parent_run_id:
+        return "Select a previous run first (click Load My Runs)."
+    try:
+        section_numbers = parse_section_selection(selected_sections, sections, section_groups) if selected_sections else None
+        run_id, queue_position = regenerate_run_sections(parent_run_id, user_email, section_numbers, mode)
+    except (ValueError, QueueFullError) as regen_e:
+        print(f"UI Thread: Regeneration of run {parent_run_id} rejected for user {user_email}: {regen_e}")
+        return f"{regen_e}"
+    message = (f"Re-{'generating' if mode == 'generate' else 'refining'} sections of the selected run (new run {run_id[:8]}). "
+               f"The rebuilt profile will be emailed to {user_email} upon completion.")
+    return (queue_status_message(job_queue, user_email, run_id) or message) if queue_position else message
+
+def handle_generate_click_with_status(file_paths, auth_state, selected_sections=None, base_run_id=None, force_regenerate=False):
     """
     Enhanced version of handle_generate_click that includes status container management.
     
     Args:
         file_paths (list): List of paths to uploaded PDF files
         auth_state (dict): Current authentication state
+        selected_sections (list): Optional section labels / group names (partial run)
+        base_run_id (str): Optional previous run to update incrementally (delta run)
+        force_regenerate (bool): Ignore cached results of identical earlier runs
         
     Returns:
         tuple: Updated states for all UI components including status container
     """
     # Show the status container first
-    result = handle_generate_click(file_paths, auth_state)
+    result = handle_generate_click(file_paths, auth_state, selected_sections, base_run_id, force_regenerate)
     # Return result plus visibility update for status container
     return [*result, gr.update(visible=True)]
 
@@ -583,7 +807,7 @@ with gr.Blocks(theme=gr.themes.Soft()) as demo:
     # --- Main Application Interface ---
     with gr.Column(visible=False, elem_classes="container") as main_app_section:
         # Add information about file upload
-        gr.Markdown("Select one or more PDF files containing company information. Maximum of 20MB in aggregate.")
+        gr.Markdown("Select one or more PDF files containing company information. Sets above 20MB in aggregate (up to 250MB) are processed in chunks and take longer.")
         
         # File upload with enhanced label
         pdf_upload = gr.File(
@@ -593,6 +817,31 @@ with gr.Blocks(theme=gr.themes.Soft()) as demo:
             type="filepath"
         )
         
+        # Optional partial run (dependent sections also generate the sections they build on)
+        with gr.Accordion("Sections (optional)", open=False):
+            section_select = gr.Dropdown(
+                choices=SECTION_CHOICES,
+                multiselect=True,
+                label="Generate only these sections or groups",
+                info="Leave empty for the full profile."
+            )
+            force_regenerate_checkbox = gr.Checkbox(
+                label="Force full regeneration",
+                value=False,
+                info="Identical documents are otherwise answered from the results of the earlier run."
+            )
+
+        # Optional delta run: only sections fed by added or removed documents are regenerated
+        with gr.Accordion("Update a previous profile (optional)", open=False):
+            with gr.Row():
+                delta_run_select = gr.Dropdown(
+                    label="Previous run of this company",
+                    choices=[],
+                    info="Upload the full new document set. Unchanged documents are recognised by their content.",
+                    scale=3
+                )
+                delta_load_button = gr.Button("Load My Runs", variant="secondary", scale=1)
+
         # File validation feedback
         file_validation = gr.HTML(
             visible=False,
@@ -639,6 +888,28 @@ with gr.Blocks(theme=gr.themes.Soft()) as demo:
                 variant="secondary"
             )
 
+        # Redo selected sections of a previous run, reusing its documents and all other sections
+        with gr.Accordion("Re-generate sections of a previous run", open=False):
+            with gr.Row():
+                regen_run_select = gr.Dropdown(label="Previous run", choices=[], scale=3)
+                regen_load_button = gr.Button("Load My Runs", variant="secondary", scale=1)
+            regen_section_select = gr.Dropdown(
+                choices=SECTION_CHOICES,
+                multiselect=True,
+                label="Sections to redo",
+                info="Leave empty to redo the sections that failed."
+            )
+            regen_mode = gr.Radio(
+                choices=[("Re-generate from the documents", "generate"), ("Re-run the refinement only", "refine")],
+                value="generate",
+                label="Mode"
+            )
+            regen_button = gr.Button("Re-generate Sections", variant="primary")
+            regen_status = gr.Markdown()
+
+        # Refreshes the queue position while a run is waiting for a free slot
+        queue_status_timer = gr.Timer(QUEUE_STATUS_REFRESH_SECONDS)
+
     # --- Simplified Event Connections ---
 
     # Connect Email input submit/button click to the new verification function
@@ -659,7 +930,7 @@ with gr.Blocks(theme=gr.themes.Soft()) as demo:
     # Connect Generate profile button
     generate_button.click(
         fn=handle_generate_click_with_status, # Returns 8 values now
-        inputs=[pdf_upload, auth_state],
+        inputs=[pdf_upload, auth_state, section_select, delta_run_select, force_regenerate_checkbox],
         # List 8 output components in the correct order
         outputs=[
             pdf_upload,                     # 1st return value
@@ -673,6 +944,30 @@ with gr.Blocks(theme=gr.themes.Soft()) as demo:
         ]
     )
 
+    # Previous runs for delta runs and regeneration
+    delta_load_button.click(
+        fn=list_previous_runs,
+        inputs=[auth_state],
+        outputs=[delta_run_select]
+    )
+    regen_load_button.click(
+        fn=list_previous_runs,
+        inputs=[auth_state],
+        outputs=[regen_run_select]
+    )
+    regen_button.click(
+        fn=handle_regenerate_click,
+        inputs=[regen_run_select, regen_section_select, regen_mode, auth_state],
+        outputs=[regen_status]
+    )
+
+    # Queue position feedback (no-op unless the user's run is waiting)
+    queue_status_timer.tick(
+        fn=refresh_queue_status,
+        inputs=[auth_state],
+        outputs=[status_output]
+    )
+
     # Reset Button connection remains the same logic, but outputs list changes
     reset_button.click(
         fn=reset_interface,
@@ -691,5 +986,19 @@ with gr.Blocks(theme=gr.themes.Soft()) as demo:
 
 # --- Launch the Gradio app ---
 if __name__ == "__main__":
+    if JOB_BACKEND != "sqlite": resume_interrupted_runs() # the durable queue re-queues interrupted runs itself
     demo.queue()
-    demo.launch(share=False, server_name="0.0.0.0") # Allow local network access# --- END OF REVISED app.py ---
+    # REST API for internal tools (mounted next to the UI when PROFILEDASH_API_TOKENS is set).
+    # Imported only then, so fastapi/uvicorn are not needed to run the UI alone.
+    api_requested = bool(os.environ.get("PROFILEDASH_API_TOKENS", "").strip())
+    if api_requested:
+        from src.http_api import create_job_api, http_api_enabled
+    if api_requested and http_api_enabled():
+        # Serve the UI and the /api routes from one server; API calls never occupy a Gradio worker
+        import uvicorn
+        api_app = create_job_api(submit_profile_run, is_email_permitted, job_queue, MAX_UPLOAD_BYTES, regenerate_run=regenerate_run_sections,
+                                 log_event_func=lambda user_email, event: save_log_entry_hf_dataset(user_email=user_email, event_data=event, api=api, HF_TOKEN=HF_TOKEN, DATASET_REPO_ID=DATASET_REPO_ID))
+        api_app = gr.mount_gradio_app(api_app, demo, path="/")
+        uvicorn.run(api_app, host="0.0.0.0", port=int(os.environ.get("GRADIO_SERVER_PORT", "7860")))
+    else:
+        demo.launch(share=False, server_name="0.0.0.0") # Allow local network access# --- END OF REVISED app.py ---
@@ -8,6 +8,8 @@ import json
 import hashlib
 import time
 import random
+import threading
+from contextlib import contextmanager
 import google.generativeai as genai
 import traceback # For more detailed error logging
 import google.api_core.exceptions # Import the specific exceptions module
@@ -16,6 +18,15 @@ import google.api_core.exceptions # Import the specific exceptions module
 api_cache = {}
 cache_file = "api_cache.json"
 CACHE_ENABLED_GLOBAL = True # Keep global switch if needed later
+# Using gemini-2.0-flash as a good balance of capability and speed/cost
+# Adjust MODEL_NAME if you specifically need Pro or another variant
+MODEL_NAME = "gemini-2.0-flash"
+# In-flight API calls across all concurrent runs (one process-wide budget, so several
+# runs share the quota instead of each pushing it into rate-limit retries)
+MAX_CONCURRENT_API_CALLS = int(os.environ.get("PROFILEDASH_MAX_CONCURRENT_API_CALLS", "6"))
+_api_call_slots = threading.BoundedSemaphore(MAX_CONCURRENT_API_CALLS)
+# Per-thread model name / timeout overrides (see api_call_overrides), used by second-chance retries
+_call_overrides = threading.local()
 
 # Load cache if it exists
 if os.path.exists(cache_file):
@@ -27,6 +38,19 @@ if os.path.exists(cache_file):
         print(f"API Cache Warning: Could not load API cache from {cache_file}. Error: {e}")
         api_cache = {}
 
+@contextmanager
+def api_call_overrides(model_name=None, timeout=None):
+    """
+    Within this block, models created on the current thread use `model_name` instead of
+    MODEL_NAME, and API calls made on it get at least `timeout` seconds (None = unchanged).
+    """
+    previous = (getattr(_call_overrides, "model_name", None), getattr(_call_overrides, "timeout", None))
+    _call_overrides.model_name, _call_overrides.timeout = model_name or previous[0], timeout or previous[1]
+    try:
+        yield
+    finally:
+        _call_overrides.model_name, _call_overrides.timeout = previous
+
 def get_cache_key(model_name, prompt_or_input_list):
     """Generate a cache key based on model and prompt/input list"""
     # Handle both string prompts and list inputs (for multimodal)
@@ -42,6 +66,23 @@ def get_cache_key(model_name, prompt_or_input_list):
 
     return hashlib.md5((model_name + input_str).encode('utf-8')).hexdigest()
 
+def _model_name(model):
+    """Try to get model name robustly"""
+    if hasattr(model, 'model_name'):
+        return model.model_name
+    if hasattr(model, '_model_name'): # Sometimes it's private
+        return model._model_name
+    return "unknown_model"
+
+def evict_cached_response(model, prompt_or_input_list):
+    """Drop a cached response that turned out to be unusable, so the next call asks the API again."""
+    if api_cache.pop(get_cache_key(_model_name(model), prompt_or_input_list), None) is None:
+        return False
+    try:
+        with open(cache_file, "w") as f: json.dump(api_cache, f, indent=2)
+    except Exception as e: print(f"API Cache Warning: Failed to save API cache after eviction: {e}")
+    return True
+
 def cached_generate_content(model, prompt_or_input_list, section_num=None, cache_enabled=True, max_retries=5, timeout=300): # Increased default timeout
     """Generate content with caching and exponential backoff for rate limits"""
     # Check global cache setting - if globally disabled, override local setting
@@ -50,15 +91,9 @@ def cached_generate_content(model, prompt_or_input_list, section_num=None, cache
         cache_enabled = False
 
     # Removed utils.get_elapsed_time dependency
+    timeout = max(timeout, getattr(_call_overrides, "timeout", None) or 0)
 
-    # Try to get model name robustly
-    model_name = "unknown_model"
-    if hasattr(model, 'model_name'):
-        model_name = model.model_name
-    elif hasattr(model, '_model_name'): # Sometimes it's private
-         model_name = model._model_name
-
-    cache_key = get_cache_key(model_name, prompt_or_input_list)
+    cache_key = get_cache_key(_model_name(model), prompt_or_input_list)
 
     if cache_enabled and cache_key in api_cache:
         print(f"API Client: {'Section ' + str(section_num) + ':' if section_num else ''} Using cached response")
@@ -100,7 +135,8 @@ def cached_generate_content(model, prompt_or_input_list, section_num=None, cache
 
             # --- Make the API call ---
             # Pass the prompt or the list directly
-            response = model.generate_content(prompt_or_input_list)
+            with _api_call_slots:
+                response = model.generate_content(prompt_or_input_list)
             # --- API Call Succeeded ---
 
             if response is None: raise ValueError("API returned None response.")
@@ -200,9 +236,7 @@ def cached_generate_content(model, prompt_or_input_list, section_num=None, cache
 
 def create_model_config(temperature=0.5, top_p=0.9, top_k=50): # Adjusted defaults based on 'Old version'
     """Creates a GenerativeModel instance with specific configuration."""
-    # Using gemini-2.0-flash as a good balance of capability and speed/cost
-    # Adjust model_name if you specifically need Pro or another variant
-    model_name = "gemini-2.0-flash"
+    model_name = getattr(_call_overrides, "model_name", None) or MODEL_NAME
     print(f"API Client: Creating model: {model_name} with temp={temperature}, top_p={top_p}, top_k={top_k}")
     try:
         # Define safety settings - BLOCK_MEDIUM_AND_ABOVE is a reasonable default
@@ -253,4 +287,13 @@ def set_global_cache_state(enabled=True):
              with open(cache_file, "w") as f: json.dump(api_cache, f, indent=2)
              print(f"API Cache: Saved cache to {cache_file} while disabling.")
          except Exception as e: print(f"API Cache Warning: Failed to save cache on disable: {e}")
-    return CACHE_ENABLED_GLOBAL
\ No newline at end of file
+    return CACHE_ENABLED_GLOBAL
+
+
+def set_max_concurrent_api_calls(limit):
+    """Resize the process-wide in-flight API call budget (call before any run starts)."""
+    global MAX_CONCURRENT_API_CALLS, _api_call_slots
+    MAX_CONCURRENT_API_CALLS = max(1, int(limit))
+    _api_call_slots = threading.BoundedSemaphore(MAX_CONCURRENT_API_CALLS)
+    print(f"API Client: At most {MAX_CONCURRENT_API_CALLS} API calls in flight across all runs.")
+    return MAX_CONCURRENT_API_CALLS
@@ -1,36 +1,51 @@
 import time
 import os
 import traceback
-import random
 import json
-from concurrent.futures import ThreadPoolExecutor, as_completed # Ensure these are imported
-import tempfile
 from datetime import datetime
 from huggingface_hub import upload_file, HfApi # Need HfApi defined or passed
 import io
-import uuid
 import base64
 from sendgrid.helpers.mail import (
     Mail, Email, To, Content, Attachment, FileContent, FileName,
     FileType, Disposition
 )
 import google.generativeai as genai
-import sendgrid # Need this to potentially check if sg object is valid
 
 # --- Import necessary functions/variables from OTHER src modules ---
 # Use relative imports because this file is inside src
-from .document_processor import load_document_content
+from .document_processor import encode_document_part, analyze_pdf_document, build_document_digest, CHARS_PER_TOKEN
+from .document_store import evict_document_entries
+from .run_store import RunCheckpoint, active_document_hashes, load_run_meta, diff_documents, unfinished_sections, UNFINISHED_STATUSES
+from .ingestion import ingest_documents
+from .section_quality import score_section_html, typical_section_length, record_section_lengths, select_sections_to_refine, REFINEMENT_GATE_SCORE, REFINEMENT_GATE_BOTTOM_N
+from .run_deadline import RUN_SLA_MINUTES, RunDeadline
+from .run_cache import RUN_CACHE_ENABLED, run_cache_key, load_cached_run, store_cached_run, cache_entry_dir
+from .page_dedup import PAGE_DEDUP_ENABLED, deduplicate_uploaded_documents, format_dedup_report
+from .map_reduce import (
+    MAP_REDUCE_MAX_TOTAL_BYTES, map_reduce_available, needs_map_reduce,
+    split_documents_into_chunks, add_map_reduce_tasks
+)
+from .scheduler import TaskScheduler
+from .consistency import group_sections_for_review, review_profile_consistency, format_section_issues
+from .section_dag import validate_section_dag, section_dependencies, uses_documents, downstream_sections, build_upstream_context, select_sections, affected_sections
+from .latency_history import LatencyEstimator, SECTION_CHAIN, MERGED_SECTION_CHAIN, PROFILE_SECTION_CHAIN, MIN_RECORDED_LATENCY_SECONDS, record_scheduler_latencies, save_latency_history
 from .html_generator import generate_full_html_profile
-from .section_processor import generate_initial_section
-from .section_definitions import sections
+from .section_processor import generate_initial_section, generate_section_batch, section_batches
+from .section_definitions import sections, document_type_sections
 from .prompts import persona, analysis_specs, output_format
-from .api_client import create_insight_model, create_fact_model # Import both models
+from .api_client import MODEL_NAME, create_insight_model, api_call_overrides
 # Import the core refinement functions
 from .refinement import (
     get_fact_critique,
     fact_improvement_response,
     get_insight_critique,
-    insight_improvement_response
+    insight_improvement_response,
+    merged_improvement_response,
+    parse_critique_verdict,
+    estimate_input_tokens,
+    INSIGHT_CRITIQUE_CONTEXT,
+    IMPROVEMENT_OUTPUT
 )
 
 # --- Moved HF Data Saving Functions ---
@@ -163,200 +178,525 @@ def save_profile_hf_dataset(
         print(f"HF Saver (background_processor) ERROR uploading final profile for run {run_id} to HF Dataset '{DATASET_REPO_ID}': {e}")
         return None
 
+def save_profile_to_disk(output_dir, filename, profile_content, append_log_func):
+    """Writes an aggregated profile to output_dir (batch runs). Returns the file path, or None on failure."""
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        file_path = os.path.join(output_dir, filename)
+        with open(file_path, "w", encoding="utf-8") as f: f.write(profile_content)
+        append_log_func(f"Profile written to {file_path}")
+        return file_path
+    except Exception as write_e:
+        append_log_func(f"ERROR writing profile to {output_dir}: {write_e}")
+        return None
+
 # --- Refinement Stage Functions ---
 
-# --- NEW: Helper Function to Refine ONE Section ---
-def _refine_single_section(
-    section_def, initial_html, documents_for_api, run_id, user_email, company_name,
-    hf_api_client, hf_token, dataset_repo_id, append_log_func # Include logger
-):
-    """Performs the 4-step refinement process for a single section."""
+REFINEMENT_STEPS = ["fact_critique", "fact_improve", "insight_critique", "insight_improve"]
+# "merged" mode: both critiques run at the same time on the same draft, then one improvement call
+# applies both (two calls on the critical path instead of four, three calls instead of four).
+# Compare it with the sequential chain on recorded runs first: python -m src.refinement_eval
+# "profile" mode: one review of the whole initial profile against the documents (consistency.py)
+# flags issues per section, and only the flagged sections get one improvement call.
+REFINEMENT_MODES = ("sequential", "merged", "profile")
+REFINEMENT_MODE = os.environ.get("PROFILEDASH_REFINEMENT_MODE", "sequential")
+MERGED_CRITIQUE_STEPS = ["fact_critique", "insight_critique"]
+MERGED_REFINEMENT_STEPS = MERGED_CRITIQUE_STEPS + ["merged_improve"]
+PROFILE_REFINEMENT_STEPS = ["consistency_improve"]
+# Skip an improvement call when its critique's verdict says nothing needs to change
+SKIP_CLEAN_IMPROVEMENTS = os.environ.get("PROFILEDASH_SKIP_CLEAN_IMPROVEMENTS", "1") != "0"
+# Second-chance pass: sections whose initial generation or refinement failed (timeout, safety block,
+# empty response) are retried once their stage is done, a few at a time, with a longer per-call
+# timeout and optionally another model, so a rate-limit storm does not leave holes in the profile
+CRITIQUE_ERROR_PREFIX = "Error: Could not generate" # what a critique returns when its call failed
+RETRY_FAILED_SECTIONS = os.environ.get("PROFILEDASH_RETRY_FAILED_SECTIONS", "1") != "0"
+RETRY_CONCURRENCY = int(os.environ.get("PROFILEDASH_RETRY_CONCURRENCY", "1"))
+RETRY_TIMEOUT_SECONDS = int(os.environ.get("PROFILEDASH_RETRY_TIMEOUT_SECONDS", "600"))
+RETRY_FALLBACK_MODEL = os.environ.get("PROFILEDASH_RETRY_FALLBACK_MODEL") or None # default: the run's model
+# Scheduler priorities (higher runs first among ready tasks). Initial generation goes first so the
+# initial profile is not delayed; refinement steps then fill workers left idle by slow sections.
+# Within a tier, tasks are ordered by the expected seconds left in their section's chain
+# (longest first, from the latency history), so heavy sections do not become the tail.
+INITIAL_PROFILE_PRIORITY = 10_000_000
+SAVE_TASK_PRIORITY = 1_000_000
+INITIAL_GENERATION_PRIORITY = 100_000
+RETRY_TASK_PRIORITY = -1_000_000 # second-chance retries only take workers nothing else needs
+
+
+def _run_refinement_step(step, section_def, state, documents_for_api, append_log_func, document_digest=None):
+    """
+    Performs ONE refinement step for a single section, updating `state`
+    ('html' = last good HTML, 'critique', 'critiques' by step, 'failed') in place. An
+    improvement step whose critique verdict is clean makes no call and sets
+    state['skipped_improvement']; an improvement made as a patch records state['patch_outcome']
+    (see patch_improvement). The insight critique gets the documents, document_digest
+    or neither, per INSIGHT_CRITIQUE_CONTEXT. A failed call (a critique error, or an improvement
+    that returned no response) sets state['failed'], so the retry pass picks the section up; an
+    improvement whose critique failed makes no call and sets state['critique_failed'].
+    """
     section_num = section_def["number"]
     section_title = section_def["title"]
     initial_instruction = section_def["specs"]
-    section_start_time = time.time()
-    step_failed_in_section = False
-    last_good_html = initial_html # Start with initial content
 
-    # Log entry for this worker/section
-    append_log_func(f"Worker refining Section {section_num} ('{section_title}')...")
-
-    try:
-        # --- Fact Refinement ---
+    if step == "fact_critique":
         append_log_func(f"S{section_num}: Fact Critique...")
-        _, fact_critique_text = get_fact_critique(initial_instruction, last_good_html, documents_for_api)
-
+        _, state["critique"] = get_fact_critique(initial_instruction, state["html"], documents_for_api)
+        state.setdefault("critiques", {})[step] = state["critique"]
+        if str(state["critique"]).startswith(CRITIQUE_ERROR_PREFIX):
+            append_log_func(f"S{section_num}: Error during Fact Critique.")
+            state["failed"] = True # Mark error, but continue
+    elif step == "fact_improve":
+        if str(state["critique"]).startswith(CRITIQUE_ERROR_PREFIX):
+            append_log_func(f"S{section_num}: No fact critique to act on. Skipping Fact Improve.")
+            state["failed"] = True; state["critique_failed"] = step
+            return
+        verdict, critique = parse_critique_verdict(state["critique"])
+        if SKIP_CLEAN_IMPROVEMENTS and verdict["noChangeNeeded"]:
+            append_log_func(f"S{section_num}: Fact critique found nothing to fix. Skipping Fact Improve.")
+            state["skipped_improvement"] = step
+            return
         append_log_func(f"S{section_num}: Fact Improve...")
-        _, fact_improved_html = fact_improvement_response(
-            initial_instruction, last_good_html, fact_critique_text, documents_for_api, section_num, section_title
+        improve_response, fact_improved_html = fact_improvement_response(
+            initial_instruction, state["html"], critique, documents_for_api, section_num, section_title, outcome=state.setdefault("patch_outcome", {})
         )
-        if not fact_improved_html or '<p class="error">' in fact_improved_html:
-             append_log_func(f"S{section_num}: Error during Fact Improvement. Using initial content for insight step.")
-             step_failed_in_section = True # Mark error, but continue
+        if improve_response is None or not fact_improved_html or '<p class="error">' in fact_improved_html:
+            append_log_func(f"S{section_num}: Error during Fact Improvement. Using initial content for insight step.")
+            state["failed"] = True # Mark error, but continue
         else:
-             last_good_html = fact_improved_html # Update last good HTML
-
-        # --- Insight Refinement ---
-        append_log_func(f"S{section_num}: Insight Critique...")
-        _, insight_critique_text = get_insight_critique(initial_instruction, last_good_html, documents_for_api)
-
+            state["html"] = fact_improved_html
+    elif step == "insight_critique":
+        append_log_func(f"S{section_num}: Insight Critique{'' if INSIGHT_CRITIQUE_CONTEXT == 'documents' else ' (' + INSIGHT_CRITIQUE_CONTEXT + ', no documents)'}...")
+        _, state["critique"] = get_insight_critique(
+            initial_instruction, state["html"], documents_for_api if INSIGHT_CRITIQUE_CONTEXT == "documents" else None,
+            document_digest if INSIGHT_CRITIQUE_CONTEXT == "digest" else None
+        )
+        state.setdefault("critiques", {})[step] = state["critique"]
+        if str(state["critique"]).startswith(CRITIQUE_ERROR_PREFIX):
+            append_log_func(f"S{section_num}: Error during Insight Critique.")
+            state["failed"] = True # Mark error, but continue
+    elif step == "insight_improve":
+        if str(state["critique"]).startswith(CRITIQUE_ERROR_PREFIX):
+            append_log_func(f"S{section_num}: No insight critique to act on. Skipping Insight Improve.")
+            state["failed"] = True; state["critique_failed"] = step
+            return
+        verdict, critique = parse_critique_verdict(state["critique"])
+        if SKIP_CLEAN_IMPROVEMENTS and verdict["noChangeNeeded"]:
+            append_log_func(f"S{section_num}: Insight critique found nothing to improve. Skipping Insight Improve.")
+            state["skipped_improvement"] = step
+            return
         append_log_func(f"S{section_num}: Insight Improve...")
-        _, insight_improved_html = insight_improvement_response(
-            initial_instruction, last_good_html, insight_critique_text, documents_for_api, section_num, section_title
+        improve_response, insight_improved_html = insight_improvement_response(
+            initial_instruction, state["html"], critique, documents_for_api, section_num, section_title, outcome=state.setdefault("patch_outcome", {})
+        )
+        if improve_response is None or not insight_improved_html or '<p class="error">' in insight_improved_html:
+            append_log_func(f"S{section_num}: Error during Insight Improvement. Using previous step's content.")
+            state["failed"] = True # Mark error, but continue
+        else:
+            state["html"] = insight_improved_html
+    elif step == "merged_improve":
+        critiques, failed_critiques = {}, []
+        for critique_step, critique_text in state.get("critiques", {}).items():
+            if str(critique_text).startswith(CRITIQUE_ERROR_PREFIX): failed_critiques.append(critique_step); continue
+            verdict, critique = parse_critique_verdict(critique_text)
+            if not (SKIP_CLEAN_IMPROVEMENTS and verdict["noChangeNeeded"]): critiques[critique_step] = critique
+        if failed_critiques: state["failed"] = True
+        if not critiques and failed_critiques:
+            append_log_func(f"S{section_num}: No usable critique ({', '.join(failed_critiques)} failed). Skipping Merged Improve.")
+            state["critique_failed"] = step
+            return
+        if not critiques:
+            append_log_func(f"S{section_num}: Critiques found nothing to fix or improve. Skipping Merged Improve.")
+            state["skipped_improvement"] = step
+            return
+        append_log_func(f"S{section_num}: Merged Improve ({' + '.join(step_name.split('_')[0] for step_name in critiques)})...")
+        improve_response, merged_improved_html = merged_improvement_response(
+            initial_instruction, state["html"], critiques.get("fact_critique"), critiques.get("insight_critique"), documents_for_api, section_num, section_title,
+            outcome=state.setdefault("patch_outcome", {})
+        )
+        if improve_response is None or not merged_improved_html or '<p class="error">' in merged_improved_html:
+            append_log_func(f"S{section_num}: Error during Merged Improvement. Using initial content.")
+            state["failed"] = True # Mark error, but continue
+        else:
+            state["html"] = merged_improved_html
+    elif step == "consistency_improve":
+        critique = state.get("critiques", {}).get("consistency_review")
+        if not critique:
+            append_log_func(f"S{section_num}: Profile review flagged no issues. Skipping Consistency Improve.")
+            state["skipped_improvement"] = step
+            return
+        append_log_func(f"S{section_num}: Consistency Improve...")
+        improve_response, consistency_improved_html = fact_improvement_response(
+            initial_instruction, state["html"], critique, documents_for_api, section_num, section_title, outcome=state.setdefault("patch_outcome", {})
         )
-        if not insight_improved_html or '<p class="error">' in insight_improved_html:
-             append_log_func(f"S{section_num}: Error during Insight Improvement. Using previous step's content.")
-             step_failed_in_section = True # Mark error, but continue
+        if improve_response is None or not consistency_improved_html or '<p class="error">' in consistency_improved_html:
+            append_log_func(f"S{section_num}: Error during Consistency Improvement. Using initial content.")
+            state["failed"] = True # Mark error, but continue
         else:
-             last_good_html = insight_improved_html # Update last good HTML
-
-    except Exception as section_e:
-        # Catch errors from critique/improvement API calls themselves
-        error_msg = f"S{section_num} ERROR during refinement API calls: {type(section_e).__name__} - {str(section_e)}"
-        append_log_func(error_msg); traceback.print_exc() # Log error from worker
-        # Use the last known good HTML and add an error marker
-        last_good_html += f'\n<p class="error">Refinement process failed for this section: {type(section_e).__name__}</p>'
-        step_failed_in_section = True
-        # Log failure for this section to dataset
+            state["html"] = consistency_improved_html
+    else:
+        raise ValueError(f"Unknown refinement step: {step}")
+
+
+def _save_refined_section(
+    section_def, state, run_id, user_email, company_name,
+    hf_api_client, hf_token, dataset_repo_id, append_log_func
+):
+    """Saves a refined section (and logs its failure, if any). Returns True if the save succeeded."""
+    section_num = section_def["number"]
+    if state.get("error_msg"):
         try:
-            log_event = {"event": "RefinementSectionFailed", "runId": run_id, "section": section_num, "status": "Error", "error": error_msg}
+            log_event = {"event": "RefinementSectionFailed", "runId": run_id, "section": section_num, "status": "Error", "error": state["error_msg"]}
             save_log_entry_hf_dataset(user_email=user_email, event_data=log_event, api=hf_api_client, HF_TOKEN=hf_token, DATASET_REPO_ID=dataset_repo_id)
         except Exception as log_err:
             append_log_func(f"S{section_num}: Error logging section failure: {log_err}")
 
-    # --- Save Refined Section (still within the worker task) ---
-    final_refined_html_for_section = last_good_html
+    if hf_api_client is None:
+        append_log_func(f"S{section_num}: Dataset uploads disabled. Refined content kept for the final profile only.")
+        return True
     append_log_func(f"S{section_num}: Saving final refined content...")
-    save_successful = False # Default to false
     try:
         save_successful = save_section_hf_dataset(
-             section_num=section_num, section_content=final_refined_html_for_section, content_type="html_refined",
+             section_num=section_num, section_content=state["html"], content_type="html_refined",
              run_id=run_id, company_name=company_name, user_email=user_email,
              api=hf_api_client, HF_TOKEN=hf_token, DATASET_REPO_ID=dataset_repo_id,
              filename_suffix="_refined"
         )
         if not save_successful: raise Exception("save_section_hf_dataset returned False")
         append_log_func(f"S{section_num}: Refined content saved.")
+        return True
     except Exception as save_e:
-         append_log_func(f"S{section_num}: ERROR saving refined section: {save_e}")
-         step_failed_in_section = True # Mark error if saving failed
+        append_log_func(f"S{section_num}: ERROR saving refined section: {save_e}")
+        return False
 
-    section_duration = time.time() - section_start_time
-    status_msg = "FAILED" if step_failed_in_section else "OK"
-    append_log_func(f"Worker finished Section {section_num} in {section_duration:.1f}s. Status: {status_msg}")
 
-    # Return section number, the resulting HTML, and error status
-    return section_num, final_refined_html_for_section, step_failed_in_section
+def new_refinement_metrics():
+    """Per-run refinement counters ('metrics' in refinement_state; reported when the stage finishes)."""
+    return {"critiques": 0, "cleanVerdicts": 0, "improvementCalls": 0, "improvementsSkipped": 0, "inputTokensSaved": 0, "outputTokensSaved": 0,
+            "documentFreeCritiques": 0, "critiqueTokensSaved": 0, "patchesApplied": 0, "patchFallbacks": 0,
+            "consistencyReviews": 0, "consistencyIssues": 0, "sectionsGated": 0, "gateCallsSaved": 0, "gateInputTokensSaved": 0, "gateOutputTokensSaved": 0,
+            "refinementRetries": 0, "refinementRetriesRecovered": 0}
 
 
-# --- REVISED Refinement Orchestration Function (Parallel) ---
-def run_refinement_stage(
-    # --- Context Passed from Initial Workflow ---
+def quality_gate_reason(section_num, quality_scores, threshold, bottom_n):
+    """Why the quality gate keeps a scored section unrefined, or None if it is refined."""
+    if section_num not in quality_scores or section_num in select_sections_to_refine(quality_scores, threshold, bottom_n):
+        return None
+    return (f"quality score {quality_scores[section_num]:.0f}" + (f" is not below {threshold:g}" if threshold else "")
+            + (f"{',' if threshold else ' is'} not among the {bottom_n} lowest" if bottom_n else ""))
+
+
+def queue_section_refinement(
+    scheduler, section_def, initial_html, documents_for_api, refinement_state,
+    run_id, user_email, company_name, hf_api_client, hf_token, dataset_repo_id, append_log_func,
+    priority_func=None, checkpoint=None, deadline=None, mode=None, gate_reason=None
+):
+    """
+    Queues the refinement of one section on `scheduler`, each step submitted once the previous
+    one is done, and records the outcome in refinement_state ('results', 'error', 'metrics').
+
+    Args:
+        priority_func (callable): Optional priority_func(section_def, step) for each step.
+        checkpoint (RunCheckpoint): Persists every step; a resumed run continues after the last one.
+        deadline (RunDeadline): Asked before each step; a skipped step ends the refinement.
+        mode (str): 'sequential', 'merged' or 'profile' (default REFINEMENT_MODE).
+        gate_reason (str): If set, the quality gate ships the section unrefined.
+    """
+    section_num = section_def["number"]
+    section_title = section_def["title"]
+    mode = mode or REFINEMENT_MODE
+    steps = MERGED_REFINEMENT_STEPS if mode == "merged" else PROFILE_REFINEMENT_STEPS if mode == "profile" else REFINEMENT_STEPS
+
+    def count_processed():
+        refinement_state["processed"] += 1
+        progress_percent = int((refinement_state["processed"] / refinement_state["total"]) * 100)
+        append_log_func(f"[Refinement Stage] Overall Refinement Progress: {refinement_state['processed']}/{refinement_state['total']} ({progress_percent}%) sections complete.")
+
+    # Skip sections that had errors initially
+    if not initial_html or '<p class="error">' in initial_html:
+        append_log_func(f"[Refinement Stage] Section {section_num}: Skipping refinement due to missing or error in initial content.")
+        refinement_state["results"][section_num] = initial_html # Store original error/missing content
+        refinement_state["error"] = True
+        count_processed()
+        return
+
+    def record_failure():
+        """A failed section goes to the retry pass, if the caller runs one."""
+        if "retry_queue" in refinement_state: refinement_state["retry_queue"][section_num] = (section_def, initial_html, documents_for_api)
+        else: refinement_state["error"] = True
+
+    state = {"html": initial_html, "critique": None, "critiques": {}, "failed": False, "error_msg": None, "start_time": time.time()}
+    if mode == "profile" and (refinement_state.get("consistency_issues") or {}).get(section_num):
+        state["critiques"]["consistency_review"] = refinement_state["consistency_issues"][section_num]
+    first_step = 0
+    progress = checkpoint.section_progress(section_num) if checkpoint else None
+    if progress and progress["step"] in steps + ["refined"]:
+        checkpointed_html, checkpointed_critique, _ = checkpoint.load_step(section_num, progress["step"])
+        if checkpointed_html:
+            state.update(html=checkpointed_html, critique=checkpointed_critique, failed=progress["failed"])
+            if progress["step"] == "refined":
+                append_log_func(f"[Refinement Stage] Section {section_num}: Already refined and saved before the restart.")
+                refinement_state["results"][section_num] = state["html"]
+                if state["failed"]: record_failure()
+                count_processed()
+                return
+            first_step = steps.index(progress["step"]) + 1
+            if mode == "merged": # either critique may have finished first
+                state["critiques"] = {step: critique for step in MERGED_CRITIQUE_STEPS for critique in [checkpoint.load_step(section_num, step)[1]] if critique}
+            append_log_func(f"[Refinement Stage] Section {section_num}: Resuming after checkpointed step '{progress['step']}'.")
+
+    def section_saved(key, save_successful, error):
+        refinement_state["results"][section_num] = state["html"]
+        section_had_error = state["failed"] or not save_successful
+        if checkpoint: checkpoint.save_step(section_num, "refined", state["html"], failed=section_had_error)
+        if state["failed"]: record_failure()
+        if not save_successful:
+            refinement_state["error"] = True
+        section_duration = time.time() - state["start_time"]
+        append_log_func(f"Finished refining Section {section_num} in {section_duration:.1f}s. Status: {'FAILED' if section_had_error else 'OK'}")
+        count_processed()
+
+    def step_done(step_index, skip_reason, error):
+        if error is not None:
+            # Catch errors from critique/improvement API calls themselves
+            state["error_msg"] = f"S{section_num} ERROR during refinement API calls: {type(error).__name__} - {str(error)}"
+            append_log_func(state["error_msg"])
+            # Use the last known good HTML and add an error marker
+            state["html"] += f'\n<p class="error">Refinement process failed for this section: {type(error).__name__}</p>'
+            state["failed"] = True
+        elif skip_reason:
+            append_log_func(f"S{section_num}: Deadline: refinement stopped before '{steps[step_index]}' ({skip_reason}).")
+        else:
+            record_step_metrics(steps[step_index])
+            if checkpoint: checkpoint.save_step(section_num, steps[step_index], state["html"], critique=state["critiques"].get(steps[step_index], state["critique"]), failed=state["failed"])
+            if mode == "sequential" and step_index + 1 < len(steps):
+                submit_step(step_index + 1)
+                return
+        submit_save()
+
+    def critique_done(step, skip_reason, error):
+        """A merged-mode critique finished; the merged improvement waits for both."""
+        if error is not None:
+            state["error_msg"] = f"S{section_num} ERROR during {step.replace('_', ' ')}: {type(error).__name__} - {str(error)}"
+            append_log_func(state["error_msg"])
+            state["critiques"].pop(step, None); state["failed"] = True
+        elif skip_reason:
+            append_log_func(f"S{section_num}: Deadline: '{step}' skipped ({skip_reason}).")
+        else:
+            record_step_metrics(step)
+            if checkpoint: checkpoint.save_step(section_num, step, state["html"], critique=state["critiques"].get(step), failed=state["failed"])
+
+    def record_step_metrics(step):
+        metrics = refinement_state.setdefault("metrics", new_refinement_metrics())
+        if step.endswith("_critique"):
+            metrics["critiques"] += 1
+            if parse_critique_verdict(state["critiques"].get(step))[0]["noChangeNeeded"]: metrics["cleanVerdicts"] += 1
+            if step == "insight_critique" and INSIGHT_CRITIQUE_CONTEXT != "documents":
+                metrics["documentFreeCritiques"] += 1
+                metrics["critiqueTokensSaved"] += max(0, estimate_input_tokens(documents_for_api, refinement_state.get("document_tokens", 0))
+                                                      - len(refinement_state.get("document_digest") or "") // CHARS_PER_TOKEN)
+        elif state.pop("critique_failed", None):
+            pass # no call made; the section is marked failed
+        elif state.pop("skipped_improvement", None):
+            input_tokens, output_tokens = estimated_step_tokens(step)
+            metrics["improvementsSkipped"] += 1
+            metrics["inputTokensSaved"] += input_tokens
+            metrics["outputTokensSaved"] += output_tokens
+        else:
+            metrics["improvementCalls"] += 1
+            patch = state.pop("patch_outcome", {}).get("patch")
+            if patch: metrics["patchesApplied" if patch == "applied" else "patchFallbacks"] += 1
+
+    def estimated_step_tokens(step):
+        """(input, output) tokens a step would cost for this section."""
+        html_tokens = len(state["html"]) // CHARS_PER_TOKEN
+        documents = [] if step == "insight_critique" and INSIGHT_CRITIQUE_CONTEXT != "documents" else documents_for_api
+        input_tokens = estimate_input_tokens(documents, refinement_state.get("document_tokens", 0)) + html_tokens + len(section_def["specs"]) // CHARS_PER_TOKEN
+        return input_tokens, 0 if step.endswith("_critique") else html_tokens
+
+    def record_gate_savings():
+        metrics = refinement_state.setdefault("metrics", new_refinement_metrics())
+        metrics["sectionsGated"] += 1
+        for step in steps[first_step:]:
+            if step == "consistency_improve" and not state["critiques"].get("consistency_review"): continue # would have been skipped anyway
+            input_tokens, output_tokens = estimated_step_tokens(step)
+            metrics["gateCallsSaved"] += 1; metrics["gateInputTokensSaved"] += input_tokens; metrics["gateOutputTokensSaved"] += output_tokens
+
+    def run_step(step):
+        """Runs one step unless the run deadline skips it; returns the skip reason, if any."""
+        skip_reason = deadline.check_step(section_def, step, state["html"]) if deadline else None
+        if not skip_reason: _run_refinement_step(step, section_def, state, documents_for_api, append_log_func, refinement_state.get("document_digest"))
+        return skip_reason
+
+    def step_priority(step):
+        return priority_func(section_def, step) if priority_func else steps.index(step) + 1
+
+    def submit_save():
+        scheduler.add_task(
+            ("save_refined", section_num), _save_refined_section, section_def, state, run_id, user_email, company_name,
+            hf_api_client, hf_token, dataset_repo_id, append_log_func,
+            priority=SAVE_TASK_PRIORITY, on_complete=section_saved
+        )
+
+    def submit_step(step_index):
+        scheduler.add_task(
+            ("refine", section_num, steps[step_index]), run_step, steps[step_index], priority=step_priority(steps[step_index]),
+            on_complete=lambda key, skip_reason, error: step_done(step_index, skip_reason, error)
+        )
+
+    def submit_merged():
+        critique_keys = []
+        for critique_step in MERGED_CRITIQUE_STEPS:
+            if critique_step in state["critiques"]: continue # checkpointed before the restart
+            critique_keys.append(("refine", section_num, critique_step))
+            scheduler.add_task(critique_keys[-1], run_step, critique_step, priority=step_priority(critique_step),
+                               on_complete=lambda key, skip_reason, error, critique_step=critique_step: critique_done(critique_step, skip_reason, error))
+        scheduler.add_task(
+            ("refine", section_num, "merged_improve"), run_step, "merged_improve", deps=critique_keys, priority=step_priority("merged_improve"),
+            on_complete=lambda key, skip_reason, error: step_done(steps.index("merged_improve"), skip_reason, error)
+        )
+
+    if gate_reason and first_step < len(steps):
+        append_log_func(f"[Refinement Stage] Section {section_num}: Quality gate: not refined ({gate_reason}).")
+        record_gate_savings()
+        submit_save()
+        return
+    append_log_func(f"Queued {mode} refinement of Section {section_num} ('{section_title}').")
+    if first_step >= len(steps): submit_save()
+    elif mode == "merged": submit_merged()
+    else: submit_step(first_step)
+
+
+def queue_retry_tasks(scheduler, kind, section_defs, func, after=()):
+    """
+    Queue func(section_def) as a (kind, section number) task per section at RETRY_TASK_PRIORITY,
+    RETRY_CONCURRENCY at a time: each task waits for the one RETRY_CONCURRENCY places before it
+    (the first ones for the keys in `after`). Returns the task keys in order.
+    """
+    lanes = max(1, RETRY_CONCURRENCY); keys = []
+    for index, section_def in enumerate(section_defs):
+        deps = [keys[index - lanes]] if index >= lanes else list(after)
+        keys.append((kind, section_def["number"]))
+        scheduler.add_task(keys[-1], func, section_def, deps=deps, priority=RETRY_TASK_PRIORITY)
+    return keys
+
+
+def retry_failed_refinements(
+    scheduler, refinement_state, run_id, user_email, company_name, hf_api_client, hf_token, dataset_repo_id, append_log_func,
+    checkpoint=None, deadline=None, mode=None
+):
+    """
+    Second-chance pass over the sections whose refinement failed (refinement_state['retry_queue'],
+    filled by queue_section_refinement) once `scheduler` has run everything else: each is refined again
+    from its initial content as a task on `scheduler`, RETRY_CONCURRENCY at a time, with RETRY_TIMEOUT_SECONDS per call and
+    RETRY_FALLBACK_MODEL, if set. A recovered section replaces its failed result (and checkpoint);
+    one that fails again keeps it and marks the stage as having errors. deadline (RunDeadline), if
+    given, is asked before each retried step, as in the main pass; a section it stops after at least
+    one retried step is 'degraded' and ships with its last completed retry step, one it stops before
+    any is 'skipped' and keeps its failed result.
+
+    Returns:
+        dict: 'retried', 'recovered', 'degraded' and 'skipped' section numbers.
+    """
+    retry_queue = refinement_state.pop("retry_queue", None) or {}
+    mode = mode or REFINEMENT_MODE
+    steps = MERGED_REFINEMENT_STEPS if mode == "merged" else PROFILE_REFINEMENT_STEPS if mode == "profile" else REFINEMENT_STEPS
+    outcome = {"retried": [], "recovered": [], "degraded": [], "skipped": []}
+    if not retry_queue:
+        return outcome
+    if deadline and deadline.remaining() <= 0:
+        append_log_func(f"[Refinement Stage] Retry: no time left in the run budget. Sections {sorted(retry_queue)} keep their failed refinement.")
+        refinement_state["error"] = True
+        return outcome
+
+    def retry_section(section_def, initial_html, documents_for_api):
+        state = {"html": initial_html, "critique": None, "critiques": {}, "failed": False, "error_msg": None, "steps_done": 0}
+        if mode == "profile" and (refinement_state.get("consistency_issues") or {}).get(section_def["number"]):
+            state["critiques"]["consistency_review"] = refinement_state["consistency_issues"][section_def["number"]]
+        with api_call_overrides(model_name=RETRY_FALLBACK_MODEL, timeout=RETRY_TIMEOUT_SECONDS):
+            for step in steps:
+                skip_reason = deadline.check_step(section_def, step, state["html"]) if deadline else None
+                if skip_reason:
+                    append_log_func(f"S{section_def['number']}: Deadline: retry stopped before '{step}' ({skip_reason}).")
+                    state["deadline_skip"] = step; break
+                _run_refinement_step(step, section_def, state, documents_for_api, append_log_func, refinement_state.get("document_digest"))
+                if state["failed"]: break
+                state["steps_done"] += 1
+        return state
+
+    outcome["retried"] = sorted(retry_queue)
+    append_log_func(f"[Refinement Stage] Retry: refining {len(retry_queue)} failed sections {outcome['retried']} again "
+                    f"({max(1, RETRY_CONCURRENCY)} at a time, {RETRY_TIMEOUT_SECONDS}s per call{', model ' + RETRY_FALLBACK_MODEL if RETRY_FALLBACK_MODEL else ''})...")
+    # After everything the main pass ran, on the same scheduler (and worker budget)
+    retry_keys = queue_retry_tasks(scheduler, "refinement_retry", [retry_queue[num][0] for num in outcome["retried"]],
+                                   lambda section_def: retry_section(*retry_queue[section_def["number"]]), after=list(scheduler.durations))
+    scheduler.run()
+    for key in retry_keys:
+        section_num = key[1]; section_def = retry_queue[section_num][0]
+        if scheduler.error(key) is not None:
+            state = {"failed": True}
+            append_log_func(f"S{section_num}: Retry: refinement failed again: {type(scheduler.error(key)).__name__} - {scheduler.error(key)}")
+        else:
+            state = scheduler.result(key)
+        if state["failed"]:
+            append_log_func(f"S{section_num}: Retry did not recover the section. Keeping its failed refinement.")
+            refinement_state["error"] = True
+            continue
+        if not state["steps_done"]: # the deadline stopped the retry before its first step
+            append_log_func(f"S{section_num}: Retry skipped by the run deadline. Keeping its failed refinement.")
+            refinement_state["error"] = True; outcome["skipped"].append(section_num)
+            continue
+        refinement_state["results"][section_num] = state["html"]
+        if checkpoint: checkpoint.save_step(section_num, "refined", state["html"], failed=False)
+        if not _save_refined_section(section_def, state, run_id, user_email, company_name, hf_api_client, hf_token, dataset_repo_id, append_log_func):
+            refinement_state["error"] = True
+        if state.get("deadline_skip"):
+            append_log_func(f"S{section_num}: Retry cut short by the run deadline. Shipping its last completed step.")
+            outcome["degraded"].append(section_num)
+        else:
+            append_log_func(f"S{section_num}: Retry recovered the section's refinement.")
+            outcome["recovered"].append(section_num)
+    metrics = refinement_state.setdefault("metrics", new_refinement_metrics())
+    metrics["refinementRetries"] += len(outcome["retried"]); metrics["refinementRetriesRecovered"] += len(outcome["recovered"])
+    append_log_func(f"[Refinement Stage] Retry: {len(outcome['recovered'])} of {len(outcome['retried'])} failed sections recovered.")
+    return outcome
+
+
+def finalize_refinement_stage(
     run_id: str,
     user_email: str,
-    api_key: str,
     company_name: str,
-    initial_results: dict,
-    documents_for_api: list,
-    append_log_func, # Callback for logging
-    # --- Clients & Config Passed In ---
+    refinement_state: dict,
+    refinement_start_time: float,
+    append_log_func,
     sg_client,
     hf_api_client,
     hf_token: str,
     dataset_repo_id: str,
     sender_email: str,
     app_version: str,
-    max_workers: int # <<< ADDED max_workers
+    output_dir: str = None,
+    profile_sections: list = None,
+    degradation: dict = None
     ):
     """
-    Orchestrates the refinement process section by section IN PARALLEL
-    after initial generation.
+    Aggregates, saves and emails the refined profile once every section has been refined.
+    With output_dir, the profile is also written there (refined_profile.html); the local
+    file then counts as saved when dataset uploads are disabled (hf_api_client None).
+    profile_sections limits the profile to a partial run's sections (default: all).
+    degradation (RunDeadline.summary()), if sections were cut short by the run deadline, is
+    reported in the email and the completion log event.
     """
-    # --- Helper for logging within refinement ---
     def _log_refinement(message):
-        append_log_func(f"[Refinement Stage] {message}") # Use the passed logger
-
-    _log_refinement("Starting Refinement Stage...")
-    refinement_start_time = time.time()
-
-    # --- Configure Google AI SDK ---
-    try:
-        genai.configure(api_key=api_key)
-        _log_refinement("Google AI SDK configured for refinement.")
-    except Exception as config_e:
-        error_msg = f"CRITICAL ERROR configuring Google AI SDK for refinement: {type(config_e).__name__} - {str(config_e)}"
-        _log_refinement(error_msg)
-        log_event = {"event": "RefinementStageFailed", "runId": run_id, "status": "Error", "error": error_msg, "stage": "GenAI Config"}
-        save_log_entry_hf_dataset(user_email=user_email, event_data=log_event, api=hf_api_client, HF_TOKEN=hf_token, DATASET_REPO_ID=dataset_repo_id)
-        return
-
-    # --- Parallel Refinement Loop ---
-    refined_results = {}
-    section_processing_error_refinement = False
-    total_sections = len(sections)
-    processed_count = 0
-
-    _log_refinement(f"Starting parallel refinement with {max_workers} workers...")
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_section_num = {}
-        for section_def in sorted(sections, key=lambda x: x["number"]):
-            section_num = section_def["number"]
-            initial_html = initial_results.get(section_num)
-
-            # Skip sections that had errors initially
-            if not initial_html or '<p class="error">' in initial_html:
-                _log_refinement(f"Section {section_num}: Skipping refinement due to missing or error in initial content.")
-                refined_results[section_num] = initial_html # Store original error/missing content
-                section_processing_error_refinement = True
-                processed_count += 1 # Count as processed for progress tracking
-                continue
-
-            # Submit the refinement task for this section
-            future = executor.submit(
-                _refine_single_section, # Call the helper function
-                section_def,
-                initial_html,
-                documents_for_api,
-                run_id,
-                user_email,
-                company_name,
-                hf_api_client,
-                hf_token,
-                dataset_repo_id,
-                append_log_func # Pass logger to worker
-            )
-            future_to_section_num[future] = section_num
-
-        # Process results as they complete
-        _log_refinement("Tasks submitted. Waiting for refinement completion...")
-        for future in as_completed(future_to_section_num):
-            section_num = future_to_section_num[future]
-            try:
-                s_num_result, refined_html_result, section_had_error = future.result()
-                refined_results[s_num_result] = refined_html_result
-                if section_had_error:
-                    section_processing_error_refinement = True # Mark if any section had an error
-                _log_refinement(f"Completed processing for section {s_num_result}.")
-            except Exception as exc:
-                _log_refinement(f"Section {section_num} refinement generated an exception in future processing: {exc}")
-                traceback.print_exc()
-                # Store a generic error message if future itself failed
-                # Attempt to get title safely
-                title = "Unknown Title"
-                try: title = sections[section_num-1]["title"]
-                except: pass
-                refined_results[section_num] = f'<div class="section" id="section-{section_num}"><h2 class="error-header">{section_num}. {title}</h2><p class="error">ERROR: Refinement task failed unexpectedly: {exc}</p></div>'
-                section_processing_error_refinement = True
-
-            processed_count += 1
-            progress_percent = int((processed_count / total_sections) * 100)
-            _log_refinement(f"Overall Refinement Progress: {processed_count}/{total_sections} ({progress_percent}%) sections complete.")
+        append_log_func(f"[Refinement Stage] {message}")
 
+    refined_results = refinement_state["results"]
+    section_processing_error_refinement = refinement_state["error"]
 
     # --- Aggregation and Final Saving ---
     _log_refinement("Refinement loop completed. Aggregating final refined profile...")
+    profile_sections = profile_sections or sections
     ordered_refined_contents = []
-    for section_def in sorted(sections, key=lambda x: x["number"]):
+    for section_def in sorted(profile_sections, key=lambda x: x["number"]):
         content = refined_results.get(section_def["number"], f'<div class="section" id="section-{section_def["number"]}"><h2 class="error-header">{section_def["number"]}. {section_def["title"]}</h2><p class="error">ERROR: Refined content missing during final aggregation.</p></div>')
         ordered_refined_contents.append(str(content))
 
@@ -364,14 +704,15 @@ def run_refinement_stage(
     final_profile_saved_to_dataset = False
     final_profile_repo_path = None
     try:
-        final_refined_html = generate_full_html_profile(f"{company_name} (Refined)", sections, ordered_refined_contents, app_version) # Pass app_version
+        final_refined_html = generate_full_html_profile(f"{company_name} (Refined)", profile_sections, ordered_refined_contents, app_version) # Pass app_version
         if final_refined_html:
+            local_path = save_profile_to_disk(output_dir, "refined_profile.html", final_refined_html, _log_refinement) if output_dir else None
             _log_refinement("Final refined HTML generated. Saving to dataset...")
             saved_repo_path = save_profile_hf_dataset(
                 profile_content=final_refined_html, content_type="html_refined", run_id=run_id, company_name=company_name, user_email=user_email,
                 api=hf_api_client, HF_TOKEN=hf_token, DATASET_REPO_ID=dataset_repo_id, # Pass context
                 filename_suffix="_refined" # Pass suffix
-            )
+            ) if hf_api_client is not None else local_path
             if saved_repo_path:
                 final_profile_saved_to_dataset = True; final_profile_repo_path = saved_repo_path
                 _log_refinement(f"Final refined profile saved successfully: {saved_repo_path}")
@@ -385,6 +726,15 @@ def run_refinement_stage(
         log_event = {"event": "RefinementStageFailed", "runId": run_id, "status": "Error", "error": error_msg, "stage": "Aggregation/Save"}
         save_log_entry_hf_dataset(user_email=user_email, event_data=log_event, api=hf_api_client, HF_TOKEN=hf_token, DATASET_REPO_ID=dataset_repo_id)
 
+    # --- Sections whose refinement was cut short by the run deadline ---
+    degraded_sections = (degradation or {}).get("sections") or {}
+    degradation_note = ""
+    if degraded_sections:
+        titles = {section_def["number"]: section_def["title"] for section_def in profile_sections}
+        _log_refinement(f"Deadline: {len(degraded_sections)} sections were refined partially to stay within the {degradation['slaMinutes']:g} min budget.")
+        degradation_note = f"<p><i>To deliver within the {degradation['slaMinutes']:g}-minute time budget, the refinement of {len(degraded_sections)} sections was shortened:</i></p><ul>" + "".join(
+            f"<li>{num}. {titles.get(int(num), '')}: stopped before {record['step'].replace('_', ' ')} ({record['reason']})</li>" for num, record in degraded_sections.items()) + "</ul>"
+
     # --- Send Final Refined Email ---
     _log_refinement("Preparing refined profile email notification...")
     email_subject_refined = f"ProfileDash: Refined Profile for {company_name} is Ready"
@@ -400,7 +750,7 @@ def run_refinement_stage(
             attachment_object_refined = Attachment(FileContent(encoded_content), FileName(attachment_filename), FileType('text/html'), Disposition('attachment'))
             status_string = "completed successfully"
             if section_processing_error_refinement: status_string = "completed, but some sections may have refinement errors"
-            email_html_content_refined = f"""<p>The <strong>refined</strong> ProfileDash profile generation for <strong>{company_name}</strong> {status_string}.</p><p>The refined profile (which includes fact-checking and insight enhancement) is attached to this email.</p>{'<p><i>Note: Some sections might contain errors if the refinement process encountered issues.</i></p>' if section_processing_error_refinement else ''}<p>(Run ID: {run_id})</p><hr><p style='font-size:small; color:grey;'>ProfileDash {app_version}</p>"""
+            email_html_content_refined = f"""<p>The <strong>refined</strong> ProfileDash profile generation for <strong>{company_name}</strong> {status_string}.</p><p>The refined profile (which includes fact-checking and insight enhancement) is attached to this email.</p>{'<p><i>Note: Some sections might contain errors if the refinement process encountered issues.</i></p>' if section_processing_error_refinement else ''}{degradation_note}<p>(Run ID: {run_id})</p><hr><p style='font-size:small; color:grey;'>ProfileDash {app_version}</p>"""
         except Exception as attach_prep_e:
             _log_refinement(f"ERROR preparing refined Base64 attachment: {attach_prep_e}."); traceback.print_exc()
             email_subject_refined = f"ProfileDash: Refined Profile Generation Complete (Attachment Error) for {company_name}"
@@ -408,7 +758,7 @@ def run_refinement_stage(
             attachment_object_refined = None
     elif section_processing_error_refinement:
         email_subject_refined = f"ProfileDash: Refined Profile Generation Completed (with errors) for {company_name}"
-        email_html_content_refined = f"""<p>The refined ProfileDash profile generation for <strong>{company_name}</strong> completed with some errors during the refinement or saving stage.</p><p>An attempt was made to attach the refined profile, but it may be incomplete or contain errors.</p><p>The initial profile was sent previously. Please check the logs or saved files if needed.</p><p>(Run ID: {run_id})</p><hr><p style='font-size:small; color:grey;'>ProfileDash {app_version}</p>"""
+        email_html_content_refined = f"""<p>The refined ProfileDash profile generation for <strong>{company_name}</strong> completed with some errors during the refinement or saving stage.</p><p>An attempt was made to attach the refined profile, but it may be incomplete or contain errors.</p><p>The initial profile was sent previously. Please check the logs or saved files if needed.</p>{degradation_note}<p>(Run ID: {run_id})</p><hr><p style='font-size:small; color:grey;'>ProfileDash {app_version}</p>"""
         if final_refined_html:
              try:
                  encoded_content = base64.b64encode(final_refined_html.encode('utf-8')).decode('ascii')
@@ -441,9 +791,162 @@ def run_refinement_stage(
     _log_refinement(f"Refinement Stage finished in {refinement_duration / 60:.1f} minutes.")
     final_status = "Success" if final_profile_saved_to_dataset else "CompletedWithErrors" if section_processing_error_refinement else "Failed"
     log_event = {"event": "RefinementStageCompleted", "runId": run_id, "status": final_status, "durationSeconds": int(refinement_duration)}
+    if degraded_sections: log_event["deadlineDegradation"] = degradation
+    metrics = refinement_state.get("metrics")
+    if metrics:
+        _log_refinement(f"Refinement metrics: {metrics['critiques']} critiques ({metrics['cleanVerdicts']} clean), {metrics['improvementCalls']} improvement calls, "
+                        f"{metrics['improvementsSkipped']} skipped (~{metrics['inputTokensSaved']:,} input / ~{metrics['outputTokensSaved']:,} output tokens saved)"
+                        + (f"; {metrics['documentFreeCritiques']} insight critiques without documents (~{metrics['critiqueTokensSaved']:,} input tokens saved)" if metrics.get("documentFreeCritiques") else "")
+                        + (f"; {metrics['patchesApplied']} improvements applied as patches, {metrics['patchFallbacks']} fell back to a full rewrite" if metrics.get("patchesApplied") or metrics.get("patchFallbacks") else "")
+                        + (f"; profile review: {metrics['consistencyReviews']} calls, {metrics['consistencyIssues']} issues" if metrics.get("consistencyReviews") else "")
+                        + (f"; quality gate: {metrics['sectionsGated']} sections not refined, ~{metrics['gateCallsSaved']} calls saved" if metrics.get("sectionsGated") else "")
+                        + (f"; retry: {metrics['refinementRetriesRecovered']} of {metrics['refinementRetries']} failed sections recovered." if metrics.get("refinementRetries") else "."))
+        log_event["metrics"] = metrics
     save_log_entry_hf_dataset(user_email=user_email, event_data=log_event, api=hf_api_client, HF_TOKEN=hf_token, DATASET_REPO_ID=dataset_repo_id)
 
 
+def run_refinement_stage(
+    # --- Context Passed from Initial Workflow ---
+    run_id: str,
+    user_email: str,
+    api_key: str,
+    company_name: str,
+    initial_results: dict,
+    documents_for_api: list,
+    append_log_func, # Callback for logging
+    # --- Clients & Config Passed In ---
+    sg_client,
+    hf_api_client,
+    hf_token: str,
+    dataset_repo_id: str,
+    sender_email: str,
+    app_version: str,
+    max_workers: int,
+    section_documents: dict = None, # Per-section context overriding documents_for_api (map-reduce mode)
+    refine_below: float = None,
+    refine_bottom_n: int = None
+    ):
+    """
+    Refines an already generated set of sections IN PARALLEL, then aggregates and
+    emails the refined profile. (The main workflow pipelines refinement with the
+    initial generation instead; this is the stand-alone entry point.)
+    refine_below / refine_bottom_n (defaults PROFILEDASH_REFINEMENT_GATE_SCORE / _BOTTOM_N, 0 = off)
+    limit refinement to the sections with the lowest quality scores.
+    """
+    def _log_refinement(message):
+        append_log_func(f"[Refinement Stage] {message}") # Use the passed logger
+
+    _log_refinement("Starting Refinement Stage...")
+    refinement_start_time = time.time()
+
+    # --- Configure Google AI SDK ---
+    try:
+        genai.configure(api_key=api_key)
+        _log_refinement("Google AI SDK configured for refinement.")
+    except Exception as config_e:
+        error_msg = f"CRITICAL ERROR configuring Google AI SDK for refinement: {type(config_e).__name__} - {str(config_e)}"
+        _log_refinement(error_msg)
+        log_event = {"event": "RefinementStageFailed", "runId": run_id, "status": "Error", "error": error_msg, "stage": "GenAI Config"}
+        save_log_entry_hf_dataset(user_email=user_email, event_data=log_event, api=hf_api_client, HF_TOKEN=hf_token, DATASET_REPO_ID=dataset_repo_id)
+        return
+
+    refinement_state = {"results": {}, "error": False, "processed": 0, "total": len(sections), "metrics": new_refinement_metrics(), **({"retry_queue": {}} if RETRY_FAILED_SECTIONS else {})}
+    gate_threshold = REFINEMENT_GATE_SCORE if refine_below is None else refine_below
+    gate_bottom_n = REFINEMENT_GATE_BOTTOM_N if refine_bottom_n is None else refine_bottom_n
+    quality_scores = {section_def["number"]: score_section_html(section_def, str(initial_results[section_def["number"]]), typical_section_length(section_def["number"]))["score"]
+                      for section_def in sections if initial_results.get(section_def["number"]) and '<p class="error">' not in str(initial_results[section_def["number"]])}
+    scheduler = TaskScheduler(max_workers, log_func=_log_refinement, name="Refinement Scheduler")
+    for section_def in sorted(sections, key=lambda x: x["number"]):
+        section_num = section_def["number"]
+        queue_section_refinement(
+            scheduler, section_def, initial_results.get(section_num),
+            section_documents.get(section_num, documents_for_api) if section_documents else documents_for_api,
+            refinement_state, run_id, user_email, company_name, hf_api_client, hf_token, dataset_repo_id, append_log_func,
+            gate_reason=quality_gate_reason(section_num, quality_scores, gate_threshold, gate_bottom_n) if gate_threshold or gate_bottom_n else None
+        )
+    _log_refinement(f"Starting parallel refinement with {max_workers} workers...")
+    scheduler.run()
+    retry_failed_refinements(scheduler, refinement_state, run_id, user_email, company_name, hf_api_client, hf_token, dataset_repo_id, append_log_func)
+
+    finalize_refinement_stage(
+        run_id, user_email, company_name, refinement_state, refinement_start_time, append_log_func,
+        sg_client, hf_api_client, hf_token, dataset_repo_id, sender_email, app_version
+    )
+
+
+def send_initial_notification(
+    run_id: str,
+    user_email: str,
+    company_name: str,
+    initial_final_html: str,
+    initial_profile_repo_path: str,
+    initial_profile_saved_to_dataset: bool,
+    initial_section_processing_error: bool,
+    initial_error_message_for_email: str,
+    append_log_func,
+    sg_client,
+    hf_api_client,
+    hf_token: str,
+    dataset_repo_id: str,
+    sender_email: str,
+    app_version: str
+    ):
+    """Emails the initial profile (or the critical failure) and logs the initial run outcome."""
+    append_log_func("Preparing INITIAL email notification...")
+    # (Initial email composition and sending logic - same as previous version)
+    email_subject_initial = ""; email_html_content_initial = ""; attachment_object_initial = None
+    initial_generation_succeeded_fully = not initial_error_message_for_email and initial_profile_saved_to_dataset
+    initial_generation_completed_with_errors = (initial_section_processing_error or not initial_profile_saved_to_dataset) and not initial_error_message_for_email
+
+    if initial_generation_succeeded_fully or initial_generation_completed_with_errors:
+        status_string = "completed successfully" if initial_generation_succeeded_fully else "completed with some errors"
+        email_subject_initial = f"ProfileDash: Initial Profile for {company_name} is Ready"
+        if initial_generation_completed_with_errors: email_subject_initial = f"ProfileDash: Initial Profile for {company_name} Completed (with errors)"
+        if initial_final_html and initial_profile_repo_path:
+            try: # Try attach
+                encoded_content = base64.b64encode(initial_final_html.encode('utf-8')).decode('ascii')
+                attachment_filename = os.path.basename(initial_profile_repo_path);
+                if not attachment_filename.lower().endswith('.html'): attachment_filename += ".html"
+                attachment_object_initial = Attachment(FileContent(encoded_content), FileName(attachment_filename), FileType('text/html'), Disposition('attachment'))
+                email_html_content_initial = f"""<p>Your <strong>initial</strong> ProfileDash profile generation for <strong>{company_name}</strong> {status_string}.</p><p>The initially generated profile is attached.</p>{'<p><i>Note: Some sections might contain errors.</i></p>' if initial_generation_completed_with_errors else ''}<p>A refined version is being generated and will be sent separately (approx. 30-60 mins).</p><p>(Run ID: {run_id})</p><hr><p style='font-size:small; color:grey;'>ProfileDash {app_version}</p>""" # Adjusted time estimate
+            except Exception as attach_prep_e:
+                 append_log_func(f"ERROR preparing initial Base64 attachment: {attach_prep_e}.")
+                 attachment_object_initial = None
+                 email_html_content_initial = f"""<p>Your <strong>initial</strong> ProfileDash profile generation for <strong>{company_name}</strong> {status_string}, but attachment failed.</p><p>A refined version is being generated and will be sent separately (approx. 30-60 mins).</p><p>(Run ID: {run_id})</p><hr><p style='font-size:small; color:grey;'>ProfileDash {app_version}</p>""" # Adjusted time estimate
+        else:
+            email_html_content_initial = f"""<p>Your <strong>initial</strong> ProfileDash profile generation for <strong>{company_name}</strong> {status_string}, but the final profile could not be generated/saved for attachment.</p><p>A refined version is being generated and will be sent separately (approx. 30-60 mins).</p><p>(Run ID: {run_id})</p><hr><p style='font-size:small; color:grey;'>ProfileDash {app_version}</p>""" # Adjusted time estimate
+        log_event_status = "Success" if initial_generation_succeeded_fully else "CompletedWithErrors"
+        try: # Log completion
+            log_event = {"event": "RunCompleted", "runId": run_id, "status": log_event_status, "stage": "Initial", "finalProfileSaved": initial_profile_saved_to_dataset, "sectionProcessingErrorEncountered": initial_section_processing_error}
+            save_log_entry_hf_dataset(user_email=user_email, event_data=log_event, api=hf_api_client, HF_TOKEN=hf_token, DATASET_REPO_ID=dataset_repo_id)
+        except Exception as log_complete_e: print(f"Error logging RunCompleted ({log_event_status}) initial: {log_complete_e}")
+    else: # Failed critically
+        email_subject_initial = f"ProfileDash: Profile Generation Failed for {company_name}"
+        error_details = initial_error_message_for_email if initial_error_message_for_email else 'An unspecified critical error occurred during initial generation.'
+        email_html_content_initial = f"""<p>Unfortunately, the initial ProfileDash profile generation for <strong>{company_name}</strong> failed critically.</p><p>Error details: {error_details}</p><p>No initial profile could be generated. Refinement stage will not run.</p><p>(Run ID: {run_id})</p><hr><p style='font-size:small; color:grey;'>ProfileDash {app_version}</p>"""
+
+    # Send Initial Email
+    if sg_client:
+        try:
+            message = Mail(from_email=Email(sender_email, "ProfileDash Notification (Initial)"), to_emails=To(user_email), subject=email_subject_initial, html_content=Content("text/html", email_html_content_initial))
+            if attachment_object_initial: message.attachment = attachment_object_initial; append_log_func("Initial Attachment added to email message.")
+            response = sg_client.client.mail.send.post(request_body=message.get())
+            email_log_status_initial = "Success" if 200 <= response.status_code < 300 else "Failure"
+            append_log_func(f"Initial notification email send status: {email_log_status_initial}")
+            try: # Log email send attempt
+                log_event = {"event": "InitialNotificationEmailSent", "runId": run_id, "status": email_log_status_initial}
+                if email_log_status_initial == "Failure": log_event["sendgridResponseStatus"] = response.status_code; log_event["sendgridResponseBody"] = str(response.body)[:1000]
+                save_log_entry_hf_dataset(user_email=user_email, event_data=log_event, api=hf_api_client, HF_TOKEN=hf_token, DATASET_REPO_ID=dataset_repo_id)
+            except Exception as log_email_e: print(f"Error logging InitialNotificationEmailSent status: {log_email_e}")
+        except Exception as email_ex:
+             append_log_func(f"Exception sending initial notification email: {email_ex}"); traceback.print_exc()
+             try: # Log email exception
+                 log_event = {"event": "InitialNotificationEmailSent", "runId": run_id, "status": "Exception", "error": str(email_ex)}
+                 save_log_entry_hf_dataset(user_email=user_email, event_data=log_event, api=hf_api_client, HF_TOKEN=hf_token, DATASET_REPO_ID=dataset_repo_id)
+             except Exception as log_email_e: print(f"Error logging Initial EmailSent exception: {log_email_e}")
+    else: append_log_func("SendGrid client not available. Cannot send initial email notification.")
+
+
 # --- Main Background Workflow Function ---
 # This is the function that app.py will import and run in a thread
 
@@ -461,11 +964,38 @@ def execute_full_profile_workflow(
     sender_email: str,
     app_version: str,
     max_workers: int,
-    max_upload_bytes: int
+    max_upload_bytes: int,
+    progress_func=None,
+    output_dir=None,
+    section_numbers=None,
+    base_run_id=None,
+    force_regenerate=False,
+    sla_minutes=None,
+    refinement_mode=None,
+    refine_below=None,
+    refine_bottom_n=None
     ):
     """
-    Performs the initial profile generation, emails result, THEN triggers refinement stage.
-    This is the main entry point called by app.py's thread.
+    Performs the profile generation as a per-section pipeline: every section is refined
+    as soon as its own initial content is ready, the initial profile is emailed once the
+    last initial section is done, and the refined profile once every section is refined.
+    This is the main entry point run by app.py's job queue or a worker process (src/worker.py).
+    progress_func(message), if given, receives every log line (queue progress reporting).
+    output_dir, if given, receives initial_profile.html and refined_profile.html (batch runs).
+    section_numbers, if given, limits the run to those sections plus the sections they build on;
+    a regeneration run (see run_store.create_regeneration_checkpoint) restores all other sections.
+    base_run_id, if given, makes this a delta run: documents are diffed with that finished run by
+    content hash and only sections fed by added or removed documents are regenerated.
+    Unless force_regenerate is set, a run over documents already profiled with the same prompts
+    and model configuration restores every section from the run cache (see run_cache.py).
+    sla_minutes (default PROFILEDASH_RUN_SLA_MINUTES; 0 = none) is the run's time budget: once it
+    runs short, refinement degrades step by step (see run_deadline.py) instead of running late.
+    refinement_mode ('sequential', 'merged' or 'profile', default PROFILEDASH_REFINEMENT_MODE) picks the refinement chain.
+    refine_below / refine_bottom_n (defaults PROFILEDASH_REFINEMENT_GATE_SCORE / _BOTTOM_N, 0 = off) limit
+    refinement to sections whose local quality score is below the threshold or among the N lowest.
+    Failed sections get a second chance (RETRY_FAILED_SECTIONS): failed initial sections are generated
+    again before the initial profile is published, failed refinements after the pipeline.
+    Dataset uploads are skipped when hf_api_client is None, emails when sg_client is None.
     """
     start_run_time = time.time()
     print(f"BG Processor: Run {run_id}: Started for {user_email}")
@@ -482,6 +1012,9 @@ def execute_full_profile_workflow(
         timestamped_message = f"{get_run_elapsed()} {message}"
         background_log_internal.insert(0, timestamped_message)
         print(f"BG Processor: Run {run_id}: {timestamped_message}")
+        if progress_func:
+            try: progress_func(timestamped_message)
+            except Exception as progress_e: print(f"BG Processor: Run {run_id}: Error reporting progress: {progress_e}")
     # --- End of Local Helper ---
 
     # Initialize status flags and variables
@@ -492,7 +1025,40 @@ def execute_full_profile_workflow(
     company_name = "Unknown_Company"
     initial_final_html = ""
     documents_for_api = []
+    document_entries = {}
     initial_results = {}
+    cache_key = None
+    use_map_reduce = False
+    initial_email_sent = False
+    pipeline_completed = False
+    refinement_state = None
+    refinement_start_time = None
+    deadline = None
+    # Checkpoint every completed step so the run can resume after a process restart
+    checkpoint = RunCheckpoint(run_id); checkpoint.begin(user_email, app_version)
+    regeneration = checkpoint.meta.get("regeneration")
+    if regeneration: append_bg_log(f"Regeneration of run {regeneration['parentRunId']} ({regeneration['mode']}): sections {regeneration['sections']}; {len(checkpoint.meta['sections'])} sections restored from its checkpoint.")
+    elif checkpoint.resuming: append_bg_log(f"Resuming run from checkpoint: {len(checkpoint.meta['sections'])} sections have completed steps.")
+    if section_numbers: checkpoint.update(sectionNumbers=sorted(section_numbers))
+    if base_run_id: checkpoint.update(delta={"baseRunId": base_run_id})
+    if force_regenerate: checkpoint.update(forceRegenerate=True)
+    if "refinementMode" not in checkpoint.meta: # a resumed run keeps its refinement mode (checkpointed steps differ)
+        checkpoint.update(refinementMode=refinement_mode if refinement_mode in REFINEMENT_MODES else REFINEMENT_MODE)
+    if "qualityGate" not in checkpoint.meta: # a resumed run keeps its refinement gate
+        gate_threshold = REFINEMENT_GATE_SCORE if refine_below is None else refine_below
+        gate_bottom_n = REFINEMENT_GATE_BOTTOM_N if refine_bottom_n is None else refine_bottom_n
+        checkpoint.update(qualityGate={"threshold": gate_threshold, "bottomN": gate_bottom_n} if gate_threshold or gate_bottom_n else None)
+    if "sla" not in checkpoint.meta: # a resumed run keeps its original deadline
+        sla_minutes = RUN_SLA_MINUTES if sla_minutes is None else sla_minutes
+        checkpoint.update(sla={"minutes": sla_minutes, "deadlineAt": start_run_time + sla_minutes * 60} if sla_minutes and sla_minutes > 0 else None)
+    delta = checkpoint.meta.get("delta")
+    base_meta = load_run_meta(delta["baseRunId"]) if delta else None
+    if delta and (base_meta is None or base_meta.get("status") in UNFINISHED_STATUSES or base_meta.get("userEmail") != user_email):
+        append_bg_log(f"Delta run: base run {delta['baseRunId']} is unknown, unfinished or not yours. Generating every section."); base_meta = None
+    if base_meta and not section_numbers and base_meta.get("sectionNumbers") and not checkpoint.meta.get("sectionNumbers"): checkpoint.update(sectionNumbers=base_meta["sectionNumbers"])
+    run_sections = select_sections(sections, checkpoint.meta.get("sectionNumbers")) # the requested sections plus the ones they build on
+    if len(run_sections) < len(sections): append_bg_log(f"Partial run: {len(run_sections)} of {len(sections)} sections ({', '.join(str(section['number']) for section in run_sections)}).")
+    initial_email_sent = checkpoint.meta.get("initialEmailSent", False)
 
     try:
         # --- 1. Configure Google AI ---
@@ -506,72 +1072,425 @@ def execute_full_profile_workflow(
         append_bg_log("Processing uploaded documents...")
         if not temp_file_paths: raise ValueError("No file paths provided.")
         if not isinstance(temp_file_paths, list): temp_file_paths = [temp_file_paths]
-        uploaded_data = {}; total_size = 0; valid_files_count = 0
-        for file_path in temp_file_paths:
-            if file_path is None: continue
-            filename = os.path.basename(file_path)
-            try:
-                if not os.path.exists(file_path): continue
-                if not filename.lower().endswith(".pdf"): continue
-                file_size = os.path.getsize(file_path);
-                if file_size == 0: continue
-                total_size += file_size
-                with open(file_path, 'rb') as f: uploaded_data[filename] = f.read()
-                valid_files_count += 1; append_bg_log(f"Read: {filename} ({file_size // 1024} KB)")
-            except Exception as read_err: append_bg_log(f"Error reading '{filename}': {read_err}"); continue
+        def log_ingested(result):
+            for warning in result["warnings"]: append_bg_log(f"Validation warning for '{result['filename']}': {warning}")
+            if not result["ok"]: append_bg_log(f"Skipping '{result['filename']}': {result['error']}"); return
+            append_bg_log(f"Ingested: {result['filename']} ({result['size'] // 1024} KB, {result['entry'].get('page_count')} pages, type: {result['entry'].get('document_type')}, store {'hit' if result['store_hit'] else 'miss'}) in {result['duration_s']:.1f}s")
+        candidate_paths = [p for p in temp_file_paths if p is not None and os.path.exists(p) and p.lower().endswith(".pdf") and os.path.getsize(p) > 0]
+        append_bg_log(f"Ingesting {len(candidate_paths)} files in parallel (validate, hash, extract, encode)...")
+        ingested = [r for r in ingest_documents(candidate_paths, on_document_ready=log_ingested) if r["ok"]]
+        uploaded_data = {r["filename"]: r["content"] for r in ingested}
+        ingested_content = dict(uploaded_data)
+        document_entries = {r["filename"]: r["entry"] for r in ingested}
+        encoded_documents = {r["filename"]: r["document"] for r in ingested}
+        total_size = sum(r["size"] for r in ingested)
         if not uploaded_data: raise ValueError("No valid PDF files processed.")
-        if total_size > max_upload_bytes: raise ValueError(f"Upload failed: Size ({total_size / (1024*1024):.2f} MB) exceeds {max_upload_bytes / (1024*1024):.0f} MB.")
-        append_bg_log(f"Encoding {valid_files_count} files for API (base64)...")
-        documents_for_api = load_document_content(uploaded_data)
-        if not documents_for_api: raise ValueError("Failed to process documents (base64).")
+        dedup_report = {}
+        if PAGE_DEDUP_ENABLED and len(uploaded_data) > 1:
+            append_bg_log("Fingerprinting pages to drop near-duplicates across documents...")
+            try:
+                uploaded_data, dedup_report = deduplicate_uploaded_documents(uploaded_data, document_entries)
+                for line in format_dedup_report(dedup_report): append_bg_log(line)
+                total_size = sum(len(content) for content in uploaded_data.values())
+                log_event = {"event": "PageDedupReport", "runId": run_id, **dedup_report}
+                save_log_entry_hf_dataset(user_email=user_email, event_data=log_event, api=hf_api_client, HF_TOKEN=hf_token, DATASET_REPO_ID=dataset_repo_id)
+            except Exception as dedup_e: append_bg_log(f"Non-critical error during page dedup, using full documents: {dedup_e}"); traceback.print_exc()
+        rewritten = {name: content for name, content in uploaded_data.items() if content is not ingested_content[name]}
+        for name, content in rewritten.items(): # page texts and token counts must match the reduced files (map-reduce chunks, digest)
+            reduced_analysis = analyze_pdf_document(name, content); reduced_analysis.pop("document_type", None)
+            document_entries[name] = {**document_entries[name], **reduced_analysis}
+        total_tokens = sum((document_entries.get(name) or {}).get("token_counts", {}).get("pdf_tokens_estimate", 0) for name in uploaded_data)
+        use_map_reduce = needs_map_reduce(total_size, total_tokens, max_upload_bytes)
+        if use_map_reduce and (not map_reduce_available() or total_size > MAP_REDUCE_MAX_TOTAL_BYTES):
+            size_limit = max_upload_bytes if not map_reduce_available() else MAP_REDUCE_MAX_TOTAL_BYTES
+            raise ValueError(f"Upload failed: Size ({total_size / (1024*1024):.2f} MB, ~{total_tokens:,} tokens) exceeds {size_limit / (1024*1024):.0f} MB or the model context.")
+        if use_map_reduce:
+            append_bg_log(f"Document set ({total_size / (1024*1024):.1f} MB, ~{total_tokens:,} tokens) exceeds a single call. Using map-reduce mode...")
+            document_chunks = split_documents_into_chunks(uploaded_data, document_entries, int(max_upload_bytes * 0.9))
+            if not document_chunks: raise ValueError("Failed to split documents into chunks for map-reduce mode.")
+            append_bg_log(f"Split documents into {len(document_chunks)} page-range chunks.")
+        else:
+            # Files were encoded during ingestion; only those rewritten by page dedup need re-encoding
+            if rewritten:
+                append_bg_log(f"Re-encoding {len(rewritten)} deduplicated files for API (base64)...")
+                encoded_documents.update({name: encode_document_part(content) for name, content in rewritten.items()})
+            documents_for_api = [encoded_documents[name] for name in uploaded_data]
+            if not documents_for_api: raise ValueError("Failed to process documents (base64).")
         first_filename = next(iter(uploaded_data.keys())); company_name = os.path.splitext(first_filename)[0].replace('_', ' ')
         append_bg_log(f"Company: {company_name}. Starting parallel generation...")
-
-
-        # --- 3. Generate Sections in Parallel (Initial Pass) ---
+        checkpoint.update(companyName=company_name, documents=[{"filename": r["filename"], "sha256": r["entry"]["sha256"], "documentType": r["entry"].get("document_type")} for r in ingested])
+        # Whole-run cache, for runs that generate every section from exactly these documents
+        if RUN_CACHE_ENABLED and not delta and not regeneration:
+            cache_key = run_cache_key([document["sha256"] for document in checkpoint.meta["documents"]], checkpoint.meta.get("sectionNumbers"), max_upload_bytes,
+                                      {"mode": checkpoint.meta["refinementMode"], "improvementOutput": IMPROVEMENT_OUTPUT, "insightCritiqueContext": INSIGHT_CRITIQUE_CONTEXT})
+            cached_run = load_cached_run(cache_key) if not checkpoint.meta.get("forceRegenerate") and not checkpoint.resuming else None
+            if cached_run:
+                restored_count = len(checkpoint.adopt_sections(cached_run, source_dir=cache_entry_dir(cache_key)))
+                checkpoint.update(runCache={"key": cache_key, "hit": True, "sourceRunId": cached_run.get("runId")})
+                append_bg_log(f"Run cache hit ({cache_key[:12]}, prompt version {cached_run['promptVersion']}, from run {cached_run.get('runId')}): restored {restored_count} sections. Rebuilding the profiles without API calls.")
+            elif checkpoint.meta.get("forceRegenerate"): append_bg_log("Force regenerate: run cache lookup skipped.")
+        if base_meta and "affectedSections" not in delta: # delta run: carry over the sections the document changes do not touch
+            added, removed = diff_documents(base_meta.get("documents", []), checkpoint.meta["documents"])
+            affected = affected_sections(run_sections, {document["documentType"] for document in added + removed}, document_type_sections)
+            redo = sorted(set(affected) | set(unfinished_sections(base_meta)))
+            carried = checkpoint.adopt_sections(base_meta, redo)
+            delta = {**delta, "added": [document["filename"] for document in added], "removed": [document["filename"] for document in removed], "affectedSections": affected, "carriedOver": len(carried)}
+            checkpoint.update(delta=delta)
+            append_bg_log(f"Delta run against {delta['baseRunId']}: added {delta['added'] or 'none'}, removed {delta['removed'] or 'none'}. Regenerating {len(redo)} sections {redo}; {len(carried)} carried over.")
+
+
+        # --- 3. Pipeline: each section runs initial generation -> fact critique -> fact improve ->
+        #        insight critique -> insight improve as soon as its own previous step is done ---
         append_bg_log(f"Creating Gemini model instance...")
         insight_model = create_insight_model()
         if not insight_model: raise RuntimeError("Failed to create insight model.")
-        append_bg_log(f"Model instance created. Submitting initial tasks with {max_workers} workers...")
-        total_sections = len(sections); completed_sections_count = 0
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            future_to_section = { executor.submit(generate_initial_section, section, documents_for_api, persona, analysis_specs, output_format, insight_model): section for section in sections }
-            append_bg_log(f"Initial tasks submitted. Waiting for completion...")
-            for future in as_completed(future_to_section):
-                section_def = future_to_section[future]; section_num = section_def["number"]; section_title = section_def["title"]
-                s_num_result, content_result = section_num, None
+        append_bg_log(f"Model instance created. Scheduling section pipeline with {max_workers} workers...")
+        total_sections = len(run_sections); completed_sections_count = 0
+        scheduler = TaskScheduler(max_workers, log_func=append_bg_log, name="Pipeline")
+        refinement_state = {"results": {}, "error": False, "processed": 0, "total": total_sections, "metrics": new_refinement_metrics(), "document_tokens": total_tokens,
+                            "document_digest": build_document_digest(document_entries) if INSIGHT_CRITIQUE_CONTEXT == "digest" else None, **({"retry_queue": {}} if RETRY_FAILED_SECTIONS else {})}
+        latency_estimator = LatencyEstimator(MODEL_NAME, total_tokens, {"merged": MERGED_SECTION_CHAIN, "profile": PROFILE_SECTION_CHAIN}.get(checkpoint.meta["refinementMode"], SECTION_CHAIN))
+        if checkpoint.meta.get("sla"):
+            deadline = RunDeadline(checkpoint.meta["sla"]["deadlineAt"], checkpoint.meta["sla"]["minutes"], latency_estimator, (checkpoint.meta.get("degradation") or {}).get("sections"))
+            append_bg_log(f"Run deadline: {checkpoint.meta['sla']['minutes']:g} min budget, {max(0.0, deadline.remaining()) / 60:.1f} min left. Refinement degrades if it runs short.")
+        try: # Synthesis sections build on earlier sections ('depends_on' in section_definitions.py)
+            validate_section_dag(run_sections); section_dag_ok = True
+        except ValueError as dag_e:
+            append_bg_log(f"Warning: Invalid section dependencies ({dag_e}). Generating every section from the documents."); section_dag_ok = False
+        def upstream_of(section_def): return section_dependencies(section_def) if section_dag_ok else []
+        # In map-reduce mode only document-free dependants skip the chunked path
+        def from_upstream(section_def): return bool(upstream_of(section_def)) and (not use_map_reduce or not uses_documents(section_def))
+        section_by_num = {section["number"]: section for section in run_sections}
+        def initial_key(section_num): return ("reduce", section_num) if use_map_reduce and not from_upstream(section_by_num[section_num]) else ("initial", section_num)
+        downstream = downstream_sections(run_sections) if section_dag_ok else {}
+        section_refinement_documents = {}
+        restored_initial = {} # section number -> (html, extraction notes) checkpointed by an earlier attempt of this run
+        deferred_refinement = {} # 'profile' mode or bottom-N gate: section number -> (section_def, initial html, refinement documents)
+        quality_gate = checkpoint.meta.get("qualityGate")
+        quality_scores = {} # section number -> local quality score of its initial content
+        generated_initial = {} # section number -> initial HTML generated (not restored) in this attempt, for the length history
+        failed_initial = {} # section number -> section_def whose initial generation failed, retried once every initial section is done
+        # Refinement waits for every initial section when it needs the whole profile (review or bottom-N ranking)
+        defer_refinement = checkpoint.meta["refinementMode"] == "profile" or bool(quality_gate and quality_gate.get("bottomN"))
+        for section in run_sections:
+            if not checkpoint.section_progress(section["number"]): continue
+            restored_html, _, restored_notes = checkpoint.load_step(section["number"], "initial")
+            if restored_html and (restored_notes or not initial_key(section["number"])[0] == "reduce"): restored_initial[section["number"]] = (restored_html, restored_notes)
+        if restored_initial: append_bg_log(f"Restored initial content of {len(restored_initial)} sections from the checkpoint.")
+        dependent_sections = [section for section in run_sections if from_upstream(section)]
+        if dependent_sections:
+            document_free = [section for section in dependent_sections if use_map_reduce or not uses_documents(section)]
+            append_bg_log(f"Section DAG: {len(dependent_sections)} sections build on earlier sections ({len(document_free)} without the document payload, ~{len(document_free) * 5 * total_tokens:,} input tokens saved if upstream succeeds).")
+
+        def section_priority(section_def, kind):
+            """Expected seconds left in this section's chain, scaled by how slow its steps were so far this run."""
+            section_num = section_def["number"]
+            actual = expected = 0.0
+            for key, seconds in list(scheduler.durations.items()):
+                if key[1:2] != (section_num,) or key[0] not in ("initial", "reduce", "refine") or seconds < MIN_RECORDED_LATENCY_SECONDS: continue
+                actual += seconds; expected += latency_estimator.expected(key[2] if key[0] == "refine" else key[0], section_def)
+            observed_ratio = min(3.0, max(0.5, actual / expected)) if expected else 1.0
+            remaining = latency_estimator.remaining(section_def, kind, observed_ratio)
+            if kind in ("initial", "map", "reduce"): # dependants wait for this section's initial content
+                remaining += max((section_priority(dependent, "initial") for dependent in downstream.get(section_num, [])), default=0.0)
+            return remaining
+        def initial_priority(section_def, kind): return INITIAL_GENERATION_PRIORITY + section_priority(section_def, kind)
+        def reprioritize_section(finished_key):
+            """A section's task finished: re-score its still-queued tasks (e.g. its other map chunks) with how slow it has been so far."""
+            section_def = section_by_num.get(finished_key[1]) if finished_key[0] in ("initial", "map", "reduce", "refine") else None
+            if section_def is None: return
+            for key in scheduler.queued_keys(lambda key: key[0] in ("initial", "map", "reduce", "refine") and key[1:2] == (section_def["number"],)):
+                scheduler.set_priority(key, section_priority(section_def, key[2]) if key[0] == "refine" else initial_priority(section_def, key[0]))
+        scheduler.on_task_complete = reprioritize_section
+        def first_kind(section_def): return "map" if initial_key(section_def["number"])[0] == "reduce" else "initial"
+        longest_first = sorted(run_sections, key=lambda section: -section_priority(section, first_kind(section)))
+        append_bg_log("Longest expected section chains first: " + ", ".join(f"S{section['number']} (~{section_priority(section, first_kind(section)):.0f}s)" for section in longest_first[:5]) + f" [history bucket: {latency_estimator.bucket}]")
+
+        def generate_from_upstream(section_def, model=None):
+            """Initial generation of a dependent section once its upstream sections are done."""
+            section_num = section_def["number"]
+            upstream_context, missing = build_upstream_context(section_def, initial_results, run_sections)
+            documents = [] if use_map_reduce or not uses_documents(section_def) else documents_for_api
+            if missing:
+                append_bg_log(f"S{section_num}: Upstream sections {missing} failed or are missing." + (" Attaching the documents instead." if not use_map_reduce else ""))
+                if not use_map_reduce: documents = documents_for_api
+            # Refinement critiques against the same sources the section was written from
+            section_refinement_documents[section_num] = documents + ([f"EARLIER PROFILE SECTIONS (compiled from the provided documents):\n{upstream_context}"] if upstream_context else [])
+            return generate_initial_section(section_def, documents, persona, analysis_specs, output_format, model or insight_model, upstream_context=upstream_context)
+
+        # Closely related sections ('batch' in section_definitions.py) share one generation call.
+        # In map-reduce mode only document-free dependants can be batched (no inline documents).
+        batches = section_batches(run_sections, eligible=lambda section: (not use_map_reduce or from_upstream(section)) and section["number"] not in restored_initial)
+        batch_of = {member["number"]: batch_name for batch_name, members in batches.items() for member in members}
+        if batches: append_bg_log(f"Section batching: {len(batch_of)} sections in {len(batches)} batched calls (" + "; ".join(f"{name}: S{members[0]['number']}-S{members[-1]['number']}" for name, members in batches.items()) + ").")
+
+        def generate_batch(members):
+            """One call for a batch; upstream sections inside the batch are written together instead."""
+            member_nums = {member["number"] for member in members}
+            upstream = sorted({num for member in members for num in upstream_of(member)} - member_nums)
+            upstream_context, missing = build_upstream_context({"number": 0, "depends_on": upstream}, initial_results, run_sections)
+            needs_documents = missing or any(not from_upstream(member) or uses_documents(member) for member in members)
+            documents = documents_for_api if needs_documents and not use_map_reduce else []
+            for member in members:
+                section_refinement_documents[member["number"]] = documents + ([f"EARLIER PROFILE SECTIONS (compiled from the provided documents):\n{upstream_context}"] if upstream_context else [])
+            return generate_section_batch(members, documents, persona, analysis_specs, output_format, insight_model, upstream_context=upstream_context)
+
+        def finish_batched_section(section_def):
+            """A batch member: take its HTML from the batch, or fall back to its own call if it is missing."""
+            section_num = section_def["number"]
+            batch_html = (scheduler.result(("batch", batch_of[section_num])) or {}).get(section_num)
+            if batch_html: return section_num, batch_html
+            append_bg_log(f"S{section_num}: Not usable from batch '{batch_of[section_num]}'. Falling back to a per-section call...")
+            if from_upstream(section_def): return generate_from_upstream(section_def)
+            section_refinement_documents.pop(section_num, None)
+            return generate_initial_section(section_def, documents_for_api, persona, analysis_specs, output_format, insight_model)
+
+        for batch_name, members in batches.items():
+            member_nums = {member["number"] for member in members}
+            batch_deps = sorted({initial_key(num) for member in members for num in upstream_of(member) if num not in member_nums})
+            scheduler.add_task(("batch", batch_name), generate_batch, members, deps=batch_deps,
+                               priority=max(initial_priority(member, "initial") for member in members))
+
+        def restore_initial_section(section_def):
+            """A section whose initial content was checkpointed: rebuild its refinement sources instead of regenerating it."""
+            section_num = section_def["number"]
+            restored_html, restored_notes = restored_initial[section_num]
+            if from_upstream(section_def):
+                upstream_context, missing = build_upstream_context(section_def, initial_results, run_sections)
+                documents = documents_for_api if not use_map_reduce and (missing or uses_documents(section_def)) else []
+                section_refinement_documents[section_num] = documents + ([f"EARLIER PROFILE SECTIONS (compiled from the provided documents):\n{upstream_context}"] if upstream_context else [])
+            elif use_map_reduce:
+                section_refinement_documents[section_num] = [f"SOURCE NOTES (extracted page by page from the provided documents):\n{restored_notes}"]
+            return section_num, restored_html
+
+        def queue_refinement(section_def, html, refinement_documents):
+            """Queue a section's refinement; the quality gate may ship it with its initial content instead."""
+            gate_reason = quality_gate_reason(section_def["number"], quality_scores, quality_gate["threshold"], quality_gate["bottomN"]) if quality_gate else None
+            queue_section_refinement(
+                scheduler, section_def, html, refinement_documents, refinement_state,
+                run_id, user_email, company_name, hf_api_client, hf_token, dataset_repo_id, append_bg_log,
+                priority_func=section_priority, checkpoint=checkpoint, deadline=deadline, mode=checkpoint.meta["refinementMode"], gate_reason=gate_reason
+            )
+
+        def queue_deferred_refinement():
+            for section_num, (section_def, html, refinement_documents) in sorted(deferred_refinement.items()):
+                queue_refinement(section_def, html, refinement_documents)
+
+        def record_initial_result(section_def, content_result, refinement_documents, extraction_notes=None, restored=False, retried=False):
+            nonlocal initial_section_processing_error, completed_sections_count
+            s_num_result = section_def["number"]; section_title = section_def["title"]
+            failed = not restored and (not content_result or '<p class="error">' in str(content_result))
+            # Map-reduce sections are not retried: their chunk calls already fall back on their own
+            retry_pending = failed and not retried and RETRY_FAILED_SECTIONS and initial_key(s_num_result)[0] == "initial"
+            if restored: append_bg_log(f"RESTORED: Section {s_num_result} ('{section_title}') initial content from checkpoint.")
+            elif failed:
+                append_bg_log(f"{'RETRY FAIL' if retried else 'PARTIAL FAIL'}: Section {s_num_result} ('{section_title}') initial generation reported error.")
+                if not retry_pending: initial_section_processing_error = True # a section awaiting its retry counts once the retry is done
+                if not content_result: content_result = f'<div class="section" id="section-{s_num_result}"><h2>{s_num_result}. {section_title}</h2><p class="error">ERROR: Generation function returned empty content.</p></div>'
+            else: append_bg_log(f"{'RETRY SUCCESS' if retried else 'SUCCESS'}: Section {s_num_result} ('{section_title}') initial generation."); checkpoint.save_step(s_num_result, "initial", str(content_result), notes=extraction_notes)
+            initial_results[s_num_result] = content_result
+            if retry_pending: failed_initial[s_num_result] = section_def
+            if not restored and not retry_pending and hf_api_client is not None: scheduler.add_task( # Save Initial Section
+                ("save_initial", s_num_result), save_section_hf_dataset, section_num=s_num_result, section_content=str(content_result), content_type="html",
+                run_id=run_id, company_name=company_name, user_email=user_email, api=hf_api_client, HF_TOKEN=hf_token, DATASET_REPO_ID=dataset_repo_id,
+                priority=SAVE_TASK_PRIORITY, on_complete=lambda key, result, error: error and append_bg_log(f"Non-critical error during initial save attempt for section {s_num_result}: {error}")
+            )
+            if not retried: completed_sections_count += 1; progress_percent = int((completed_sections_count / total_sections) * 100); append_bg_log(f"Initial Progress: {completed_sections_count}/{total_sections} ({progress_percent}%) sections processed.")
+            if retry_pending: return # refined (or shipped with the error) after the retry pass
+            if '<p class="error">' not in str(content_result):
+                quality_scores[s_num_result] = score_section_html(section_def, str(content_result), typical_section_length(s_num_result))["score"]
+                if not restored: generated_initial[s_num_result] = str(content_result)
+            if defer_refinement: # refined once every initial section is done (profile review / bottom-N ranking)
+                deferred_refinement[s_num_result] = (section_def, str(content_result), refinement_documents); return
+            # Refinement of this section starts right away instead of waiting for the slowest section
+            queue_refinement(section_def, str(content_result), refinement_documents)
+
+        if use_map_reduce:
+            def map_reduce_section_done(section_def, content_result, extraction_notes):
+                # Refinement of a map-reduce section critiques against its extraction notes, not the full documents
+                record_initial_result(section_def, content_result, [f"SOURCE NOTES (extracted page by page from the provided documents):\n{extraction_notes}"], extraction_notes=extraction_notes)
+            add_map_reduce_tasks(scheduler, [section for section in longest_first if not from_upstream(section) and section["number"] not in restored_initial], document_chunks, persona, analysis_specs, output_format, insight_model, map_reduce_section_done, priority_func=initial_priority, log_func=append_bg_log)
+        for section in longest_first:
+            if section["number"] in restored_initial: # keeps the initial task key, so dependants and the initial profile wait on it as usual
+                scheduler.add_task(initial_key(section["number"]), restore_initial_section, section, deps=[initial_key(upstream) for upstream in upstream_of(section)] if from_upstream(section) else [],
+                                   priority=initial_priority(section, "initial"), on_complete=lambda key, result, error, section_def=section: record_initial_result(section_def, result[1], section_refinement_documents.get(section_def["number"], documents_for_api), restored=True))
+                continue
+            if initial_key(section["number"])[0] == "reduce": continue # queued as map/reduce tasks above
+            def initial_section_done(key, result, error, section_def=section):
+                section_num = section_def["number"]; section_title = section_def["title"]
+                if error is not None:
+                    append_bg_log(f"FAIL: Section {section_num} ('{section_title}') initial generation hit exception - {type(error).__name__}: {error}")
+                    content_result = f'<div class="section" id="section-{section_num}"><h2>{section_num}. {section_title}</h2><p class="error">ERROR: Generation process failed unexpectedly: {error}</p></div>'
+                else:
+                    _, content_result = result
+                record_initial_result(section_def, content_result, section_refinement_documents.get(section_num, documents_for_api))
+            if section["number"] in batch_of:
+                scheduler.add_task(("initial", section["number"]), finish_batched_section, section, deps=[("batch", batch_of[section["number"]])],
+                                   priority=initial_priority(section, "initial"), on_complete=initial_section_done)
+            elif from_upstream(section): # starts once its upstream sections have their initial content
+                scheduler.add_task(("initial", section["number"]), generate_from_upstream, section, deps=[initial_key(upstream) for upstream in upstream_of(section)],
+                                   priority=initial_priority(section, "initial"), on_complete=initial_section_done)
+            else:
+                scheduler.add_task(("initial", section["number"]), generate_initial_section, section, documents_for_api, persona, analysis_specs, output_format, insight_model,
+                                   priority=initial_priority(section, "initial"), on_complete=initial_section_done)
+        initial_keys = [initial_key(section["number"]) for section in run_sections]
+
+        # --- Second chance for failed initial sections, before the initial profile is published ---
+        def regenerate_failed_section(section_def):
+            """Generate a failed section again with a longer timeout (and RETRY_FALLBACK_MODEL, if set)."""
+            with api_call_overrides(model_name=RETRY_FALLBACK_MODEL, timeout=RETRY_TIMEOUT_SECONDS):
+                model = create_insight_model() if RETRY_FALLBACK_MODEL else insight_model
+                if from_upstream(section_def): return generate_from_upstream(section_def, model)[1]
+                section_refinement_documents.pop(section_def["number"], None)
+                return generate_initial_section(section_def, documents_for_api, persona, analysis_specs, output_format, model)[1]
+
+        def plan_initial_retry(key, result, error):
+            """Once every initial section is done: queue the failed ones again, then the end of the retry pass."""
+            retry_keys = []
+            try:
+                if failed_initial:
+                    append_bg_log(f"Retry: generating {len(failed_initial)} failed sections {sorted(failed_initial)} again "
+                                  f"({max(1, RETRY_CONCURRENCY)} at a time, {RETRY_TIMEOUT_SECONDS}s per call{', model ' + RETRY_FALLBACK_MODEL if RETRY_FALLBACK_MODEL else ''})...")
+                    retry_keys = queue_retry_tasks(scheduler, "initial_retry", [failed_initial[num] for num in sorted(failed_initial)], regenerate_failed_section)
+            finally: # the initial profile and the refinement gates wait for this key
+                scheduler.add_task(("initial_retry",), lambda: None, deps=retry_keys, priority=INITIAL_GENERATION_PRIORITY, on_complete=initial_retry_done)
+
+        def initial_retry_done(key, result, error):
+            if not failed_initial: return
+            for section_num, section_def in sorted(failed_initial.items()):
+                retry_error = scheduler.error(("initial_retry", section_num))
+                if retry_error is not None:
+                    append_bg_log(f"S{section_num}: Retry hit exception - {type(retry_error).__name__}: {retry_error}")
+                    content_result = f'<div class="section" id="section-{section_num}"><h2>{section_num}. {section_def["title"]}</h2><p class="error">ERROR: Generation failed again on retry: {retry_error}</p></div>'
+                else:
+                    content_result = scheduler.result(("initial_retry", section_num))
+                record_initial_result(section_def, content_result, section_refinement_documents.get(section_num, documents_for_api), retried=True)
+            recovered = [num for num in sorted(failed_initial) if '<p class="error">' not in str(initial_results[num])]
+            checkpoint.update(failedSectionRetry={**(checkpoint.meta.get("failedSectionRetry") or {}), "initial": {"retried": sorted(failed_initial), "recovered": recovered}})
+            append_bg_log(f"Retry: {len(recovered)} of {len(failed_initial)} failed initial sections recovered {recovered}.")
+            log_event = {"event": "FailedSectionRetry", "runId": run_id, "stage": "initial", "retried": sorted(failed_initial), "recovered": recovered,
+                         "concurrency": max(1, RETRY_CONCURRENCY), "timeoutSeconds": RETRY_TIMEOUT_SECONDS, "model": RETRY_FALLBACK_MODEL or MODEL_NAME}
+            save_log_entry_hf_dataset(user_email=user_email, event_data=log_event, api=hf_api_client, HF_TOKEN=hf_token, DATASET_REPO_ID=dataset_repo_id)
+
+        # Everything that needs the whole initial profile waits for the retry pass (a no-op when nothing failed)
+        scheduler.add_task(("initial_retry", "plan"), lambda: None, deps=initial_keys, priority=INITIAL_GENERATION_PRIORITY, on_complete=plan_initial_retry)
+        initial_stage_keys = [("initial_retry",)]
+
+        # --- 4./5. Aggregate, save and email the initial profile as soon as the last initial section is done ---
+        def publish_initial_profile():
+            nonlocal initial_final_html, initial_profile_saved_to_dataset, initial_profile_repo_path, initial_section_processing_error, initial_error_message_for_email, initial_email_sent
+            if initial_email_sent: append_bg_log("All initial sections processed. The initial profile was already emailed before the restart."); return
+            append_bg_log("All initial sections processed. Aggregating initial profile...")
+            try:
+                ordered_initial_contents = []
+                for section_def in sorted(run_sections, key=lambda x: x["number"]):
+                    content = initial_results.get(section_def["number"], f'<div class="section" id="section-{section_def["number"]}"><h2>{section_def["number"]}. {section_def["title"]}</h2><p class="error">ERROR: Content missing during initial aggregation.</p></div>')
+                    ordered_initial_contents.append(str(content))
+                initial_final_html = generate_full_html_profile(company_name, run_sections, ordered_initial_contents, app_version)
+                if initial_final_html and isinstance(initial_final_html, str):
+                    local_path = save_profile_to_disk(output_dir, "initial_profile.html", initial_final_html, append_bg_log) if output_dir else None
+                    append_bg_log("Initial HTML generated. Saving to dataset...")
+                    saved_repo_path = save_profile_hf_dataset(profile_content=initial_final_html, content_type="html", run_id=run_id, company_name=company_name, user_email=user_email, api=hf_api_client, HF_TOKEN=hf_token, DATASET_REPO_ID=dataset_repo_id) if hf_api_client is not None else local_path
+                    if saved_repo_path: initial_profile_saved_to_dataset = True; initial_profile_repo_path = saved_repo_path; append_bg_log(f"Initial profile saved successfully to dataset: {saved_repo_path}")
+                    else: append_bg_log("Warning: Failed to save initial profile to dataset."); initial_profile_saved_to_dataset = False; initial_section_processing_error = True
+                else: append_bg_log("Error: Initial HTML generation failed or produced empty content."); raise ValueError("Initial HTML generation failed.")
+            except Exception as aggregation_e:
+                print(f"BG Processor: Run {run_id}: CRITICAL ERROR aggregating initial profile: {aggregation_e}"); traceback.print_exc()
+                initial_section_processing_error = True; initial_error_message_for_email = f"Profile generation failed: {type(aggregation_e).__name__} - {str(aggregation_e)}"
+                dropped = scheduler.cancel(lambda key: key[0] in ("refine", "save_refined", "consistency_review", "consistency_refinement", "refinement_gate"))
+                append_bg_log(f"Cancelled {len(dropped)} queued refinement tasks after the initial profile failed.")
                 try:
-                    s_num_result, content_result = future.result()
-                    if not content_result or '<p class="error">' in str(content_result):
-                        append_bg_log(f"PARTIAL FAIL: Section {s_num_result} ('{section_title}') initial generation reported error.")
-                        initial_section_processing_error = True
-                        if not content_result: content_result = f'<div class="section" id="section-{s_num_result}"><h2>{s_num_result}. {section_title}</h2><p class="error">ERROR: Generation function returned empty content.</p></div>'
-                    else: append_bg_log(f"SUCCESS: Section {s_num_result} ('{section_title}') initial generation.")
-                    initial_results[section_num] = content_result
-                except Exception as e:
-                    append_bg_log(f"FAIL: Section {section_num} ('{section_title}') initial generation hit exception - {type(e).__name__}: {e}")
-                    error_content_html = f'<div class="section" id="section-{section_num}"><h2>{section_num}. {section_title}</h2><p class="error">ERROR: Generation process failed unexpectedly: {e}</p></div>'
-                    initial_results[section_num] = error_content_html; content_result = error_content_html; initial_section_processing_error = True
-                try: # Save Initial Section
-                    if content_result:
-                         save_section_hf_dataset(section_num=s_num_result, section_content=str(content_result), content_type="html", run_id=run_id, company_name=company_name, user_email=user_email, api=hf_api_client, HF_TOKEN=hf_token, DATASET_REPO_ID=dataset_repo_id)
-                    else: append_bg_log(f"Warning: Skipping dataset save for empty initial section {s_num_result}")
-                except Exception as section_save_e: append_bg_log(f"Non-critical error during initial save attempt for section {s_num_result}: {section_save_e}")
-                completed_sections_count += 1; progress_percent = int((completed_sections_count / total_sections) * 100); append_bg_log(f"Initial Progress: {completed_sections_count}/{total_sections} ({progress_percent}%) sections processed.")
-        append_bg_log("All initial sections processed. Aggregating initial profile...")
-
-        # --- 4. Aggregate and Save Initial Profile ---
-        ordered_initial_contents = []
-        for section_def in sorted(sections, key=lambda x: x["number"]):
-            content = initial_results.get(section_def["number"], f'<div class="section" id="section-{section_def["number"]}"><h2>{section_def["number"]}. {section_def["title"]}</h2><p class="error">ERROR: Content missing during initial aggregation.</p></div>')
-            ordered_initial_contents.append(str(content))
-        initial_final_html = generate_full_html_profile(company_name, sections, ordered_initial_contents, app_version)
-        if initial_final_html and isinstance(initial_final_html, str):
-            append_bg_log("Initial HTML generated. Saving to dataset...")
-            saved_repo_path = save_profile_hf_dataset(profile_content=initial_final_html, content_type="html", run_id=run_id, company_name=company_name, user_email=user_email, api=hf_api_client, HF_TOKEN=hf_token, DATASET_REPO_ID=dataset_repo_id)
-            if saved_repo_path: initial_profile_saved_to_dataset = True; initial_profile_repo_path = saved_repo_path; append_bg_log(f"Initial profile saved successfully to dataset: {saved_repo_path}")
-            else: append_bg_log("Warning: Failed to save initial profile to dataset."); initial_profile_saved_to_dataset = False; initial_section_processing_error = True
-        else: append_bg_log("Error: Initial HTML generation failed or produced empty content."); raise ValueError("Initial HTML generation failed.")
+                    log_event = {"event": "RunFailed", "runId": run_id, "status": "Exception", "errorStage": "InitialAggregation", "errorType": type(aggregation_e).__name__, "errorMessage": str(aggregation_e)}
+                    save_log_entry_hf_dataset(user_email=user_email, event_data=log_event, api=hf_api_client, HF_TOKEN=hf_token, DATASET_REPO_ID=dataset_repo_id)
+                except Exception as log_fail_e: print(f"Error logging RunFailed after aggregation error: {log_fail_e}")
+            send_initial_notification(
+                run_id, user_email, company_name, initial_final_html, initial_profile_repo_path, initial_profile_saved_to_dataset,
+                initial_section_processing_error, initial_error_message_for_email, append_bg_log,
+                sg_client, hf_api_client, hf_token, dataset_repo_id, sender_email, app_version
+            )
+            initial_email_sent = True; checkpoint.update(initialEmailSent=True)
+
+        scheduler.add_task(("initial_profile",), publish_initial_profile, deps=initial_stage_keys, priority=INITIAL_PROFILE_PRIORITY)
+
+        # --- 'profile' refinement: review the whole initial profile, then improve only the flagged sections ---
+        def review_group(group):
+            if not use_map_reduce: return review_profile_consistency(group, initial_results, documents_for_api)
+            # Map-reduce runs have no inline documents: review against the sections' page-by-page extraction notes
+            notes = [f"SECTION {section['number']} {text}" for section in group for text in deferred_refinement.get(section["number"], (None, None, []))[2] if str(text).startswith("SOURCE NOTES")]
+            if not notes:
+                append_bg_log(f"Profile review skipped for sections {group[0]['number']}-{group[-1]['number']}: no extraction notes to review against.")
+                return []
+            return review_profile_consistency(group, initial_results, notes)
+
+        def queue_profile_refinement():
+            review = checkpoint.meta.get("consistencyReview")
+            if review is None: # not reviewed before a restart
+                issues, failed_groups = [], []
+                for index, group in enumerate(review_groups):
+                    if scheduler.error(("consistency_review", index)) is not None: failed_groups.append([section["number"] for section in group])
+                    else: issues.extend(scheduler.result(("consistency_review", index)) or [])
+                review = {"calls": len(review_groups), "issues": issues, "failedGroups": failed_groups}
+                checkpoint.update(consistencyReview=review)
+                metrics = refinement_state["metrics"]; metrics["consistencyReviews"] += len(review_groups); metrics["consistencyIssues"] += len(issues)
+                log_event = {"event": "ConsistencyReview", "runId": run_id, "calls": len(review_groups), "issueCount": len(issues), "failedGroups": failed_groups,
+                             "sectionsFlagged": sorted({issue["section"] for issue in issues})}
+                save_log_entry_hf_dataset(user_email=user_email, event_data=log_event, api=hf_api_client, HF_TOKEN=hf_token, DATASET_REPO_ID=dataset_repo_id)
+            if review["failedGroups"]:
+                append_bg_log(f"Profile review failed for sections {review['failedGroups']}; they keep their initial content."); refinement_state["error"] = True
+            by_section = {}
+            for issue in review["issues"]: by_section.setdefault(issue["section"], []).append(issue)
+            refinement_state["consistency_issues"] = {num: format_section_issues(section_issues) for num, section_issues in by_section.items()}
+            append_bg_log(f"Profile review: {len(review['issues'])} issues in {len(by_section)} of {len(deferred_refinement)} sections ({review['calls']} review calls). Improving only the flagged sections...")
+            queue_deferred_refinement()
+
+        def plan_profile_review(key, result, error):
+            """Once every initial section is done: one review call per group of sections, then the improvements."""
+            review_keys = []
+            if "consistencyReview" not in checkpoint.meta:
+                review_groups[:] = group_sections_for_review(run_sections, initial_results)
+                for index, group in enumerate(review_groups):
+                    review_keys.append(("consistency_review", index))
+                    scheduler.add_task(review_keys[-1], review_group, group, priority=INITIAL_GENERATION_PRIORITY)
+            scheduler.add_task(("consistency_refinement",), queue_profile_refinement, deps=review_keys, priority=INITIAL_GENERATION_PRIORITY)
+
+        review_groups = []
+        if checkpoint.meta["refinementMode"] == "profile":
+            scheduler.add_task(("consistency_review", "plan"), lambda: None, deps=initial_stage_keys, priority=INITIAL_GENERATION_PRIORITY, on_complete=plan_profile_review)
+        elif defer_refinement: # bottom-N quality gate: rank every section before refining any
+            scheduler.add_task(("refinement_gate",), queue_deferred_refinement, deps=initial_stage_keys, priority=INITIAL_GENERATION_PRIORITY)
+        append_bg_log("Initial tasks submitted. Refinement of each section starts as soon as its initial content is ready...")
+        refinement_start_time = time.time()
+        scheduler.run()
+        if refinement_state.get("retry_queue") and initial_error_message_for_email is None:
+            retry = retry_failed_refinements(scheduler, refinement_state, run_id, user_email, company_name, hf_api_client, hf_token, dataset_repo_id, append_bg_log,
+                                             checkpoint=checkpoint, deadline=deadline, mode=checkpoint.meta["refinementMode"])
+            checkpoint.update(failedSectionRetry={**(checkpoint.meta.get("failedSectionRetry") or {}), "refinement": retry})
+            log_event = {"event": "FailedSectionRetry", "runId": run_id, "stage": "refinement", **retry,
+                         "concurrency": max(1, RETRY_CONCURRENCY), "timeoutSeconds": RETRY_TIMEOUT_SECONDS, "model": RETRY_FALLBACK_MODEL or MODEL_NAME}
+            save_log_entry_hf_dataset(user_email=user_email, event_data=log_event, api=hf_api_client, HF_TOKEN=hf_token, DATASET_REPO_ID=dataset_repo_id)
+        pipeline_completed = True
+        if deadline and deadline.degraded:
+            checkpoint.update(degradation=deadline.summary())
+            append_bg_log(f"Deadline: refinement shortened for sections {sorted(deadline.degraded)} ({deadline.summary()['secondsLeft'] / 60:.1f} min of the budget left).")
+            log_event = {"event": "RunDeadlineDegraded", "runId": run_id, **checkpoint.meta["degradation"]}
+            save_log_entry_hf_dataset(user_email=user_email, event_data=log_event, api=hf_api_client, HF_TOKEN=hf_token, DATASET_REPO_ID=dataset_repo_id)
+        if quality_gate:
+            gated = sorted(set(quality_scores) - select_sections_to_refine(quality_scores, quality_gate["threshold"], quality_gate["bottomN"]))
+            checkpoint.update(qualityGate={"threshold": quality_gate["threshold"], "bottomN": quality_gate["bottomN"], "scores": {str(num): score for num, score in sorted(quality_scores.items())}, "gated": gated})
+            metrics = refinement_state["metrics"]
+            append_bg_log(f"Quality gate: {len(gated)} of {len(quality_scores)} sections kept their initial content {gated}; ~{metrics['gateCallsSaved']} calls and ~{metrics['gateInputTokensSaved']:,} input / ~{metrics['gateOutputTokensSaved']:,} output tokens saved.")
+            log_event = {"event": "QualityGate", "runId": run_id, **checkpoint.meta["qualityGate"], "callsSaved": metrics["gateCallsSaved"],
+                         "inputTokensSaved": metrics["gateInputTokensSaved"], "outputTokensSaved": metrics["gateOutputTokensSaved"]}
+            save_log_entry_hf_dataset(user_email=user_email, event_data=log_event, api=hf_api_client, HF_TOKEN=hf_token, DATASET_REPO_ID=dataset_repo_id)
+        if generated_initial: record_section_lengths(generated_initial)
+        append_bg_log(f"Section pipeline finished: {len(scheduler.durations)} tasks in {(scheduler.finished_at - scheduler.started_at) / 60:.1f} minutes.")
+        try: # Learn from this run and compare the longest-first order with plain FIFO
+            recorded = record_scheduler_latencies(scheduler, MODEL_NAME, latency_estimator.bucket); save_latency_history()
+            scheduling_report = scheduler.makespan_report()
+            append_bg_log(f"Scheduling: makespan {scheduling_report['actualSeconds']:.0f}s actual; simulated longest-first {scheduling_report['simulatedPrioritySeconds']:.0f}s vs FIFO {scheduling_report['simulatedFifoSeconds']:.0f}s ({scheduling_report['improvementVsFifoPercent']:+.1f}%). {recorded} latency samples recorded.")
+            log_event = {"event": "SchedulingReport", "runId": run_id, "sizeBucket": latency_estimator.bucket, "latencySamplesRecorded": recorded, **scheduling_report}
+            save_log_entry_hf_dataset(user_email=user_email, event_data=log_event, api=hf_api_client, HF_TOKEN=hf_token, DATASET_REPO_ID=dataset_repo_id)
+        except Exception as report_e: append_bg_log(f"Non-critical error recording scheduling statistics: {report_e}")
 
 
     except Exception as generation_e:
@@ -583,76 +1502,25 @@ def execute_full_profile_workflow(
         except Exception as log_fail_e: print(f"Error logging RunFailed after main exception: {log_fail_e}")
 
 
-    # --- 5. Send INITIAL Email Notification ---
-    append_bg_log("Preparing INITIAL email notification...")
-    # (Initial email composition and sending logic - same as previous version)
-    email_subject_initial = ""; email_html_content_initial = ""; attachment_object_initial = None
-    initial_generation_succeeded_fully = not initial_error_message_for_email and initial_profile_saved_to_dataset
-    initial_generation_completed_with_errors = (initial_section_processing_error or not initial_profile_saved_to_dataset) and not initial_error_message_for_email
-    initial_generation_failed_critically = initial_error_message_for_email is not None
-
-    if initial_generation_succeeded_fully or initial_generation_completed_with_errors:
-        status_string = "completed successfully" if initial_generation_succeeded_fully else "completed with some errors"
-        email_subject_initial = f"ProfileDash: Initial Profile for {company_name} is Ready"
-        if initial_generation_completed_with_errors: email_subject_initial = f"ProfileDash: Initial Profile for {company_name} Completed (with errors)"
-        if initial_final_html and initial_profile_repo_path:
-            try: # Try attach
-                encoded_content = base64.b64encode(initial_final_html.encode('utf-8')).decode('ascii')
-                attachment_filename = os.path.basename(initial_profile_repo_path);
-                if not attachment_filename.lower().endswith('.html'): attachment_filename += ".html"
-                attachment_object_initial = Attachment(FileContent(encoded_content), FileName(attachment_filename), FileType('text/html'), Disposition('attachment'))
-                email_html_content_initial = f"""<p>Your <strong>initial</strong> ProfileDash profile generation for <strong>{company_name}</strong> {status_string}.</p><p>The initially generated profile is attached.</p>{'<p><i>Note: Some sections might contain errors.</i></p>' if initial_generation_completed_with_errors else ''}<p>A refined version is being generated and will be sent separately (approx. 30-60 mins).</p><p>(Run ID: {run_id})</p><hr><p style='font-size:small; color:grey;'>ProfileDash {app_version}</p>""" # Adjusted time estimate
-            except Exception as attach_prep_e:
-                 append_bg_log(f"ERROR preparing initial Base64 attachment: {attach_prep_e}.")
-                 attachment_object_initial = None
-                 email_html_content_initial = f"""<p>Your <strong>initial</strong> ProfileDash profile generation for <strong>{company_name}</strong> {status_string}, but attachment failed.</p><p>A refined version is being generated and will be sent separately (approx. 30-60 mins).</p><p>(Run ID: {run_id})</p><hr><p style='font-size:small; color:grey;'>ProfileDash {app_version}</p>""" # Adjusted time estimate
-        else:
-            email_html_content_initial = f"""<p>Your <strong>initial</strong> ProfileDash profile generation for <strong>{company_name}</strong> {status_string}, but the final profile could not be generated/saved for attachment.</p><p>A refined version is being generated and will be sent separately (approx. 30-60 mins).</p><p>(Run ID: {run_id})</p><hr><p style='font-size:small; color:grey;'>ProfileDash {app_version}</p>""" # Adjusted time estimate
-        log_event_status = "Success" if initial_generation_succeeded_fully else "CompletedWithErrors"
-        try: # Log completion
-            log_event = {"event": "RunCompleted", "runId": run_id, "status": log_event_status, "stage": "Initial", "finalProfileSaved": initial_profile_saved_to_dataset, "sectionProcessingErrorEncountered": initial_section_processing_error}
-            save_log_entry_hf_dataset(user_email=user_email, event_data=log_event, api=hf_api_client, HF_TOKEN=hf_token, DATASET_REPO_ID=dataset_repo_id)
-        except Exception as log_complete_e: print(f"Error logging RunCompleted ({log_event_status}) initial: {log_complete_e}")
-    else: # Failed critically
-        email_subject_initial = f"ProfileDash: Profile Generation Failed for {company_name}"
-        error_details = initial_error_message_for_email if initial_error_message_for_email else 'An unspecified critical error occurred during initial generation.'
-        email_html_content_initial = f"""<p>Unfortunately, the initial ProfileDash profile generation for <strong>{company_name}</strong> failed critically.</p><p>Error details: {error_details}</p><p>No initial profile could be generated. Refinement stage will not run.</p><p>(Run ID: {run_id})</p><hr><p style='font-size:small; color:grey;'>ProfileDash {app_version}</p>"""
-
-    # Send Initial Email
-    if sg_client:
-        try:
-            message = Mail(from_email=Email(sender_email, "ProfileDash Notification (Initial)"), to_emails=To(user_email), subject=email_subject_initial, html_content=Content("text/html", email_html_content_initial))
-            if attachment_object_initial: message.attachment = attachment_object_initial; append_bg_log("Initial Attachment added to email message.")
-            response = sg_client.client.mail.send.post(request_body=message.get())
-            email_log_status_initial = "Success" if 200 <= response.status_code < 300 else "Failure"
-            append_bg_log(f"Initial notification email send status: {email_log_status_initial}")
-            try: # Log email send attempt
-                log_event = {"event": "InitialNotificationEmailSent", "runId": run_id, "status": email_log_status_initial}
-                if email_log_status_initial == "Failure": log_event["sendgridResponseStatus"] = response.status_code; log_event["sendgridResponseBody"] = str(response.body)[:1000]
-                save_log_entry_hf_dataset(user_email=user_email, event_data=log_event, api=hf_api_client, HF_TOKEN=hf_token, DATASET_REPO_ID=dataset_repo_id)
-            except Exception as log_email_e: print(f"Error logging InitialNotificationEmailSent status: {log_email_e}")
-        except Exception as email_ex:
-             append_bg_log(f"Exception sending initial notification email: {email_ex}"); traceback.print_exc()
-             try: # Log email exception
-                 log_event = {"event": "InitialNotificationEmailSent", "runId": run_id, "status": "Exception", "error": str(email_ex)}
-                 save_log_entry_hf_dataset(user_email=user_email, event_data=log_event, api=hf_api_client, HF_TOKEN=hf_token, DATASET_REPO_ID=dataset_repo_id)
-             except Exception as log_email_e: print(f"Error logging Initial EmailSent exception: {log_email_e}")
-    else: append_bg_log("SendGrid client not available. Cannot send initial email notification.")
+    # --- Send INITIAL Email Notification if the pipeline failed before it could ---
+    if not initial_email_sent:
+        send_initial_notification(
+            run_id, user_email, company_name, initial_final_html, initial_profile_repo_path, initial_profile_saved_to_dataset,
+            initial_section_processing_error, initial_error_message_for_email, append_bg_log,
+            sg_client, hf_api_client, hf_token, dataset_repo_id, sender_email, app_version
+        )
 
 
-    # --- *** CALL REFINEMENT STAGE *** ---
-    if not initial_generation_failed_critically:
-        append_bg_log("Initial processing complete. Starting refinement stage...")
-        initial_results_snapshot = initial_results.copy() # Pass snapshot
+    # --- *** FINALIZE REFINEMENT STAGE *** ---
+    if pipeline_completed and initial_error_message_for_email is None:
+        append_bg_log("All sections refined. Finalizing refinement stage...")
         try:
-            # Call the refinement orchestrator function (defined above in this file)
-            run_refinement_stage(
+            finalize_refinement_stage(
                 run_id=run_id,
                 user_email=user_email,
-                api_key=api_key,
                 company_name=company_name,
-                initial_results=initial_results_snapshot,
-                documents_for_api=documents_for_api,
+                refinement_state=refinement_state,
+                refinement_start_time=refinement_start_time,
                 append_log_func=append_bg_log, # Pass the logger
                 # Pass clients and config needed by refinement stage
                 sg_client=sg_client,
@@ -661,16 +1529,32 @@ def execute_full_profile_workflow(
                 dataset_repo_id=dataset_repo_id,
                 sender_email=sender_email,
                 app_version=app_version,
-                max_workers=max_workers # <<< Pass max_workers for parallel refinement
+                output_dir=output_dir,
+                profile_sections=run_sections,
+                degradation=checkpoint.meta.get("degradation")
             )
+            checkpoint.update(refinementMetrics=refinement_state["metrics"])
             append_bg_log("Refinement stage completed (or attempted).")
         except Exception as refinement_e:
-            error_msg = f"CRITICAL ERROR initiating or during refinement stage call: {type(refinement_e).__name__} - {str(refinement_e)}"
+            error_msg = f"CRITICAL ERROR during refinement stage finalization: {type(refinement_e).__name__} - {str(refinement_e)}"
             append_bg_log(error_msg); traceback.print_exc()
             log_event = {"event": "RefinementStageFailed", "runId": run_id, "status": "CriticalException", "error": error_msg, "stage": "OrchestratorCall"}
             save_log_entry_hf_dataset(user_email=user_email, event_data=log_event, api=hf_api_client, HF_TOKEN=hf_token, DATASET_REPO_ID=dataset_repo_id)
     else:
          append_bg_log("Skipping refinement stage due to critical failure during initial generation.")
 
+    checkpoint.finish("completed" if pipeline_completed and initial_error_message_for_email is None else "failed")
+
+    # --- Cache a fully successful run for identical re-uploads (not one whose quality gate kept sections unrefined) ---
+    if cache_key and not checkpoint.meta.get("runCache", {}).get("hit") and pipeline_completed and initial_error_message_for_email is None \
+            and not initial_section_processing_error and not refinement_state["error"] and not checkpoint.meta.get("degradation") \
+            and not refinement_state["metrics"]["sectionsGated"]:
+        if store_cached_run(cache_key, checkpoint, [section["number"] for section in run_sections], [document["sha256"] for document in checkpoint.meta["documents"]], company_name):
+            checkpoint.update(runCache={"key": cache_key, "hit": False}); append_bg_log(f"Run stored in the run cache ({cache_key[:12]}).")
+
+    # --- Keep the local document store within its size budget (documents of unfinished runs stay for resuming) ---
+    try: evict_document_entries(keep_hashes=active_document_hashes())
+    except Exception as evict_e: append_bg_log(f"Non-critical error pruning document store: {evict_e}")
+
     # --- End of background task ---
-    append_bg_log(f"Background task finished.")
\ No newline at end of file
+    append_bg_log(f"Background task finished.")
@@ -0,0 +1,153 @@
+"""
+Batch module for ProfileDash
+Headless profiling of many companies: every sub-folder of a directory tree is one
+company (all PDFs below it are its documents). Companies run in parallel through
+the same JobQueue the app uses, sharing one run budget and the process-wide API
+call limit, and each company's initial and refined HTML is written to disk.
+
+Usage:
+    python -m src.batch <companies_dir> --output-dir <dir> [--concurrency 2]
+        [--max-workers 3] [--max-api-calls 6] [--email you@sc.com] [--no-email] [--no-upload] [--sections financials] [--force-regenerate] [--sla-minutes 45]
+        [--refinement-mode merged] [--refine-below 60] [--refine-bottom-n 10]
+
+Needs GOOGLE_API_KEY (and SENDGRID_API_KEY / HF_DATA_TOKEN unless --no-email / --no-upload).
+"""
+
+import os
+import sys
+import time
+import uuid
+import argparse
+import threading
+
+from .job_queue import JobQueue
+from .run_store import load_run_meta
+from .section_dag import parse_section_selection
+from .section_definitions import sections, section_groups
+from .api_client import MAX_CONCURRENT_API_CALLS, set_max_concurrent_api_calls
+from .worker import create_service_clients
+from .background_processor import execute_full_profile_workflow, REFINEMENT_MODES
+
+BATCH_USER_EMAIL = os.environ.get("PROFILEDASH_BATCH_EMAIL", "batch@localhost")
+BATCH_DATASET_REPO_ID = "ralfpilarczyk/ProfileDashData"
+BATCH_SENDER_EMAIL = "ProfileDash.NoReply@gmail.com"
+BATCH_APP_VERSION = "batch"
+BATCH_MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+
+
+def find_company_folders(root_dir):
+    """{company folder name: sorted PDF paths below it} for each direct sub-folder containing PDFs."""
+    companies = {}
+    for name in sorted(os.listdir(root_dir)):
+        folder = os.path.join(root_dir, name)
+        if not os.path.isdir(folder):
+            continue
+        pdf_paths = sorted(os.path.join(dirpath, filename) for dirpath, _, filenames in os.walk(folder)
+                           for filename in filenames if filename.lower().endswith(".pdf"))
+        if pdf_paths:
+            companies[name] = pdf_paths
+    return companies
+
+
+def run_batch(root_dir, output_dir, concurrency=2, max_workers=3, max_api_calls=None,
+              user_email=BATCH_USER_EMAIL, send_email=True, upload=True, max_upload_bytes=BATCH_MAX_UPLOAD_BYTES, section_numbers=None,
+              force_regenerate=False, sla_minutes=None, refinement_mode=None, refine_below=None, refine_bottom_n=None):
+    """
+    Profile every company folder under root_dir (only `section_numbers` and the sections
+    they build on, if given; companies already profiled with the same documents come from the
+    run cache unless force_regenerate; sla_minutes is each company's time budget before refinement
+    degrades; refinement_mode overrides PROFILEDASH_REFINEMENT_MODE; refine_below / refine_bottom_n
+    limit refinement to low-scoring sections). Returns the per-company results (company, run_id, status,
+    seconds, output_dir).
+    """
+    companies = find_company_folders(root_dir)
+    if not companies:
+        print(f"Batch: No company folders with PDFs found under {root_dir}.")
+        return []
+    set_max_concurrent_api_calls(max_api_calls or MAX_CONCURRENT_API_CALLS)
+    clients = create_service_clients()
+    if not clients["api_key"]:
+        raise ValueError("GOOGLE_API_KEY not found in the environment.")
+    sg_client = clients["sg_client"] if send_email else None
+    hf_api_client = clients["hf_api_client"] if upload else None
+
+    job_queue = JobQueue(max_running=concurrency, max_queue_depth=len(companies), max_per_user=len(companies), name="Batch Queue")
+    results, results_lock, finished = [], threading.Lock(), threading.Semaphore(0)
+
+    def profile_company(company, run_id, pdf_paths, company_output_dir):
+        start = time.time()
+        try:
+            execute_full_profile_workflow(
+                run_id, user_email, clients["api_key"], pdf_paths,
+                sg_client, hf_api_client, clients["hf_token"], BATCH_DATASET_REPO_ID, BATCH_SENDER_EMAIL, BATCH_APP_VERSION,
+                max_workers, max_upload_bytes, output_dir=company_output_dir, section_numbers=section_numbers,
+                force_regenerate=force_regenerate, sla_minutes=sla_minutes, refinement_mode=refinement_mode,
+                refine_below=refine_below, refine_bottom_n=refine_bottom_n
+            )
+            status = (load_run_meta(run_id) or {}).get("status", "unknown")
+        except Exception as e:
+            print(f"Batch: {company} crashed: {type(e).__name__} - {e}")
+            status = "failed"
+        with results_lock:
+            results.append({"company": company, "run_id": run_id, "status": status, "seconds": round(time.time() - start, 1),
+                            "output_dir": company_output_dir,
+                            "refined": os.path.exists(os.path.join(company_output_dir, "refined_profile.html"))})
+            print(f"Batch: {company} {status} in {(time.time() - start) / 60:.1f} minutes ({len(results)}/{len(companies)} done).")
+        finished.release()
+
+    batch_start = time.time()
+    print(f"Batch: Profiling {len(companies)} companies, {concurrency} at a time with {max_workers} workers each "
+          f"(email {'on' if sg_client else 'off'}, dataset upload {'on' if hf_api_client else 'off'}).")
+    for company, pdf_paths in companies.items():
+        run_id = str(uuid.uuid4())
+        job_queue.submit(run_id, user_email, profile_company, company, run_id, pdf_paths, os.path.join(output_dir, company))
+    for _ in companies:
+        finished.acquire()
+    print_throughput_summary(results, time.time() - batch_start, concurrency)
+    return results
+
+
+def print_throughput_summary(results, wall_seconds, concurrency):
+    """Per-company outcome plus overall throughput."""
+    print("\n=== Batch summary ===")
+    for result in sorted(results, key=lambda r: r["company"]):
+        print(f"{result['company']:<40} {result['status']:<10} {result['seconds'] / 60:6.1f} min  "
+              f"{'refined' if result['refined'] else 'initial only'}  {result['output_dir']}")
+    completed = [r for r in results if r["status"] == "completed"]
+    busy_seconds = sum(r["seconds"] for r in results)
+    print(f"{len(completed)}/{len(results)} companies completed in {wall_seconds / 60:.1f} minutes "
+          f"({len(results) / wall_seconds * 3600:.1f} profiles/hour, average {busy_seconds / max(1, len(results)) / 60:.1f} min per profile, "
+          f"effective parallelism {busy_seconds / wall_seconds:.1f} of {concurrency}).")
+
+
+def main(argv=None):
+    """Command-line entry point for batch profiling."""
+    parser = argparse.ArgumentParser(prog="python -m src.batch", description="Generate ProfileDash profiles for a directory of company folders.")
+    parser.add_argument("companies_dir", help="Directory with one sub-folder of PDFs per company")
+    parser.add_argument("--output-dir", default="batch_output", help="Where <company>/initial_profile.html and refined_profile.html are written")
+    parser.add_argument("--concurrency", type=int, default=2, help="Companies profiled at the same time")
+    parser.add_argument("--max-workers", type=int, default=3, help="Section workers per company")
+    parser.add_argument("--max-api-calls", type=int, default=None, help=f"API calls in flight across all companies (default {MAX_CONCURRENT_API_CALLS})")
+    parser.add_argument("--email", default=BATCH_USER_EMAIL, help="Recipient of the emails and owner of the run logs")
+    parser.add_argument("--no-email", action="store_true", help="Do not send notification emails")
+    parser.add_argument("--no-upload", action="store_true", help="Do not upload sections, profiles or logs to the HF dataset")
+    parser.add_argument("--sections", default="", help=f"Only these sections, e.g. '7-9,23' or a group ({', '.join(section_groups)})")
+    parser.add_argument("--force-regenerate", action="store_true", help="Ignore the run cache and regenerate every company")
+    parser.add_argument("--sla-minutes", type=float, default=None, help="Time budget per company; refinement degrades once it runs short (default: PROFILEDASH_RUN_SLA_MINUTES, 0 = none)")
+    parser.add_argument("--refinement-mode", choices=REFINEMENT_MODES, default=None, help="'merged' runs both critiques in parallel and one combined improvement (default: PROFILEDASH_REFINEMENT_MODE)")
+    parser.add_argument("--refine-below", type=float, default=None, help="Refine only sections whose local quality score is below this (default: PROFILEDASH_REFINEMENT_GATE_SCORE, 0 = all)")
+    parser.add_argument("--refine-bottom-n", type=int, default=None, help="Refine only the N lowest-scoring sections (default: PROFILEDASH_REFINEMENT_GATE_BOTTOM_N, 0 = all)")
+    args = parser.parse_args(argv)
+    try:
+        section_numbers = parse_section_selection(args.sections, sections, section_groups) if args.sections else None
+    except ValueError as e:
+        parser.error(str(e))
+    results = run_batch(args.companies_dir, args.output_dir, max(1, args.concurrency), max(1, args.max_workers), args.max_api_calls,
+                        args.email, send_email=not args.no_email, upload=not args.no_upload, section_numbers=section_numbers,
+                        force_regenerate=args.force_regenerate, sla_minutes=args.sla_minutes, refinement_mode=args.refinement_mode,
+                        refine_below=args.refine_below, refine_bottom_n=args.refine_bottom_n)
+    return 0 if results and all(r["status"] == "completed" for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+"""
+Consistency module for ProfileDash
+Whole-profile review for the 'profile' refinement mode: the assembled initial profile (as
+text) is reviewed together with the documents in one call, or a few for very long profiles,
+and comes back as a list of section-targeted issues: contradictions between sections,
+statements the documents do not support, and material gaps. Only the flagged sections are
+then improved, instead of critiquing every section twice.
+"""
+
+import os
+import json
+import traceback
+
+from .api_client import cached_generate_content, create_fact_model
+from .html_generator import extract_text_from_html
+from .prompts import persona
+
+# Profile text per review call; longer profiles are split into consecutive groups of sections
+CONSISTENCY_MAX_PROFILE_CHARS = int(os.environ.get("PROFILEDASH_CONSISTENCY_MAX_PROFILE_CHARS", "400000"))
+ISSUE_CATEGORIES = ("contradiction", "factual", "gap")
+ISSUE_SEVERITIES = ("minor", "major")
+CONSISTENCY_INSTRUCTION = (
+    "Below is a draft company profile, section by section, compiled from the provided documents.\n"
+    "Review it as a whole and list the issues that need fixing:\n"
+    "- contradiction: a figure, date, name or statement that conflicts with another section (e.g. revenue in a financial table vs. the narrative elsewhere);\n"
+    "- factual: a statement that is not supported by, or conflicts with, the documents;\n"
+    "- gap: material information from the documents that the section clearly should cover but omits.\n"
+    "Assign each issue to the ONE section that should change (for a contradiction, the section that is wrong according to the documents). "
+    "Quote the conflicting values and where the correct value comes from, so the section can be fixed without seeing the rest of the profile. "
+    "Do not report style, formatting or wording preferences.\n"
+    "Output *only* a JSON array, one object per issue:\n"
+    '[{{"section": <section number>, "category": "contradiction" | "factual" | "gap", "severity": "minor" | "major", '
+    '"related_sections": [<other section numbers involved>], "issue": "<what is wrong>", "fix": "<what the section should say instead>"}}]\n'
+    "Output [] if the profile has no such issues. Only use these section numbers: {section_numbers}.\n\n"
+    "DRAFT PROFILE:\n{profile_text}"
+)
+
+
+def profile_section_text(section_def, html):
+    """One section of the profile as plain text, with a header the review can refer to."""
+    return f"=== SECTION {section_def['number']}. {section_def['title']} ===\n{extract_text_from_html(html).strip()}\n"
+
+
+def group_sections_for_review(section_defs, html_by_num, max_chars=CONSISTENCY_MAX_PROFILE_CHARS):
+    """
+    Consecutive groups of reviewable sections (initial content without errors), each with at
+    most max_chars of profile text (a longer single section forms its own group).
+    """
+    groups, current, current_chars = [], [], 0
+    for section_def in sorted(section_defs, key=lambda s: s["number"]):
+        html = html_by_num.get(section_def["number"])
+        if not html or '<p class="error">' in str(html):
+            continue
+        chars = len(profile_section_text(section_def, str(html)))
+        if current and current_chars + chars > max_chars:
+            groups.append(current); current, current_chars = [], 0
+        current.append(section_def); current_chars += chars
+    if current:
+        groups.append(current)
+    return groups
+
+
+def parse_consistency_issues(text, section_numbers):
+    """
+    The issues in a review response, keeping only well-formed ones that target `section_numbers`.
+
+    Returns:
+        list: dicts with 'section', 'category', 'severity', 'relatedSections', 'issue', 'fix'.
+    """
+    text = (text or "").strip()
+    start, end = text.find("["), text.rfind("]")
+    if start == -1 or end < start:
+        raise ValueError("No JSON issue list in the review response.")
+    raw_issues = json.loads(text[start:end + 1])
+    issues = []
+    for raw in raw_issues if isinstance(raw_issues, list) else []:
+        try:
+            section_num = int(raw.get("section"))
+        except (AttributeError, TypeError, ValueError):
+            continue
+        if section_num not in section_numbers or not str(raw.get("issue") or "").strip():
+            continue
+        related = [int(num) for num in raw.get("related_sections") or [] if str(num).isdigit() and int(num) != section_num]
+        issues.append({
+            "section": section_num,
+            "category": raw.get("category") if raw.get("category") in ISSUE_CATEGORIES else "factual",
+            "severity": raw.get("severity") if raw.get("severity") in ISSUE_SEVERITIES else "major",
+            "relatedSections": related,
+            "issue": str(raw["issue"]).strip(),
+            "fix": str(raw.get("fix") or "").strip(),
+        })
+    return issues
+
+
+def review_profile_consistency(section_defs, html_by_num, documents):
+    """
+    Review one group of sections (see group_sections_for_review) against each other and the documents.
+
+    Returns:
+        list: The section-targeted issues (see parse_consistency_issues).
+
+    Raises:
+        Exception: If the call fails or the response has no readable issue list.
+    """
+    section_numbers = sorted(section_def["number"] for section_def in section_defs)
+    profile_text = "\n".join(profile_section_text(section_def, str(html_by_num[section_def["number"]])) for section_def in section_defs)
+    prompt = f"{persona}\n" + CONSISTENCY_INSTRUCTION.format(section_numbers=", ".join(map(str, section_numbers)), profile_text=profile_text)
+    try:
+        print(f"Consistency Review: Reviewing sections {section_numbers[0]}-{section_numbers[-1]} ({len(profile_text):,} chars)...")
+        response = cached_generate_content(create_fact_model(), [prompt] + documents)
+        issues = parse_consistency_issues(getattr(response, "text", ""), set(section_numbers))
+    except Exception as e:
+        print(f"Consistency Review ERROR for sections {section_numbers[0]}-{section_numbers[-1]}: {type(e).__name__} - {e}")
+        traceback.print_exc()
+        raise
+    print(f"Consistency Review: {len(issues)} issues in {len({issue['section'] for issue in issues})} sections.")
+    return issues
+
+
+def format_section_issues(issues):
+    """The issues of one section as the critique its improvement call addresses."""
+    lines = []
+    for index, issue in enumerate(issues, start=1):
+        related = f" (see also section{'s' if len(issue['relatedSections']) > 1 else ''} {', '.join(map(str, issue['relatedSections']))})" if issue["relatedSections"] else ""
+        lines.append(f"{index}. [{issue['category']}, {issue['severity']}]{related} {issue['issue']}" + (f"\n   Fix: {issue['fix']}" if issue["fix"] else ""))
+    return "Issues found by a review of the whole profile against the documents:\n" + "\n".join(lines)
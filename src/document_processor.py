@@ -4,11 +4,42 @@ Handles document upload and preprocessing using base64 encoding for Gemini.
 """
 
 import os
+import io
+import re
 import base64
 import traceback
 
+# pypdf is optional: without it documents are still sent to the API, but
+# per-page text (and everything derived from it) is unavailable.
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+# Gemini bills each PDF page as an image (~258 tokens) plus its extracted text.
+TOKENS_PER_PDF_PAGE = 258
+CHARS_PER_TOKEN = 4
+# Compact text outline of a document set, sent instead of the PDFs where a call only needs orientation
+DOCUMENT_DIGEST_MAX_CHARS = int(os.environ.get("PROFILEDASH_DOCUMENT_DIGEST_MAX_CHARS", "6000"))
+
+# Keyword hints used to tag documents by type (checked against filename and first pages).
+DOCUMENT_TYPE_KEYWORDS = [
+    ("interim_report", ["interim", "quarterly", "half-year", "half year", "10-q", "q1", "q2", "q3", "q4", "h1", "1h", "9m", "6-k"]),
+    ("annual_report", ["annual report", "annual_report", "annualreport", "10-k", "20-f", "form 10k", "integrated report"]),
+    ("investor_presentation", ["presentation", "investor day", "deck", "slides", "roadshow", "earnings call"]),
+    ("prospectus", ["prospectus", "offering circular", "offering memorandum", "s-1", "f-1"]),
+]
+
 # upload_documents (tkinter) and get_current_documents (global state) are removed.
 
+def encode_document_part(file_content_bytes):
+    """Base64-encode one PDF into the part format expected by the Gemini API."""
+    return {
+        'mime_type': 'application/pdf', # Crucial for Gemini to recognize it
+        'data': base64.standard_b64encode(file_content_bytes).decode("utf-8")
+    }
+
+
 def load_document_content(uploaded_data):
     """
     Process uploaded documents (passed as a dict of filename: bytes)
@@ -54,4 +85,135 @@ def load_document_content(uploaded_data):
         print("Document Processor Warning: No documents were successfully processed and encoded.")
 
     print(f"Document Processor: Finished processing. {len(documents_for_api)} documents ready for API.")
-    return documents_for_api
\ No newline at end of file
+    return documents_for_api
+
+
+def extract_page_texts(file_content_bytes, filename="document"):
+    """
+    Extract the text of every page of a PDF.
+
+    Args:
+        file_content_bytes (bytes): Raw PDF content.
+        filename (str): Used for log messages only.
+
+    Returns:
+        list: One string per page (empty string for image-only pages), or None
+              if pypdf is unavailable or the file cannot be parsed.
+    """
+    if PdfReader is None:
+        print(f"Document Processor Warning: pypdf not installed, skipping text extraction for {filename}.")
+        return None
+    try:
+        reader = PdfReader(io.BytesIO(file_content_bytes))
+        if reader.is_encrypted:
+            reader.decrypt("")
+        page_texts = []
+        for page in reader.pages:
+            try:
+                page_texts.append(page.extract_text() or "")
+            except Exception as page_e:
+                print(f"Document Processor Warning: Could not extract text from a page of {filename}: {page_e}")
+                page_texts.append("")
+        return page_texts
+    except Exception as e:
+        print(f"Document Processor Error extracting text from {filename}: {type(e).__name__} - {e}")
+        return None
+
+
+def classify_document_type(filename, page_texts=None):
+    """
+    Tag a document as annual_report, interim_report, investor_presentation,
+    prospectus or other, based on its filename and the text of its first pages.
+    """
+    candidates = [filename.lower()]
+    if page_texts:
+        candidates.append(" ".join(page_texts[:2]).lower()[:5000])
+
+    for candidate in candidates:
+        for document_type, keywords in DOCUMENT_TYPE_KEYWORDS:
+            for keyword in keywords:
+                # Short tokens like "q1" or "h1" must match as whole words
+                if len(keyword) <= 3:
+                    if re.search(rf'(?<![a-z0-9]){re.escape(keyword)}(?![a-z0-9])', candidate):
+                        return document_type
+                elif keyword in candidate:
+                    return document_type
+    return "other"
+
+
+def estimate_document_tokens(page_count, page_texts=None):
+    """Estimate the input tokens a PDF costs per API call (page images plus text)."""
+    text_chars = sum(len(text) for text in page_texts) if page_texts else 0
+    return page_count * TOKENS_PER_PDF_PAGE + text_chars // CHARS_PER_TOKEN
+
+
+def count_pdf_pages(file_content_bytes):
+    """Count pages without a full parse (used when pypdf is unavailable)."""
+    if PdfReader is not None:
+        try:
+            return len(PdfReader(io.BytesIO(file_content_bytes)).pages)
+        except Exception:
+            pass
+    return len(re.findall(rb'/Type\s*/Page(?![s\w])', file_content_bytes))
+
+
+def analyze_pdf_document(filename, file_content_bytes):
+    """
+    Derive the expensive per-document artifacts that are worth persisting
+    between runs (see document_store.py).
+
+    Returns:
+        dict: page_count, page_texts, page_index, token_counts and document_type.
+    """
+    page_texts = extract_page_texts(file_content_bytes, filename)
+    page_count = len(page_texts) if page_texts is not None else count_pdf_pages(file_content_bytes)
+
+    page_index = []
+    for page_number, text in enumerate(page_texts or [], start=1):
+        first_line = next((line.strip() for line in text.splitlines() if line.strip()), "")
+        page_index.append({"page": page_number, "chars": len(text), "heading": first_line[:120]})
+
+    return {
+        "page_count": page_count,
+        "page_texts": page_texts,
+        "page_index": page_index,
+        "token_counts": {
+            "text_tokens": sum(len(text) for text in page_texts) // CHARS_PER_TOKEN if page_texts else 0,
+            "pdf_tokens_estimate": estimate_document_tokens(page_count, page_texts),
+        },
+        "document_type": classify_document_type(filename, page_texts),
+    }
+
+
+def build_document_digest(document_entries, max_chars=DOCUMENT_DIGEST_MAX_CHARS):
+    """
+    Compact outline of a document set from the stored analysis (no API calls): per document
+    its name, type and page count, then its distinct page headings with page numbers. Each
+    document gets an equal share of max_chars.
+
+    Args:
+        document_entries (dict): filename -> document store entry (see analyze_pdf_document).
+
+    Returns:
+        str: The digest ('' without documents).
+    """
+    if not document_entries:
+        return ""
+    share = max(200, max_chars // len(document_entries))
+    blocks = []
+    for filename, entry in document_entries.items():
+        entry = entry or {}
+        block = f"[{filename}] {(entry.get('document_type') or 'other').replace('_', ' ')}, {entry.get('page_count') or '?'} pages"
+        seen = set()
+        for page in entry.get("page_index") or []:
+            heading = re.sub(r"\s+", " ", page.get("heading") or "").strip()
+            if len(heading) < 4 or heading.lower() in seen or heading.isdigit():
+                continue
+            line = f"\n  p.{page['page']}: {heading}"
+            if len(block) + len(line) > share:
+                block += "\n  ..."
+                break
+            seen.add(heading.lower())
+            block += line
+        blocks.append(block)
+    return "\n".join(blocks)[:max_chars]
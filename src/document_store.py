@@ -0,0 +1,265 @@
+"""
+Document store module for ProfileDash
+Persists per-document preprocessing results on local disk, keyed by the SHA-256
+of the PDF bytes, so later runs with the same file skip straight to generation.
+
+Layout: <DOCUMENT_STORE_DIR>/<sha256>/document.pdf + meta.json
+
+Usage (CLI):
+    python -m src.document_store list
+    python -m src.document_store show <sha256-prefix>
+    python -m src.document_store prune [--max-mb 2048]
+    python -m src.document_store remove <sha256-prefix>
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import threading
+import traceback
+from datetime import datetime
+
+from .document_processor import analyze_pdf_document
+
+DOCUMENT_STORE_DIR = os.environ.get("PROFILEDASH_DOCUMENT_STORE", "document_store")
+DOCUMENT_STORE_MAX_MB = int(os.environ.get("PROFILEDASH_DOCUMENT_STORE_MAX_MB", "2048"))
+STORE_FORMAT_VERSION = 1
+META_FILENAME = "meta.json"
+PDF_FILENAME = "document.pdf"
+
+_store_lock = threading.Lock()
+
+
+def compute_document_hash(file_content_bytes):
+    """SHA-256 hex digest of the raw PDF bytes (the store key)."""
+    return hashlib.sha256(file_content_bytes).hexdigest()
+
+
+def _entry_dir(doc_hash, store_dir=None):
+    return os.path.join(store_dir or DOCUMENT_STORE_DIR, doc_hash)
+
+
+def _write_meta(entry_dir, meta):
+    # Write to a temp file first so a crash never leaves a half-written meta.json
+    tmp_path = os.path.join(entry_dir, META_FILENAME + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(entry_dir, META_FILENAME))
+
+
+def _dir_size_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try: total += os.path.getsize(os.path.join(root, name))
+            except OSError: pass
+    return total
+
+
+def load_document_entry(doc_hash, store_dir=None, touch=True):
+    """
+    Load a stored document's metadata.
+
+    Returns:
+        dict: The stored metadata, or None if the document is not in the store
+              (or was written by an incompatible store version).
+    """
+    entry_dir = _entry_dir(doc_hash, store_dir)
+    meta_path = os.path.join(entry_dir, META_FILENAME)
+    if not os.path.exists(meta_path):
+        return None
+    try:
+        with _store_lock:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("store_version") != STORE_FORMAT_VERSION:
+                print(f"Document Store: Ignoring entry {doc_hash[:12]} written by store version {meta.get('store_version')}.")
+                return None
+            if touch:
+                meta["last_accessed"] = time.time()
+                _write_meta(entry_dir, meta)
+        return meta
+    except Exception as e:
+        print(f"Document Store Warning: Could not read entry {doc_hash[:12]}: {e}")
+        return None
+
+
+def load_document_bytes(doc_hash, store_dir=None):
+    """Return the stored PDF bytes for a hash, or None if absent."""
+    pdf_path = os.path.join(_entry_dir(doc_hash, store_dir), PDF_FILENAME)
+    if not os.path.exists(pdf_path):
+        return None
+    with open(pdf_path, "rb") as f:
+        return f.read()
+
+
+def save_document_entry(doc_hash, filename, file_content_bytes, analysis, store_dir=None):
+    """Persist the PDF and its derived artifacts. Returns the stored metadata."""
+    entry_dir = _entry_dir(doc_hash, store_dir)
+    now = time.time()
+    meta = {
+        "store_version": STORE_FORMAT_VERSION,
+        "sha256": doc_hash,
+        "filenames": [filename],
+        "size_bytes": len(file_content_bytes),
+        "created": now,
+        "last_accessed": now,
+        **analysis,
+    }
+    with _store_lock:
+        os.makedirs(entry_dir, exist_ok=True)
+        pdf_path = os.path.join(entry_dir, PDF_FILENAME)
+        if not os.path.exists(pdf_path):
+            with open(pdf_path, "wb") as f:
+                f.write(file_content_bytes)
+        _write_meta(entry_dir, meta)
+    return meta
+
+
+def update_document_entry(doc_hash, updates, store_dir=None):
+    """Merge `updates` into a stored entry's metadata. Returns the new metadata or None."""
+    entry_dir = _entry_dir(doc_hash, store_dir)
+    meta_path = os.path.join(entry_dir, META_FILENAME)
+    if not os.path.exists(meta_path):
+        return None
+    with _store_lock:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        meta.update(updates)
+        _write_meta(entry_dir, meta)
+    return meta
+
+
+def get_or_create_document_entry(filename, file_content_bytes, store_dir=None):
+    """
+    Look up a document by content hash, analysing and storing it on a miss.
+
+    Returns:
+        tuple: (metadata dict, cache_hit bool)
+    """
+    doc_hash = compute_document_hash(file_content_bytes)
+    meta = load_document_entry(doc_hash, store_dir)
+    if meta is not None:
+        if filename not in meta.get("filenames", []):
+            meta = update_document_entry(doc_hash, {"filenames": meta.get("filenames", []) + [filename]}, store_dir) or meta
+        print(f"Document Store: Hit for '{filename}' ({doc_hash[:12]}, {meta.get('page_count')} pages).")
+        return meta, True
+
+    print(f"Document Store: Miss for '{filename}' ({doc_hash[:12]}). Analysing...")
+    analysis = analyze_pdf_document(filename, file_content_bytes)
+    try:
+        meta = save_document_entry(doc_hash, filename, file_content_bytes, analysis, store_dir)
+    except Exception as e:
+        # The store is an optimisation; a failed write must not fail the run
+        print(f"Document Store Warning: Could not persist '{filename}': {e}")
+        traceback.print_exc()
+        meta = {"sha256": doc_hash, "filenames": [filename], "size_bytes": len(file_content_bytes), **analysis}
+    return meta, False
+
+
+def list_document_entries(store_dir=None):
+    """Metadata (without page texts) plus on-disk size for every stored document."""
+    root = store_dir or DOCUMENT_STORE_DIR
+    if not os.path.isdir(root):
+        return []
+    entries = []
+    for doc_hash in os.listdir(root):
+        meta = load_document_entry(doc_hash, store_dir, touch=False)
+        if meta is None:
+            continue
+        meta = {k: v for k, v in meta.items() if k != "page_texts"}
+        meta["disk_bytes"] = _dir_size_bytes(_entry_dir(doc_hash, store_dir))
+        entries.append(meta)
+    return entries
+
+
+def remove_document_entry(doc_hash, store_dir=None):
+    """Delete a stored document. Returns True if something was removed."""
+    entry_dir = _entry_dir(doc_hash, store_dir)
+    if not os.path.isdir(entry_dir):
+        return False
+    with _store_lock:
+        shutil.rmtree(entry_dir, ignore_errors=True)
+    return True
+
+
+def evict_document_entries(max_bytes=None, store_dir=None, keep_hashes=()):
+    """
+    Size-based eviction: delete least-recently-used documents until the store
+    fits in `max_bytes` (defaults to DOCUMENT_STORE_MAX_MB). Documents in
+    `keep_hashes` (e.g. inputs of runs that may still resume) are never evicted.
+
+    Returns:
+        list: Hashes of the evicted documents.
+    """
+    if max_bytes is None:
+        max_bytes = DOCUMENT_STORE_MAX_MB * 1024 * 1024
+    entries = sorted(list_document_entries(store_dir), key=lambda e: e.get("last_accessed", 0))
+    total_bytes = sum(e["disk_bytes"] for e in entries)
+    evicted = []
+    for entry in entries:
+        if total_bytes <= max_bytes:
+            break
+        if entry["sha256"] in keep_hashes:
+            continue
+        if remove_document_entry(entry["sha256"], store_dir):
+            total_bytes -= entry["disk_bytes"]
+            evicted.append(entry["sha256"])
+    if evicted:
+        print(f"Document Store: Evicted {len(evicted)} documents. Store size now {total_bytes / (1024*1024):.1f} MB.")
+    return evicted
+
+
+def _resolve_prefix(prefix, store_dir=None):
+    matches = [e["sha256"] for e in list_document_entries(store_dir) if e["sha256"].startswith(prefix)]
+    if len(matches) != 1:
+        print(f"Expected exactly one document matching '{prefix}', found {len(matches)}.")
+        return None
+    return matches[0]
+
+
+def main(argv=None):
+    """Command-line entry point to inspect and prune the document store."""
+    parser = argparse.ArgumentParser(prog="python -m src.document_store", description="Inspect and prune the ProfileDash document store.")
+    parser.add_argument("--store-dir", default=None, help=f"Store directory (default: {DOCUMENT_STORE_DIR})")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="List stored documents")
+    show_parser = subparsers.add_parser("show", help="Show one document's metadata")
+    show_parser.add_argument("hash_prefix")
+    prune_parser = subparsers.add_parser("prune", help="Evict least-recently-used documents above a size limit")
+    prune_parser.add_argument("--max-mb", type=float, default=DOCUMENT_STORE_MAX_MB)
+    remove_parser = subparsers.add_parser("remove", help="Remove one document")
+    remove_parser.add_argument("hash_prefix")
+    args = parser.parse_args(argv)
+
+    if args.command == "list":
+        entries = sorted(list_document_entries(args.store_dir), key=lambda e: e.get("last_accessed", 0), reverse=True)
+        for e in entries:
+            last_used = datetime.fromtimestamp(e.get("last_accessed", 0)).strftime("%Y-%m-%d %H:%M")
+            print(f"{e['sha256'][:12]}  {e['disk_bytes'] / (1024*1024):8.1f} MB  {e.get('page_count', '?'):>4} pages  "
+                  f"{e.get('document_type', 'other'):<22} {last_used}  {', '.join(e.get('filenames', []))}")
+        total_mb = sum(e["disk_bytes"] for e in entries) / (1024*1024)
+        print(f"{len(entries)} documents, {total_mb:.1f} MB total (limit {DOCUMENT_STORE_MAX_MB} MB).")
+    elif args.command == "show":
+        doc_hash = _resolve_prefix(args.hash_prefix, args.store_dir)
+        if not doc_hash: return 1
+        meta = load_document_entry(doc_hash, args.store_dir, touch=False)
+        meta["page_texts"] = f"<{len(meta.get('page_texts') or [])} pages of text>"
+        print(json.dumps(meta, indent=2))
+    elif args.command == "prune":
+        evicted = evict_document_entries(int(args.max_mb * 1024 * 1024), args.store_dir)
+        print(f"Evicted {len(evicted)} documents.")
+    elif args.command == "remove":
+        doc_hash = _resolve_prefix(args.hash_prefix, args.store_dir)
+        if not doc_hash: return 1
+        remove_document_entry(doc_hash, args.store_dir)
+        print(f"Removed {doc_hash}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,241 @@
+"""
+Durable queue module for ProfileDash
+A SQLite-backed run queue shared by the Gradio process and any number of worker
+processes (`python -m src.worker`), on this host or others mounting the same queue
+directory. The UI process only enqueues runs and reads their status; workers claim
+runs fair-share across users, heartbeat while running, report progress back through
+the queue, and re-queue runs whose worker stopped heartbeating (the run then resumes
+from its run store checkpoint).
+
+Layout: <QUEUE_DIR>/jobs.sqlite3, <QUEUE_DIR>/uploads/<run_id>/<file>.pdf
+"""
+
+import os
+import json
+import time
+import shutil
+import socket
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from .job_queue import QueueFullError, fair_share_order, MAX_QUEUE_DEPTH, MAX_ACTIVE_RUNS_PER_USER, TYPICAL_RUN_MINUTES
+
+QUEUE_DIR = os.environ.get("PROFILEDASH_QUEUE_DIR", "queue")
+QUEUE_DB_FILENAME = "jobs.sqlite3"
+HEARTBEAT_SECONDS = 30
+STALE_AFTER_SECONDS = 180   # a running job without a heartbeat for this long is re-queued
+MAX_JOB_ATTEMPTS = 3        # claims per job before it is marked failed
+PROGRESS_MIN_INTERVAL_SECONDS = 2.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    sequence INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT UNIQUE NOT NULL,
+    user TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    submitted_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    worker_id TEXT,
+    heartbeat_at REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    progress TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+CREATE TABLE IF NOT EXISTS workers (
+    id TEXT PRIMARY KEY,
+    host TEXT,
+    pid INTEGER,
+    concurrency INTEGER,
+    heartbeat_at REAL
+);
+"""
+
+
+class DurableJobQueue:
+    """
+    Same status interface as JobQueue (user_jobs, stats, estimated_wait_minutes,
+    set_progress), but jobs are JSON payloads executed by separate worker processes.
+    """
+
+    def __init__(self, queue_dir=None, max_queue_depth=MAX_QUEUE_DEPTH, max_per_user=MAX_ACTIVE_RUNS_PER_USER,
+                 log_func=print, name="Durable Queue"):
+        self.queue_dir = queue_dir or QUEUE_DIR
+        self.db_path = os.path.join(self.queue_dir, QUEUE_DB_FILENAME)
+        self.max_queue_depth = max(0, int(max_queue_depth))
+        self.max_per_user = max(1, int(max_per_user))
+        self.log_func = log_func
+        self.name = name
+        self._local = threading.local()
+        self._last_progress = {}
+        os.makedirs(self.queue_dir, exist_ok=True)
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self):
+        # One connection per thread; autocommit mode with explicit BEGIN IMMEDIATE for writes
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    # --- UI process: submitting ---
+
+    def spool_uploads(self, run_id, file_paths):
+        """Copy uploaded files into the shared queue directory (workers may not see the UI's temp files)."""
+        spool_dir = os.path.join(self.queue_dir, "uploads", run_id)
+        os.makedirs(spool_dir, exist_ok=True)
+        spooled = []
+        for path in file_paths:
+            target = os.path.join(spool_dir, os.path.basename(path))
+            shutil.copyfile(path, target)
+            spooled.append(os.path.abspath(target))
+        return spooled
+
+    def discard_uploads(self, run_id):
+        shutil.rmtree(os.path.join(self.queue_dir, "uploads", run_id), ignore_errors=True)
+
+    def submit(self, job_id, user, payload):
+        """
+        Enqueue a run (`payload`: JSON-serialisable workflow arguments). Returns its
+        1-based position among the waiting runs. Raises QueueFullError on backpressure.
+        """
+        with self._transaction() as conn:
+            active = conn.execute("SELECT COUNT(*) FROM jobs WHERE user = ? AND status IN ('queued', 'running')", (user,)).fetchone()[0]
+            if active >= self.max_per_user:
+                raise QueueFullError(f"You already have {active} profile runs in progress or queued (limit {self.max_per_user}). "
+                                     f"Please wait for one of them to finish.")
+            waiting = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if waiting >= self.max_queue_depth:
+                raise QueueFullError(f"ProfileDash is at capacity ({waiting} runs waiting). Please try again later.")
+            conn.execute("INSERT INTO jobs (id, user, payload, status, submitted_at) VALUES (?, ?, ?, 'queued', ?)",
+                         (job_id, user, json.dumps(payload), time.time()))
+        position = self.position(job_id)
+        self.log_func(f"{self.name}: Run {job_id} for {user} queued at position {position} ({self.stats()['waiting']} waiting)")
+        return position
+
+    # --- Status ---
+
+    def _fair_order(self, conn):
+        waiting = [dict(row) for row in conn.execute("SELECT id, user, sequence, submitted_at FROM jobs WHERE status = 'queued' ORDER BY sequence")]
+        running_users = [row["user"] for row in conn.execute("SELECT user FROM jobs WHERE status = 'running'")]
+        last_started = {row["user"]: row["last"] for row in conn.execute("SELECT user, MAX(started_at) AS last FROM jobs WHERE started_at IS NOT NULL GROUP BY user")}
+        return fair_share_order(waiting, running_users, last_started)
+
+    def position(self, job_id):
+        """1-based position among the waiting runs, 0 if running, None if finished or unknown."""
+        conn = self._connection()
+        for index, job in enumerate(self._fair_order(conn)):
+            if job["id"] == job_id:
+                return index + 1
+        row = conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return 0 if row and row["status"] == "running" else None
+
+    def user_jobs(self, user):
+        """The user's active runs: id, position (0 = running), submitted_at, started_at, progress."""
+        conn = self._connection()
+        jobs = [{"id": row["id"], "position": 0, "submitted_at": row["submitted_at"], "started_at": row["started_at"], "progress": row["progress"]}
+                for row in conn.execute("SELECT * FROM jobs WHERE user = ? AND status = 'running'", (user,))]
+        jobs += [{"id": job["id"], "position": index + 1, "submitted_at": job["submitted_at"], "started_at": None, "progress": None}
+                 for index, job in enumerate(self._fair_order(conn)) if job["user"] == user]
+        return jobs
+
+    def live_capacity(self):
+        """Run slots of the workers that heartbeated recently."""
+        row = self._connection().execute("SELECT COALESCE(SUM(concurrency), 0) FROM workers WHERE heartbeat_at > ?",
+                                         (time.time() - STALE_AFTER_SECONDS,)).fetchone()
+        return int(row[0])
+
+    def stats(self):
+        conn = self._connection()
+        counts = {row["status"]: row["n"] for row in conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status")}
+        return {"running": counts.get("running", 0), "waiting": counts.get("queued", 0), "maxRunning": self.live_capacity(),
+                "maxQueueDepth": self.max_queue_depth}
+
+    def estimated_wait_minutes(self, position):
+        """Rough wait before a run at `position` starts, assuming typical run times."""
+        if not position:
+            return 0
+        return int(-(-position // max(1, self.live_capacity())) * TYPICAL_RUN_MINUTES)
+
+    # --- Worker side ---
+
+    def register_worker(self, worker_id, concurrency):
+        with self._transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO workers (id, host, pid, concurrency, heartbeat_at) VALUES (?, ?, ?, ?, ?)",
+                         (worker_id, socket.gethostname(), os.getpid(), concurrency, time.time()))
+
+    def unregister_worker(self, worker_id):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM workers WHERE id = ?", (worker_id,))
+
+    def heartbeat(self, worker_id, job_ids=()):
+        """Keep the worker and its running jobs alive."""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("UPDATE workers SET heartbeat_at = ? WHERE id = ?", (now, worker_id))
+            for job_id in job_ids:
+                conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND worker_id = ? AND status = 'running'", (now, job_id, worker_id))
+
+    def _requeue_stale(self, conn):
+        """Running jobs whose worker stopped heartbeating go back to the queue (or fail after MAX_JOB_ATTEMPTS)."""
+        cutoff = time.time() - STALE_AFTER_SECONDS
+        stale = conn.execute("SELECT id, attempts, worker_id FROM jobs WHERE status = 'running' AND heartbeat_at < ?", (cutoff,)).fetchall()
+        for row in stale:
+            if row["attempts"] >= MAX_JOB_ATTEMPTS:
+                conn.execute("UPDATE jobs SET status = 'failed', finished_at = ?, error = ? WHERE id = ?",
+                             (time.time(), f"Worker {row['worker_id']} stopped {row['attempts']} times", row["id"]))
+                self.log_func(f"{self.name}: Run {row['id']} failed: its worker stopped {row['attempts']} times.")
+            else:
+                conn.execute("UPDATE jobs SET status = 'queued', worker_id = NULL WHERE id = ?", (row["id"],))
+                self.log_func(f"{self.name}: Worker {row['worker_id']} stopped heartbeating. Re-queued run {row['id']}.")
+
+    def claim(self, worker_id):
+        """Atomically take the next job (fair-share). Returns (job_id, user, payload) or None."""
+        with self._transaction() as conn:
+            self._requeue_stale(conn)
+            order = self._fair_order(conn)
+            if not order:
+                return None
+            job = order[0]
+            now = time.time()
+            conn.execute("UPDATE jobs SET status = 'running', worker_id = ?, started_at = ?, heartbeat_at = ?, attempts = attempts + 1 WHERE id = ?",
+                         (worker_id, now, now, job["id"]))
+            payload = conn.execute("SELECT payload FROM jobs WHERE id = ?", (job["id"],)).fetchone()["payload"]
+        self.log_func(f"{self.name}: Worker {worker_id} claimed run {job['id']} for {job['user']} after {now - job['submitted_at']:.1f}s in queue.")
+        return job["id"], job["user"], json.loads(payload)
+
+    def set_progress(self, job_id, message):
+        """Latest progress line of a running job (throttled, so chatty runs do not hammer the database)."""
+        now = time.time()
+        if now - self._last_progress.get(job_id, 0.0) < PROGRESS_MIN_INTERVAL_SECONDS:
+            return
+        self._last_progress[job_id] = now
+        try:
+            with self._transaction() as conn:
+                conn.execute("UPDATE jobs SET progress = ?, heartbeat_at = ? WHERE id = ? AND status = 'running'", (str(message)[:500], now, job_id))
+        except sqlite3.Error as e:
+            print(f"{self.name} Warning: Could not record progress for run {job_id}: {e}")
+
+    def finish(self, job_id, status="done", error=None):
+        """Mark a job done or failed and remove its spooled uploads."""
+        self._last_progress.pop(job_id, None)
+        with self._transaction() as conn:
+            conn.execute("UPDATE jobs SET status = ?, finished_at = ?, error = ? WHERE id = ?", (status, time.time(), error, job_id))
+        self.discard_uploads(job_id)
@@ -53,7 +53,7 @@ def clean_llm_output(content, section_num=None, section_title=None):
         # If no section info, just return the content stripped of ```html
         return content
 
-# --- Folder/File Operations (Kept from Old Version, not used by current app.py) ---
+# --- Folder/File Operations (section files are used by run_store checkpoints) ---
 def create_profile_folder(company_name):
     """Create a unique folder for storing profile sections"""
     print("HTML Generator: create_profile_folder called (inactive in current app).")
@@ -69,17 +69,16 @@ def create_profile_folder(company_name):
         return ".", timestamp # Fallback to current directory
 
 def save_section(profile_folder, section_number, content):
-    """Save a section's HTML content to a file."""
-    print(f"HTML Generator: save_section {section_number} called (inactive in current app).")
+    """Save a section's HTML content to a file (written via a temp file, so a crash never leaves a partial section)."""
     if not isinstance(content, str): content = str(content)
     try:
         filepath = os.path.join(profile_folder, f"section_{section_number}.html")
-        with open(filepath, "w", encoding="utf-8") as f: f.write(content)
+        with open(filepath + ".tmp", "w", encoding="utf-8") as f: f.write(content)
+        os.replace(filepath + ".tmp", filepath)
     except Exception as e: print(f"HTML Generator Error saving section {section_number} to {profile_folder}: {e}")
 
 def load_section(profile_folder, section_number):
     """Load a section's HTML content from a file if it exists."""
-    print(f"HTML Generator: load_section {section_number} called (inactive in current app).")
     filepath = os.path.join(profile_folder, f"section_{section_number}.html")
     if os.path.exists(filepath):
         try:
@@ -0,0 +1,121 @@
+"""
+HTML patch module for ProfileDash
+Applies a model's list of edits to a section's HTML locally, so an improvement call only
+has to output what changes instead of re-emitting the whole section. An edit is a JSON object:
+
+    {"op": "replace" | "insert_before" | "insert_after" | "delete",
+     "find": "<exact text or HTML span of the current HTML>"   or   "id": "<element id>",
+     "html": "<new HTML>"}                                       (not needed for delete)
+
+'find' must occur exactly once (whitespace differences are tolerated); 'id' targets the
+whole element carrying that id attribute. Edits are applied in order, each to the result
+of the previous one. Any edit that does not apply cleanly rejects the whole patch
+(HtmlPatchError), and the caller falls back to a full rewrite.
+"""
+
+import re
+import json
+
+PATCH_OPS = ("replace", "insert_before", "insert_after", "delete")
+VOID_ELEMENTS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+
+
+class HtmlPatchError(ValueError):
+    """A patch that cannot be parsed or does not apply cleanly."""
+
+
+def parse_html_patch(text):
+    """
+    The edit list in a model response (a JSON array, optionally inside a code fence).
+
+    Returns:
+        list: The edits, each validated for its op and anchor.
+    """
+    text = (text or "").strip()
+    start, end = text.find("["), text.rfind("]")
+    if start == -1 or end < start:
+        raise HtmlPatchError("No JSON edit list in the response.")
+    try:
+        edits = json.loads(text[start:end + 1])
+    except ValueError as e:
+        raise HtmlPatchError(f"Unreadable edit list: {e}")
+    if not isinstance(edits, list):
+        raise HtmlPatchError("The edit list is not a JSON array.")
+    for index, edit in enumerate(edits, start=1):
+        if not isinstance(edit, dict) or edit.get("op") not in PATCH_OPS:
+            raise HtmlPatchError(f"Edit {index}: op must be one of {', '.join(PATCH_OPS)}.")
+        if not (isinstance(edit.get("find"), str) and edit["find"].strip()) and not (isinstance(edit.get("id"), str) and edit["id"].strip()):
+            raise HtmlPatchError(f"Edit {index}: needs a non-empty 'find' span or an element 'id'.")
+        if edit["op"] != "delete" and not isinstance(edit.get("html"), str):
+            raise HtmlPatchError(f"Edit {index}: '{edit['op']}' needs the new 'html'.")
+    return edits
+
+
+def _find_span(html, find):
+    """(start, end) of the single occurrence of `find` in html, tolerating whitespace differences."""
+    count = html.count(find)
+    if count == 1:
+        start = html.index(find)
+        return start, start + len(find)
+    if count == 0:
+        # Whitespace in the span matches any whitespace; tag boundaries may gain or lose it
+        tokens = [token for token in re.split(r"(\s+|(?=<)|(?<=>))", find.strip()) if token]
+        parts = []
+        for index, token in enumerate(tokens):
+            if token.isspace():
+                at_tag = (index and tokens[index - 1].endswith(">")) or (index + 1 < len(tokens) and tokens[index + 1].startswith("<"))
+                parts.append(r"\s*" if at_tag else r"\s+")
+            else:
+                if index and not tokens[index - 1].isspace():
+                    parts.append(r"\s*")
+                parts.append(re.escape(token))
+        pattern = "".join(parts)
+        matches = list(re.finditer(pattern, html)) if pattern else []
+        if len(matches) == 1:
+            return matches[0].span()
+        count = len(matches)
+    raise HtmlPatchError(f"'find' span occurs {count} times (must be exactly once): {find[:80]!r}")
+
+
+def _find_element(html, element_id):
+    """(start, end) of the whole element carrying id=element_id."""
+    openings = list(re.finditer(rf"<([a-zA-Z][\w-]*)\b[^>]*\bid\s*=\s*[\"']{re.escape(element_id)}[\"'][^>]*>", html))
+    if len(openings) != 1:
+        raise HtmlPatchError(f"Element id {element_id!r} occurs {len(openings)} times (must be exactly once).")
+    opening = openings[0]
+    tag = opening.group(1).lower()
+    if tag in VOID_ELEMENTS or opening.group(0).endswith("/>"):
+        return opening.span()
+    depth = 1
+    for tag_match in re.finditer(rf"<(/?){tag}\b[^>]*>", html[opening.end():], re.IGNORECASE):
+        depth += -1 if tag_match.group(1) else 1
+        if depth == 0:
+            return opening.start(), opening.end() + tag_match.end()
+    raise HtmlPatchError(f"Element id {element_id!r} is not closed.")
+
+
+def apply_html_patch(html, edits):
+    """
+    Apply `edits` (see parse_html_patch) to html in order.
+
+    Returns:
+        str: The patched HTML (unchanged for an empty edit list).
+
+    Raises:
+        HtmlPatchError: If any edit's anchor is missing or ambiguous.
+    """
+    for index, edit in enumerate(edits, start=1):
+        try:
+            start, end = _find_element(html, edit["id"]) if edit.get("id") else _find_span(html, edit["find"])
+        except HtmlPatchError as e:
+            raise HtmlPatchError(f"Edit {index} ({edit['op']}): {e}")
+        new_html = edit.get("html") or ""
+        if edit["op"] == "replace":
+            html = html[:start] + new_html + html[end:]
+        elif edit["op"] == "insert_before":
+            html = html[:start] + new_html + html[start:]
+        elif edit["op"] == "insert_after":
+            html = html[:end] + new_html + html[end:]
+        else:
+            html = html[:start] + html[end:]
+    return html
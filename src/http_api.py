@@ -0,0 +1,205 @@
+"""
+HTTP API module for ProfileDash
+A small REST API for internal tools, mounted next to the Gradio UI in the same
+server. Runs submitted here go through the same job queue, limits and PDF
+validation as the UI; requests return immediately (no Gradio worker is held) and
+clients poll for status.
+
+    POST /api/runs                    multipart: files (PDFs), email[, sections, base_run_id, force_regenerate, sla_minutes] -> 202 {run_id, queue_position}
+    POST /api/runs/{run_id}/regenerate   form: email[, sections, mode] -> 202 {run_id, queue_position}
+    GET  /api/runs/{run_id}           status, queue position, latest log line, per-section step
+    GET  /api/runs/{run_id}/initial   initial profile HTML (404 until ready)
+    GET  /api/runs/{run_id}/refined   refined profile HTML (404 until ready)
+
+Every request needs 'Authorization: Bearer <token>' with a token from
+PROFILEDASH_API_TOKENS (comma-separated); without tokens the API is disabled.
+"""
+
+import os
+import uuid
+import shutil
+import secrets
+import tempfile
+from typing import List, Optional
+
+from fastapi import FastAPI, APIRouter, Depends, File, Form, Header, HTTPException, UploadFile
+from fastapi.responses import HTMLResponse, JSONResponse
+
+from .job_queue import QueueFullError
+from .pdf_validation import validate_pdf_files, format_validation_errors
+from .run_store import load_run_meta, load_run_profile
+from .section_definitions import sections, section_groups
+from .section_dag import select_sections, parse_section_selection
+from .background_processor import REFINEMENT_STEPS
+
+API_TOKENS = [token.strip() for token in os.environ.get("PROFILEDASH_API_TOKENS", "").split(",") if token.strip()]
+SECTION_STEPS = ["initial"] + REFINEMENT_STEPS + ["refined"]
+STEPS_COMPLETED = {**{step: index + 1 for index, step in enumerate(SECTION_STEPS)}, "merged_improve": len(SECTION_STEPS) - 1, "consistency_improve": len(SECTION_STEPS) - 1}
+MAX_FILES_PER_RUN = 20
+
+
+def http_api_enabled():
+    return bool(API_TOKENS)
+
+
+def _require_token(authorization: str = Header(default="")):
+    """Bearer token check (constant-time comparison)."""
+    token = authorization[7:].strip() if authorization.lower().startswith("bearer ") else ""
+    if not API_TOKENS:
+        raise HTTPException(status_code=503, detail="The HTTP API is disabled (PROFILEDASH_API_TOKENS is not set).")
+    if not any(secrets.compare_digest(token, allowed) for allowed in API_TOKENS):
+        raise HTTPException(status_code=401, detail="Missing or invalid API token.")
+
+
+def _section_progress(meta):
+    """Per-section step and counts from a run's checkpoint metadata."""
+    progress = (meta or {}).get("sections", {})
+    section_states = []
+    for section_def in select_sections(sections, (meta or {}).get("sectionNumbers")):
+        state = progress.get(str(section_def["number"]))
+        section_states.append({
+            "number": section_def["number"], "title": section_def["title"],
+            "step": state["step"] if state else None,
+            "stepsCompleted": STEPS_COMPLETED.get(state["step"], 0) if state else 0,
+            "failed": bool(state and state["failed"]),
+        })
+    return {
+        "sections": section_states,
+        "sectionsInitialDone": sum(1 for s in section_states if s["stepsCompleted"] >= 1),
+        "sectionsRefined": sum(1 for s in section_states if s["step"] == "refined"),
+        "stepsPerSection": len(SECTION_STEPS),
+    }
+
+
+def parse_sections_field(value):
+    """Section numbers from a 'sections' form field ("7,8,9", "15-18", "financials"); [] if empty."""
+    try:
+        return parse_section_selection(value, sections, section_groups) if value else []
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+def create_job_api(submit_run, is_email_permitted, job_queue, max_upload_bytes, log_event_func=None, regenerate_run=None):
+    """
+    Build the FastAPI app.
+
+    Args:
+        submit_run (callable): submit_run(run_id, user_email, file_paths) -> queue position;
+                               raises QueueFullError on backpressure (same path as the UI).
+        is_email_permitted (callable): email -> bool (same rules as the UI login).
+        job_queue: JobQueue or DurableJobQueue (queue position and progress).
+        max_upload_bytes (int): Per-file size limit of uploads.
+        log_event_func (callable): Optional log_event_func(user_email, event_dict).
+        regenerate_run (callable): Optional regenerate_run(run_id, user_email, section_numbers, mode)
+                                   -> (new run id, queue position); enables /regenerate.
+    """
+    router = APIRouter(prefix="/api", dependencies=[Depends(_require_token)])
+
+    def log_event(user_email, event):
+        if log_event_func:
+            try: log_event_func(user_email, event)
+            except Exception as log_e: print(f"HTTP API: Error logging {event.get('event')}: {log_e}")
+
+    @router.post("/runs", status_code=202)
+    def submit_profile_run(email: str = Form(...), files: List[UploadFile] = File(...), sections: str = Form(""), base_run_id: str = Form(""),
+                           force_regenerate: bool = Form(False), sla_minutes: Optional[float] = Form(None)):
+        if not email or "@" not in email or not is_email_permitted(email):
+            raise HTTPException(status_code=403, detail="Email address is not authorized.")
+        section_numbers = parse_sections_field(sections)
+        if sla_minutes is not None and sla_minutes < 0:
+            raise HTTPException(status_code=422, detail="sla_minutes must be 0 (no deadline) or positive.")
+        base_meta = load_run_meta(base_run_id) if base_run_id else None
+        if base_run_id and (base_meta is None or base_meta.get("userEmail") != email):
+            raise HTTPException(status_code=404, detail=f"Base run {base_run_id} not found for {email}.")
+        pdf_files = [f for f in files if f.filename and f.filename.lower().endswith(".pdf")]
+        if not pdf_files or len(pdf_files) > MAX_FILES_PER_RUN:
+            raise HTTPException(status_code=422, detail=f"Upload between 1 and {MAX_FILES_PER_RUN} PDF files.")
+        run_id = str(uuid.uuid4())
+        upload_dir = tempfile.mkdtemp(prefix=f"profiledash_api_{run_id[:8]}_")
+        file_paths = []
+        for upload in pdf_files:
+            path = os.path.join(upload_dir, os.path.basename(upload.filename))
+            with open(path, "wb") as f:
+                shutil.copyfileobj(upload.file, f)
+            if os.path.getsize(path) > max_upload_bytes:
+                shutil.rmtree(upload_dir, ignore_errors=True)
+                raise HTTPException(status_code=413, detail=f"{upload.filename} exceeds {max_upload_bytes // (1024*1024)} MB.")
+            file_paths.append(path)
+
+        validation_results = validate_pdf_files(file_paths)
+        validation_error = format_validation_errors(validation_results)
+        if validation_error:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+            log_event(email, {"event": "RunRejected", "runId": run_id, "reason": "PDFValidation", "source": "api",
+                              "errors": {r["filename"]: r["errors"] for r in validation_results if not r["ok"]}})
+            raise HTTPException(status_code=422, detail=validation_error)
+        try:
+            queue_position = submit_run(run_id, email, file_paths, section_numbers=section_numbers or None, base_run_id=base_run_id or None,
+                                        force_regenerate=force_regenerate, sla_minutes=sla_minutes)
+        except QueueFullError as queue_full_e:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+            log_event(email, {"event": "RunRejected", "runId": run_id, "reason": "QueueFull", "source": "api", "queue": job_queue.stats()})
+            return JSONResponse(status_code=429, content={"detail": str(queue_full_e)}, headers={"Retry-After": "300"})
+        print(f"HTTP API: Run {run_id} submitted for {email} ({len(file_paths)} files, queue position {queue_position}).")
+        log_event(email, {"event": "RunSubmitted", "runId": run_id, "source": "api", "queuePosition": queue_position})
+        return {"run_id": run_id, "status": "queued" if queue_position else "running", "queue_position": queue_position,
+                "status_url": f"/api/runs/{run_id}"}
+
+    @router.post("/runs/{run_id}/regenerate", status_code=202)
+    def regenerate_sections(run_id: str, email: str = Form(...), sections: str = Form(""), mode: str = Form("generate")):
+        if regenerate_run is None:
+            raise HTTPException(status_code=404, detail="Regeneration is not available.")
+        if not email or "@" not in email or not is_email_permitted(email):
+            raise HTTPException(status_code=403, detail="Email address is not authorized.")
+        try:
+            new_run_id, queue_position = regenerate_run(run_id, email, parse_sections_field(sections) or None, mode)
+        except QueueFullError as queue_full_e:
+            return JSONResponse(status_code=429, content={"detail": str(queue_full_e)}, headers={"Retry-After": "300"})
+        except ValueError as regen_e:
+            raise HTTPException(status_code=409, detail=str(regen_e))
+        print(f"HTTP API: Run {new_run_id} regenerates sections of run {run_id} for {email} ({mode}).")
+        return {"run_id": new_run_id, "parent_run_id": run_id, "status": "queued" if queue_position else "running",
+                "queue_position": queue_position, "status_url": f"/api/runs/{new_run_id}"}
+
+    @router.get("/runs/{run_id}")
+    def run_status(run_id: str):
+        meta = load_run_meta(run_id)
+        queued = next((job for job in job_queue.user_jobs((meta or {}).get("userEmail", "")) if job["id"] == run_id), None) if meta else None
+        if meta is None:
+            position = job_queue.position(run_id)
+            if position is None:
+                raise HTTPException(status_code=404, detail="Unknown run id.")
+            queued = {"position": position, "progress": None}
+        status = (meta or {}).get("status", "queued")
+        if queued is not None:
+            status = "queued" if queued["position"] else "running"
+        return {
+            "run_id": run_id,
+            "status": status,  # queued | running | completed | failed
+            "queue_position": queued["position"] if queued and queued["position"] else None,
+            "latest_log": queued.get("progress") if queued else None,
+            "company_name": (meta or {}).get("companyName"),
+            "initial_email_sent": bool((meta or {}).get("initialEmailSent")),
+            "section_numbers": (meta or {}).get("sectionNumbers"),
+            "regeneration": (meta or {}).get("regeneration"),
+            "delta": (meta or {}).get("delta"),
+            "run_cache_hit": bool((meta or {}).get("runCache", {}).get("hit")),
+            "sla": (meta or {}).get("sla"),
+            "degradation": (meta or {}).get("degradation"),
+            "initial_ready": load_run_profile(run_id, "initial") is not None,
+            "refined_ready": load_run_profile(run_id, "refined") is not None,
+            **_section_progress(meta),
+        }
+
+    @router.get("/runs/{run_id}/{kind}", response_class=HTMLResponse)
+    def run_profile(run_id: str, kind: str):
+        if kind not in ("initial", "refined"):
+            raise HTTPException(status_code=404, detail="Use /initial or /refined.")
+        profile_html = load_run_profile(run_id, kind)
+        if profile_html is None:
+            raise HTTPException(status_code=404, detail=f"The {kind} profile of run {run_id} is not ready (or the run is unknown).")
+        return HTMLResponse(profile_html)
+
+    api = FastAPI(title="ProfileDash API", docs_url="/api/docs", openapi_url="/api/openapi.json")
+    api.include_router(router)
+    return api
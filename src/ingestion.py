@@ -0,0 +1,77 @@
+"""
+Ingestion module for ProfileDash
+Reads, validates, hashes, analyses (via the document store) and base64-encodes
+uploaded files concurrently on a bounded pool, so the per-file work is no longer
+serialized on the critical path before the first section starts.
+"""
+
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .pdf_validation import validate_pdf_file
+from .document_store import get_or_create_document_entry
+from .document_processor import encode_document_part
+
+INGEST_MAX_WORKERS = 4
+
+
+def ingest_document(file_path):
+    """
+    Full per-file ingestion: validate -> read -> hash/store lookup (text extraction
+    on a miss) -> base64 encode.
+
+    Returns:
+        dict: filename, path, ok, error, warnings, content (bytes), size, entry (store
+              metadata), store_hit, document (API part) and duration_s.
+    """
+    start = time.time()
+    filename = os.path.basename(file_path)
+    result = {"filename": filename, "path": file_path, "ok": False, "error": None, "warnings": [],
+              "content": None, "size": 0, "entry": None, "store_hit": False, "document": None, "duration_s": 0.0}
+    try:
+        validation = validate_pdf_file(file_path)
+        result["warnings"] = validation["warnings"]
+        if not validation["ok"]:
+            result["error"] = "; ".join(validation["errors"])
+            return result
+        with open(file_path, 'rb') as f:
+            result["content"] = f.read()
+        result["size"] = len(result["content"])
+        result["entry"], result["store_hit"] = get_or_create_document_entry(filename, result["content"])
+        result["document"] = encode_document_part(result["content"])
+        result["ok"] = True
+    except Exception as e:
+        print(f"Ingestion Error processing '{filename}': {type(e).__name__} - {e}")
+        traceback.print_exc()
+        result["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        result["duration_s"] = round(time.time() - start, 2)
+    return result
+
+
+def ingest_documents(file_paths, max_workers=INGEST_MAX_WORKERS, on_document_ready=None):
+    """
+    Ingest several files concurrently.
+
+    Args:
+        file_paths (list): Paths of uploaded files (None entries are ignored).
+        max_workers (int): Pool size bound.
+        on_document_ready (callable): Called with each result as soon as that file finishes.
+
+    Returns:
+        list: Ingestion results in upload order (failed files included with ok=False).
+    """
+    file_paths = [p for p in (file_paths or []) if p]
+    if not file_paths:
+        return []
+    results = {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(file_paths))) as executor:
+        future_to_path = {executor.submit(ingest_document, path): path for path in file_paths}
+        for future in as_completed(future_to_path):
+            result = future.result()  # ingest_document never raises
+            results[future_to_path[future]] = result
+            if on_document_ready:
+                on_document_ready(result)
+    return [results[path] for path in file_paths]
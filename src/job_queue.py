@@ -0,0 +1,167 @@
+"""
+Job queue module for ProfileDash
+One process-wide queue for profile runs. At most MAX_CONCURRENT_RUNS runs execute
+at a time (each with its own section worker pool), the next run is picked fair-share
+across users (fewest running runs first, then least recently served) and new runs
+are rejected once the queue is too deep, instead of every click starting its own
+thread and all runs competing for the same API quota.
+"""
+
+import os
+import time
+import itertools
+import threading
+import traceback
+
+MAX_CONCURRENT_RUNS = int(os.environ.get("PROFILEDASH_MAX_CONCURRENT_RUNS", "2"))
+MAX_QUEUE_DEPTH = int(os.environ.get("PROFILEDASH_MAX_QUEUE_DEPTH", "10"))  # waiting runs, all users
+MAX_ACTIVE_RUNS_PER_USER = 3   # running + waiting runs of one user
+TYPICAL_RUN_MINUTES = 15       # only used for the wait estimate shown to users
+
+
+class QueueFullError(Exception):
+    """Raised by JobQueue.submit() when a run cannot be accepted (backpressure)."""
+
+
+def fair_share_order(waiting, running_users, last_started):
+    """
+    Waiting jobs (dicts with 'user' and 'sequence') in the order they would start:
+    per pick, the user with the fewest running runs, then the least recently served
+    user (`last_started`: user -> time), then submission order.
+    """
+    running_per_user = {}
+    for user in running_users:
+        running_per_user[user] = running_per_user.get(user, 0) + 1
+    last_started = dict(last_started)
+    waiting, order = list(waiting), []
+    while waiting:
+        job = min(waiting, key=lambda j: (running_per_user.get(j["user"], 0), last_started.get(j["user"], 0.0), j["sequence"]))
+        waiting.remove(job)
+        order.append(job)
+        running_per_user[job["user"]] = running_per_user.get(job["user"], 0) + 1
+        last_started[job["user"]] = time.time() + len(order)  # served after everyone already counted
+    return order
+
+
+class JobQueue:
+    """
+    Bounded fair-share run queue. Jobs are plain callables run on daemon threads;
+    a finished job (successful or not) frees its slot for the next waiting one.
+    """
+
+    def __init__(self, max_running=MAX_CONCURRENT_RUNS, max_queue_depth=MAX_QUEUE_DEPTH,
+                 max_per_user=MAX_ACTIVE_RUNS_PER_USER, log_func=print, name="Job Queue"):
+        self.max_running = max(1, int(max_running))
+        self.max_queue_depth = max(0, int(max_queue_depth))
+        self.max_per_user = max(1, int(max_per_user))
+        self.log_func = log_func
+        self.name = name
+        self._lock = threading.Lock()
+        self._sequence = itertools.count()
+        self._waiting = []        # job dicts in submission order
+        self._running = {}        # job_id -> job dict
+        self._last_started = {}   # user -> time their most recent run started
+
+    # --- Submitting ---
+
+    def submit(self, job_id, user, func, *args, **kwargs):
+        """
+        Queue a run. Returns its 1-based position among the waiting runs (0 if it
+        started immediately). Raises QueueFullError if the queue is at capacity or
+        the user already has the maximum number of active runs.
+        """
+        with self._lock:
+            active = sum(1 for job in list(self._running.values()) + self._waiting if job["user"] == user)
+            if active >= self.max_per_user:
+                raise QueueFullError(f"You already have {active} profile runs in progress or queued (limit {self.max_per_user}). "
+                                     f"Please wait for one of them to finish.")
+            if len(self._running) >= self.max_running and len(self._waiting) >= self.max_queue_depth:
+                raise QueueFullError(f"ProfileDash is at capacity ({len(self._running)} runs in progress, "
+                                     f"{len(self._waiting)} waiting). Please try again later.")
+            self._waiting.append({"id": job_id, "user": user, "func": func, "args": args, "kwargs": kwargs,
+                                  "sequence": next(self._sequence), "submitted_at": time.time(), "started_at": None, "progress": None})
+            self._dispatch()
+            position = self._position(job_id)
+        self.log_func(f"{self.name}: Run {job_id} for {user} {'started' if not position else f'queued at position {position}'} "
+                      f"({len(self._running)} running, {len(self._waiting)} waiting)")
+        return position
+
+    # --- Dispatching (called with the lock held) ---
+
+    def _fair_order(self):
+        return fair_share_order(self._waiting, [job["user"] for job in self._running.values()], self._last_started)
+
+    def _dispatch(self):
+        while self._waiting and len(self._running) < self.max_running:
+            job = self._fair_order()[0]
+            self._waiting.remove(job)
+            job["started_at"] = time.time()
+            self._running[job["id"]] = job
+            self._last_started[job["user"]] = job["started_at"]
+            threading.Thread(target=self._run_job, args=(job,), daemon=True).start()
+
+    def _position(self, job_id):
+        for index, job in enumerate(self._fair_order()):
+            if job["id"] == job_id:
+                return index + 1
+        return 0 if job_id in self._running else None
+
+    def _run_job(self, job):
+        wait_s = job["started_at"] - job["submitted_at"]
+        self.log_func(f"{self.name}: Starting run {job['id']} for {job['user']} after {wait_s:.1f}s in queue")
+        try:
+            job["func"](*job["args"], **job["kwargs"])
+        except Exception as e:
+            self.log_func(f"{self.name}: Run {job['id']} raised {type(e).__name__} - {e}")
+            traceback.print_exc()
+        finally:
+            with self._lock:
+                self._running.pop(job["id"], None)
+                self._dispatch()
+            self.log_func(f"{self.name}: Run {job['id']} finished after {time.time() - job['started_at']:.1f}s "
+                          f"({len(self._running)} running, {len(self._waiting)} waiting)")
+
+    # --- Status ---
+
+    def position(self, job_id):
+        """1-based position among the waiting runs, 0 if running, None if finished or unknown."""
+        with self._lock:
+            return self._position(job_id)
+
+    def set_progress(self, job_id, message):
+        """Latest progress line of a running job (shown to its user)."""
+        job = self._running.get(job_id)
+        if job is not None:
+            job["progress"] = str(message)[:500]
+
+    def user_jobs(self, user):
+        """The user's active runs as dicts: id, position (0 = running), submitted_at, started_at, progress."""
+        with self._lock:
+            order = self._fair_order()
+            jobs = [{"id": job["id"], "position": 0, "submitted_at": job["submitted_at"], "started_at": job["started_at"], "progress": job["progress"]}
+                    for job in self._running.values() if job["user"] == user]
+            jobs += [{"id": job["id"], "position": index + 1, "submitted_at": job["submitted_at"], "started_at": None, "progress": None}
+                     for index, job in enumerate(order) if job["user"] == user]
+        return jobs
+
+    def stats(self):
+        with self._lock:
+            return {"running": len(self._running), "waiting": len(self._waiting), "maxRunning": self.max_running,
+                    "maxQueueDepth": self.max_queue_depth}
+
+    def estimated_wait_minutes(self, position):
+        """Rough wait before a run at `position` starts, assuming typical run times."""
+        if not position:
+            return 0
+        return int(-(-position // self.max_running) * TYPICAL_RUN_MINUTES)
+
+
+def queue_status_message(job_queue, user, run_id=None):
+    """Status text for a user's queued runs (None if none of their runs is waiting)."""
+    waiting = [job for job in job_queue.user_jobs(user) if job["position"] and (run_id is None or job["id"] == run_id)]
+    if not waiting:
+        return None
+    job = min(waiting, key=lambda j: j["position"])
+    return (f"Your profile run is queued at position {job['position']} "
+            f"(estimated start in about {job_queue.estimated_wait_minutes(job['position'])} mins). "
+            f"It will start automatically and the profile will be emailed to {user} upon completion. You can close this window now.")
@@ -0,0 +1,169 @@
+"""
+Latency history module for ProfileDash
+Keeps a persistent record of how long each section step took (per model, document
+size bucket, step kind and section) and turns it into expected durations, so the
+scheduler can start the longest section chains first instead of in definition order.
+"""
+
+import os
+import json
+import threading
+import statistics
+
+LATENCY_HISTORY_FILE = os.environ.get("PROFILEDASH_LATENCY_HISTORY", "latency_history.json")
+MAX_SAMPLES_PER_KEY = 50          # most recent samples kept per (model, size, kind, section)
+MIN_RECORDED_LATENCY_SECONDS = 2.0 # shorter calls were API cache hits (real calls are paced >= 1.5s)
+# Upper bounds (estimated input tokens) of the document size buckets
+SIZE_BUCKETS = [(50_000, "<50k"), (150_000, "50k-150k"), (400_000, "150k-400k"), (800_000, "400k-800k")]
+# Priors used until a step has history: typical seconds per call
+DEFAULT_LATENCY_SECONDS = {
+    "initial": 60.0, "fact_critique": 30.0, "fact_improve": 60.0, "insight_critique": 30.0,
+    "insight_improve": 60.0, "merged_improve": 75.0, "consistency_improve": 60.0, "map": 30.0, "reduce": 45.0,
+}
+SECTION_CHAIN = ["initial", "fact_critique", "fact_improve", "insight_critique", "insight_improve"]
+# Merged refinement mode: the fact and insight critiques run in parallel, so one critique is on the critical path
+MERGED_SECTION_CHAIN = ["initial", "fact_critique", "merged_improve"]
+# Profile refinement mode: one whole-profile review (not a per-section step), then at most one improvement
+PROFILE_SECTION_CHAIN = ["initial", "consistency_improve"]
+
+_history = None
+_history_lock = threading.Lock()
+
+
+def _load_history():
+    global _history
+    if _history is None:
+        _history = {}
+        if os.path.exists(LATENCY_HISTORY_FILE):
+            try:
+                with open(LATENCY_HISTORY_FILE, "r") as f:
+                    _history = json.load(f)
+                print(f"Latency History: Loaded {len(_history)} keys from {LATENCY_HISTORY_FILE}")
+            except Exception as e:
+                print(f"Latency History Warning: Could not load {LATENCY_HISTORY_FILE}. Error: {e}")
+                _history = {}
+    return _history
+
+
+def size_bucket(total_tokens):
+    """Document size bucket label for an estimated input token count."""
+    if total_tokens is None:
+        return "unknown"
+    for upper_bound, label in SIZE_BUCKETS:
+        if total_tokens < upper_bound:
+            return label
+    return ">800k"
+
+
+def _history_key(model_name, bucket, kind, section_num):
+    return f"{model_name}|{bucket}|{kind}|{section_num}"
+
+
+def record_latency(model_name, bucket, kind, section_num, seconds):
+    """Add one sample (in memory; call save_latency_history() to persist)."""
+    if seconds < MIN_RECORDED_LATENCY_SECONDS:
+        return False
+    with _history_lock:
+        samples = _load_history().setdefault(_history_key(model_name, bucket, kind, section_num), [])
+        samples.append(round(seconds, 2))
+        del samples[:-MAX_SAMPLES_PER_KEY]
+    return True
+
+
+def save_latency_history():
+    """Atomically write the history file."""
+    with _history_lock:
+        history = _load_history()
+        try:
+            temp_path = f"{LATENCY_HISTORY_FILE}.tmp"
+            with open(temp_path, "w") as f:
+                json.dump(history, f)
+            os.replace(temp_path, LATENCY_HISTORY_FILE)
+            print(f"Latency History: Saved {len(history)} keys to {LATENCY_HISTORY_FILE}")
+        except Exception as e:
+            print(f"Latency History Warning: Failed to save {LATENCY_HISTORY_FILE}: {e}")
+
+
+def _percentile(samples, percentile):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(percentile / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def latency_percentiles(model_name, bucket, kind, section_num):
+    """p50/p95 and sample count for one key, or None without history."""
+    with _history_lock:
+        samples = list(_load_history().get(_history_key(model_name, bucket, kind, section_num), []))
+    if not samples:
+        return None
+    return {"p50": _percentile(samples, 50), "p95": _percentile(samples, 95), "samples": len(samples)}
+
+
+def record_scheduler_latencies(scheduler, model_name, bucket):
+    """
+    Record the duration of every successful API task of a finished scheduler run.
+    Task keys: ("initial", n), ("refine", n, step), ("map", n, chunk_id), ("reduce", n).
+    Returns the number of samples recorded.
+    """
+    recorded = 0
+    for key, seconds in list(scheduler.durations.items()):
+        if scheduler.error(key) is not None:
+            continue
+        if key[0] in ("initial", "map", "reduce"):
+            kind, section_num = key[0], key[1]
+        elif key[0] == "refine":
+            kind, section_num = key[2], key[1]
+        else:
+            continue
+        recorded += record_latency(model_name, bucket, kind, section_num, seconds)
+    return recorded
+
+
+class LatencyEstimator:
+    """
+    Expected step durations for one run (model + document size bucket). Falls back
+    from the exact key to the same section in other size buckets, then to the kind's
+    median across sections, then to a prior scaled by the section's spec length.
+    """
+
+    def __init__(self, model_name, total_tokens, chain=SECTION_CHAIN):
+        self.model_name = model_name
+        self.bucket = size_bucket(total_tokens)
+        self.chain = chain
+        with _history_lock:
+            self._history = {key: list(samples) for key, samples in _load_history().items()}
+
+    def _samples(self, bucket, kind, section_num):
+        prefix = f"{self.model_name}|"
+        matches = []
+        for key, samples in self._history.items():
+            if not key.startswith(prefix):
+                continue
+            _, key_bucket, key_kind, key_section = key.split("|")
+            if key_kind == kind and (bucket is None or key_bucket == bucket) and (section_num is None or key_section == str(section_num)):
+                matches.extend(samples)
+        return matches
+
+    def expected(self, kind, section_def):
+        """Expected (p50) seconds for one step of one section."""
+        section_num = section_def["number"]
+        for bucket, section in ((self.bucket, section_num), (None, section_num), (self.bucket, None)):
+            samples = self._samples(bucket, kind, section)
+            if samples:
+                return statistics.median(samples)
+        spec_weight = min(2.0, max(0.5, len(section_def.get("specs", "")) / 1500))
+        return DEFAULT_LATENCY_SECONDS.get(kind, 60.0) * spec_weight
+
+    def remaining(self, section_def, from_kind, observed_ratio=1.0):
+        """
+        Expected seconds left in a section's chain, starting with `from_kind`
+        (a step of the run's chain, or "map"/"reduce" for map-reduce initial generation).
+        `observed_ratio` (actual/expected so far this run) scales the estimate.
+        """
+        if from_kind == "map":
+            kinds = ["map", "reduce"] + self.chain[1:]
+        elif from_kind == "reduce":
+            kinds = ["reduce"] + self.chain[1:]
+        else: # a step off the chain (the parallel insight critique) is as far along as the fact critique
+            kinds = self.chain[self.chain.index(from_kind if from_kind in self.chain else "fact_critique"):]
+        return sum(self.expected(kind, section_def) for kind in kinds) * observed_ratio
@@ -0,0 +1,215 @@
+"""
+Map-reduce generation module for ProfileDash
+For document sets larger than the inline upload cap or the model context window:
+documents are split into page-range chunks, every section runs a per-chunk
+extraction ("map") call, and the section HTML is written by a "reduce" call over
+the compact extractions only.
+"""
+
+import io
+import base64
+import traceback
+
+try:
+    from pypdf import PdfReader, PdfWriter
+except ImportError:
+    PdfReader = PdfWriter = None
+
+from .api_client import cached_generate_content
+from .document_processor import estimate_document_tokens
+from .section_processor import build_section_instruction, finalize_section_html, check_response_usable
+
+# Switch to map-reduce above this many estimated input tokens (model context is ~1M,
+# leaving room for the prompt and output) or above the inline upload cap.
+MAP_REDUCE_TOKEN_THRESHOLD = 800_000
+# Per-chunk budgets: small enough for fast calls, large enough to keep call counts sane.
+MAP_REDUCE_CHUNK_TOKENS = 200_000
+MAP_REDUCE_CHUNK_MAX_PAGES = 120
+# Hard ceiling on the aggregate upload even in map-reduce mode.
+MAP_REDUCE_MAX_TOTAL_BYTES = 250 * 1024 * 1024
+NO_RELEVANT_CONTENT = "NO RELEVANT CONTENT"
+
+
+def map_reduce_available():
+    return PdfReader is not None
+
+
+def needs_map_reduce(total_bytes, total_tokens, max_upload_bytes):
+    """True if the document set cannot be sent inline in a single call."""
+    return total_bytes > max_upload_bytes or total_tokens > MAP_REDUCE_TOKEN_THRESHOLD
+
+
+def _write_page_range(reader, first_page, last_page):
+    writer = PdfWriter()
+    for page_index in range(first_page, last_page + 1):
+        writer.add_page(reader.pages[page_index])
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+def split_document_into_chunks(filename, file_content_bytes, page_texts, max_chunk_bytes):
+    """
+    Split one PDF into contiguous page ranges that each fit the per-chunk token
+    budget and `max_chunk_bytes`.
+
+    Returns:
+        list: Chunk dicts with filename, first_page/last_page (1-based), page_texts and
+              'document' (the API part: {'mime_type': 'application/pdf', 'data': base64}).
+    """
+    reader = PdfReader(io.BytesIO(file_content_bytes))
+    page_count = len(reader.pages)
+    page_texts = page_texts if page_texts and len(page_texts) == page_count else [""] * page_count
+
+    # Greedy page ranges by token estimate, then split further if the written PDF is too big
+    ranges = []
+    start = 0; tokens = 0
+    for page_index in range(page_count):
+        page_tokens = estimate_document_tokens(1, [page_texts[page_index]])
+        if page_index > start and (tokens + page_tokens > MAP_REDUCE_CHUNK_TOKENS or page_index - start >= MAP_REDUCE_CHUNK_MAX_PAGES):
+            ranges.append((start, page_index - 1)); start = page_index; tokens = 0
+        tokens += page_tokens
+    ranges.append((start, page_count - 1))
+
+    chunks = []
+    while ranges:
+        first_page, last_page = ranges.pop(0)
+        chunk_bytes = _write_page_range(reader, first_page, last_page)
+        if len(chunk_bytes) > max_chunk_bytes and last_page > first_page:
+            middle = (first_page + last_page) // 2
+            ranges[0:0] = [(first_page, middle), (middle + 1, last_page)]
+            continue
+        if len(chunk_bytes) > max_chunk_bytes:
+            print(f"Map-Reduce Warning: Page {first_page + 1} of '{filename}' alone exceeds the chunk size limit; sending it anyway.")
+        chunks.append({
+            "filename": filename,
+            "first_page": first_page + 1,
+            "last_page": last_page + 1,
+            "page_texts": page_texts[first_page:last_page + 1],
+            "document": {'mime_type': 'application/pdf', 'data': base64.standard_b64encode(chunk_bytes).decode("utf-8")},
+        })
+    return chunks
+
+
+def split_documents_into_chunks(uploaded_data, document_entries, max_chunk_bytes):
+    """Chunk every uploaded document. Returns a flat list of chunks with 'chunk_id' set."""
+    chunks = []
+    for filename, file_content_bytes in uploaded_data.items():
+        page_texts = (document_entries.get(filename) or {}).get("page_texts")
+        try:
+            chunks.extend(split_document_into_chunks(filename, file_content_bytes, page_texts, max_chunk_bytes))
+        except Exception as e:
+            print(f"Map-Reduce Error: Could not split '{filename}' into chunks: {type(e).__name__} - {e}")
+            traceback.print_exc()
+    for chunk_id, chunk in enumerate(chunks, start=1):
+        chunk["chunk_id"] = chunk_id
+    print(f"Map-Reduce: Split {len(uploaded_data)} documents into {len(chunks)} chunks.")
+    return chunks
+
+
+def extract_section_from_chunk(section, chunk, total_chunks, persona, model):
+    """Map step: compact, source-referenced notes from one chunk relevant to one section."""
+    section_num = section["number"]
+    instruction = f"""
+{persona}
+
+You are reading PART {chunk['chunk_id']} of {total_chunks} of the source documents: "{chunk['filename']}", pages {chunk['first_page']}-{chunk['last_page']} of that document.
+The first page of this part is page {chunk['first_page']} of the original document; cite original page numbers.
+
+TASK: Extract everything in this part that is relevant to section {section_num}: "{section['title']}" of a company profile.
+
+SECTION SPECIFICATIONS:
+{section['specs']}
+
+Output compact plain-text notes, no HTML and no commentary:
+- One bullet per fact: figures with units and the exact time period or date they relate to.
+- Verbatim quotes only where material, in quotation marks.
+- End every bullet with [Source: {chunk['filename']}, Page X].
+If this part contains nothing relevant to the section, output exactly: {NO_RELEVANT_CONTENT}
+"""
+    response = cached_generate_content(model, [instruction, chunk["document"]], section_num=section_num, cache_enabled=True, timeout=300)
+    check_response_usable(response, section_num)
+    return (response.text or "").replace("```", "").strip()
+
+
+def format_extractions(section, extractions):
+    """Concatenate per-chunk notes in document order, skipping empty parts."""
+    parts = []
+    for chunk, notes in extractions:
+        if not notes or notes.strip().upper().startswith(NO_RELEVANT_CONTENT):
+            continue
+        parts.append(f"### {chunk['filename']}, pages {chunk['first_page']}-{chunk['last_page']}\n{notes}")
+    return "\n\n".join(parts)
+
+
+def reduce_section(section, extraction_notes, persona, analysis_specs, output_format, model):
+    """Reduce step: write the section HTML from the combined extraction notes (no documents attached)."""
+    section_num = section["number"]
+    section_title = section["title"]
+    instruction = build_section_instruction(
+        section, persona, analysis_specs, output_format,
+        source_description="the EXTRACTED NOTES below, which were compiled page by page from all provided documents (keep their source references)"
+    )
+    instruction += f"\nEXTRACTED NOTES FOR SECTION {section_num}:\n{extraction_notes or 'No relevant information was found in the documents.'}\n"
+    try:
+        response = cached_generate_content(model, instruction, section_num=section_num, cache_enabled=True, timeout=300)
+        check_response_usable(response, section_num)
+        return section_num, finalize_section_html(response.text, section_num, section_title)
+    except TimeoutError as e:
+        print(f"Map-Reduce: TIMEOUT reducing Section {section_num}: {e}")
+        return section_num, f'<div class="section" id="section-{section_num}"><h2>{section_num}. {section_title}</h2><p class="error">ERROR: Processing timed out for section {section_num}.</p></div>'
+    except Exception as e:
+        print(f"Map-Reduce: ERROR reducing Section {section_num}: {type(e).__name__} - {e}")
+        traceback.print_exc()
+        return section_num, f'<div class="section" id="section-{section_num}"><h2>{section_num}. {section_title}</h2><p class="error">ERROR: Could not generate initial content: {type(e).__name__}</p></div>'
+
+
+def _reduce_from_extractions(scheduler, section, chunks, persona, analysis_specs, output_format, model):
+    """Reduce task body: collect this section's map results from the scheduler and write the section."""
+    section_num = section["number"]
+    extractions = []
+    for chunk in chunks:
+        map_key = ("map", section_num, chunk["chunk_id"])
+        error = scheduler.error(map_key)
+        if error is not None:
+            print(f"Map-Reduce: S{section_num} extraction failed for {chunk['filename']} pages {chunk['first_page']}-{chunk['last_page']}: {type(error).__name__} - {error}")
+            notes = f"[Extraction failed for {chunk['filename']}, pages {chunk['first_page']}-{chunk['last_page']}]"
+        else:
+            notes = scheduler.result(map_key, "")
+        extractions.append((chunk, notes))
+    extraction_notes = format_extractions(section, extractions)
+    _, section_html = reduce_section(section, extraction_notes, persona, analysis_specs, output_format, model)
+    return section_html, extraction_notes
+
+
+def add_map_reduce_tasks(scheduler, section_defs, chunks, persona, analysis_specs, output_format, model, on_section_done, priority=0, priority_func=None, log_func=print):
+    """
+    Queue map (section x chunk) and reduce (per section) tasks on a TaskScheduler.
+    A section's reduce task depends on its extraction tasks, so it starts as soon as
+    its own last extraction finishes.
+
+    Args:
+        on_section_done (callable): Called as on_section_done(section, html, extraction_notes)
+                                    on the scheduler thread when a section's reduce finishes.
+        priority_func (callable): Optional priority_func(section, "map"|"reduce") overriding `priority`.
+    """
+    total_chunks = len(chunks)
+    for section in section_defs:
+        section_num = section["number"]
+        map_keys = []
+        for chunk in chunks:
+            map_key = ("map", section_num, chunk["chunk_id"])
+            scheduler.add_task(map_key, extract_section_from_chunk, section, chunk, total_chunks, persona, model,
+                               priority=priority_func(section, "map") if priority_func else priority)
+            map_keys.append(map_key)
+
+        def reduce_done(key, result, error, section=section):
+            if error is not None:
+                section_html = f'<div class="section" id="section-{section["number"]}"><h2>{section["number"]}. {section["title"]}</h2><p class="error">ERROR: Generation process failed unexpectedly: {error}</p></div>'
+                on_section_done(section, section_html, "")
+            else:
+                on_section_done(section, *result)
+
+        scheduler.add_task(("reduce", section_num), _reduce_from_extractions, scheduler, section, chunks, persona, analysis_specs, output_format, model,
+                           deps=map_keys, priority=priority_func(section, "reduce") if priority_func else priority + 1, on_complete=reduce_done)
+    log_func(f"Map-reduce: {len(section_defs) * total_chunks} extraction tasks queued ({len(section_defs)} sections x {total_chunks} chunks).")
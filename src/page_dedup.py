@@ -0,0 +1,229 @@
+"""
+Page deduplication module for ProfileDash
+Fingerprints pages across the uploaded documents (word shingles + bottom-k MinHash)
+and drops near-duplicate pages from the older document, keeping the more recent copy.
+"""
+
+import io
+import os
+import re
+import hashlib
+import traceback
+from collections import defaultdict
+from datetime import date
+
+try:
+    from pypdf import PdfReader, PdfWriter
+except ImportError:
+    PdfReader = PdfWriter = None
+
+from .document_processor import TOKENS_PER_PDF_PAGE, CHARS_PER_TOKEN
+
+PAGE_DEDUP_ENABLED = os.environ.get("PROFILEDASH_PAGE_DEDUP", "1") != "0"
+SHINGLE_SIZE = 5            # words per shingle
+SKETCH_SIZE = 64            # bottom-k MinHash sketch size
+SIMILARITY_THRESHOLD = 0.85 # estimated Jaccard similarity above which pages count as duplicates
+MIN_PAGE_CHARS = 400        # shorter pages (covers, dividers, image-only) are never dropped
+MIN_SHARED_HASHES = 8       # sketch values two pages must share to be compared at all
+
+MONTHS = {m: i for i, m in enumerate(["january", "february", "march", "april", "may", "june", "july",
+                                       "august", "september", "october", "november", "december"], start=1)}
+
+
+def _normalize_text(text):
+    return re.sub(r'\s+', ' ', re.sub(r'[^\w%.,$€£-]+', ' ', text.lower())).strip()
+
+
+def page_sketch(text, shingle_size=SHINGLE_SIZE, sketch_size=SKETCH_SIZE):
+    """Bottom-k MinHash sketch (sorted tuple of the k smallest shingle hashes) of a page's text."""
+    words = _normalize_text(text).split()
+    if len(words) < shingle_size:
+        return ()
+    hashes = {
+        int.from_bytes(hashlib.blake2b(" ".join(words[i:i + shingle_size]).encode("utf-8"), digest_size=8).digest(), "big")
+        for i in range(len(words) - shingle_size + 1)
+    }
+    return tuple(sorted(hashes)[:sketch_size])
+
+
+def estimate_similarity(sketch_a, sketch_b, sketch_size=SKETCH_SIZE):
+    """Estimate Jaccard similarity of two pages from their bottom-k sketches."""
+    if not sketch_a or not sketch_b:
+        return 0.0
+    union_sketch = sorted(set(sketch_a) | set(sketch_b))[:sketch_size]
+    shared = set(sketch_a) & set(sketch_b)
+    return sum(1 for h in union_sketch if h in shared) / len(union_sketch)
+
+
+def estimate_document_date(filename, page_texts=None):
+    """
+    Best-effort "as of" date of a document: the latest full date on its first
+    pages, else the latest year in its filename or first pages. Returns a
+    date or None.
+    """
+    candidates = []
+    text = " ".join((page_texts or [])[:2]).lower()[:8000]
+    month_pattern = "|".join(MONTHS)
+    for day, month, year in re.findall(rf'\b(\d{{1,2}})\s+({month_pattern})\s+(20\d\d)\b', text):
+        candidates.append((int(year), MONTHS[month], int(day)))
+    for month, day, year in re.findall(rf'\b({month_pattern})\s+(\d{{1,2}}),?\s+(20\d\d)\b', text):
+        candidates.append((int(year), MONTHS[month], int(day)))
+    valid = []
+    for year, month, day in candidates:
+        try: valid.append(date(year, month, day))
+        except ValueError: pass
+    if valid:
+        return max(valid)
+
+    years = [int(y) for y in re.findall(r'(?<!\d)(20\d\d)(?!\d)', filename)] or \
+            [int(y) for y in re.findall(r'(?<!\d)(20\d\d)(?!\d)', text)]
+    return date(max(years), 12, 31) if years else None
+
+
+def build_reduced_pdf(file_content_bytes, keep_pages):
+    """Write a new PDF containing only the 0-based page indexes in `keep_pages`."""
+    reader = PdfReader(io.BytesIO(file_content_bytes))
+    writer = PdfWriter()
+    for page_index in keep_pages:
+        writer.add_page(reader.pages[page_index])
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+def find_duplicate_pages(documents, threshold=SIMILARITY_THRESHOLD):
+    """
+    Find pages of older documents that are near-duplicates of pages in more recent ones.
+
+    Args:
+        documents (list): Dicts with 'filename', 'page_texts' and 'recency' (sortable,
+                          larger = more recent), in upload order.
+
+    Returns:
+        dict: filename -> {page_index: (kept_filename, kept_page_index, similarity)}
+    """
+    sketches = {}
+    index = defaultdict(list)
+    for doc_pos, doc in enumerate(documents):
+        for page_index, text in enumerate(doc["page_texts"]):
+            if len(text.strip()) < MIN_PAGE_CHARS:
+                continue
+            sketch = page_sketch(text)
+            if not sketch:
+                continue
+            sketches[(doc_pos, page_index)] = sketch
+            for h in sketch:
+                index[h].append((doc_pos, page_index))
+
+    # Candidate pairs share enough sketch values; only pairs across documents count
+    shared_counts = defaultdict(int)
+    for pages in index.values():
+        if len(pages) > 50:  # boilerplate shingles (headers/footers) carry no signal
+            continue
+        for i in range(len(pages)):
+            for j in range(i + 1, len(pages)):
+                if pages[i][0] != pages[j][0]:
+                    shared_counts[(pages[i], pages[j]) if pages[i] < pages[j] else (pages[j], pages[i])] += 1
+
+    duplicates = defaultdict(dict)
+    for (page_a, page_b), shared in sorted(shared_counts.items()):
+        if shared < MIN_SHARED_HASHES:
+            continue
+        similarity = estimate_similarity(sketches[page_a], sketches[page_b])
+        if similarity < threshold:
+            continue
+        # Drop the copy in the older document (later upload wins ties)
+        recency_a = (documents[page_a[0]]["recency"], page_a[0])
+        recency_b = (documents[page_b[0]]["recency"], page_b[0])
+        older, newer = (page_a, page_b) if recency_a < recency_b else (page_b, page_a)
+        older_name = documents[older[0]]["filename"]
+        newer_name = documents[newer[0]]["filename"]
+        existing = duplicates[older_name].get(older[1])
+        if existing is None or similarity > existing[2]:
+            duplicates[older_name][older[1]] = (newer_name, newer[1], round(similarity, 3))
+
+    # Point chains (oldest -> older -> newest) at the copy that actually survives
+    for dropped in duplicates.values():
+        for page_index, (kept_name, kept_page, similarity) in list(dropped.items()):
+            seen = set()
+            while kept_page in duplicates.get(kept_name, {}) and (kept_name, kept_page) not in seen:
+                seen.add((kept_name, kept_page))
+                kept_name, kept_page, _ = duplicates[kept_name][kept_page]
+            dropped[page_index] = (kept_name, kept_page, similarity)
+    return dict(duplicates)
+
+
+def deduplicate_uploaded_documents(uploaded_data, document_entries, threshold=SIMILARITY_THRESHOLD):
+    """
+    Drop near-duplicate pages across the uploaded set, keeping the most recent copy.
+
+    Args:
+        uploaded_data (dict): filename -> PDF bytes (upload order preserved).
+        document_entries (dict): filename -> document store metadata (needs 'page_texts').
+
+    Returns:
+        tuple: (reduced uploaded_data dict, dedup report dict). On any problem the
+               original uploaded_data is returned unchanged with the reason in the report.
+    """
+    report = {"enabled": True, "threshold": threshold, "pages_dropped": 0, "tokens_saved_estimate": 0, "documents": []}
+    if PdfReader is None:
+        report.update(enabled=False, reason="pypdf not installed")
+        return uploaded_data, report
+
+    documents = []
+    for filename in uploaded_data:
+        page_texts = (document_entries.get(filename) or {}).get("page_texts")
+        if not page_texts:
+            continue
+        doc_date = estimate_document_date(filename, page_texts)
+        documents.append({"filename": filename, "page_texts": page_texts,
+                          "recency": doc_date.toordinal() if doc_date else 0,
+                          "as_of": doc_date.isoformat() if doc_date else None})
+    if len(documents) < 2:
+        report.update(enabled=False, reason="fewer than two documents with extractable text")
+        return uploaded_data, report
+
+    duplicates = find_duplicate_pages(documents, threshold)
+    reduced_data = dict(uploaded_data)
+    for doc in documents:
+        filename = doc["filename"]
+        dropped = duplicates.get(filename, {})
+        page_count = len(doc["page_texts"])
+        doc_report = {"filename": filename, "as_of": doc["as_of"], "pages_total": page_count,
+                      "pages_dropped": 0, "dropped_pages": []}
+        report["documents"].append(doc_report)
+        if not dropped:
+            continue
+        keep_pages = [i for i in range(page_count) if i not in dropped]
+        if not keep_pages:
+            continue  # never drop a whole document
+        try:
+            reduced_data[filename] = build_reduced_pdf(uploaded_data[filename], keep_pages)
+        except Exception as e:
+            print(f"Page Dedup Warning: Could not rebuild '{filename}' without duplicate pages: {e}")
+            traceback.print_exc()
+            continue
+        doc_report["pages_dropped"] = len(dropped)
+        doc_report["dropped_pages"] = [
+            {"page": page_index + 1, "duplicate_of": {"filename": kept_name, "page": kept_page + 1}, "similarity": similarity}
+            for page_index, (kept_name, kept_page, similarity) in sorted(dropped.items())
+        ]
+        report["pages_dropped"] += len(dropped)
+        report["tokens_saved_estimate"] += sum(
+            TOKENS_PER_PDF_PAGE + len(doc["page_texts"][i]) // CHARS_PER_TOKEN for i in dropped)
+
+    print(f"Page Dedup: Dropped {report['pages_dropped']} near-duplicate pages "
+          f"(~{report['tokens_saved_estimate']} tokens per call).")
+    return reduced_data, report
+
+
+def format_dedup_report(report):
+    """One line per document, for the run log."""
+    if not report.get("enabled"):
+        return [f"Page dedup skipped: {report.get('reason', 'disabled')}"]
+    lines = [f"Page dedup: {report['pages_dropped']} pages dropped, ~{report['tokens_saved_estimate']} input tokens saved per call."]
+    for doc in report["documents"]:
+        if doc["pages_dropped"]:
+            sources = sorted({d["duplicate_of"]["filename"] for d in doc["dropped_pages"]})
+            lines.append(f"  {doc['filename']} (as of {doc['as_of'] or 'unknown'}): dropped {doc['pages_dropped']}/{doc['pages_total']} pages, kept in {', '.join(sources)}")
+    return lines
@@ -0,0 +1,208 @@
+"""
+PDF validation module for ProfileDash
+Fast, local structural checks run on every upload before any API call is made:
+magic bytes, cross-reference table, encryption, page count, text coverage and
+embedded fonts. Files are checked in parallel; each check takes milliseconds.
+"""
+
+import io
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+from .document_processor import count_pdf_pages
+
+VALIDATION_MAX_WORKERS = 4
+TEXT_SAMPLE_PAGES = 6          # pages sampled (spread across the file) for text coverage
+MIN_PAGE_TEXT_CHARS = 50       # a sampled page with less text counts as image-only
+REJECT_IMAGE_ONLY_PDFS = True  # scanned PDFs without a text layer give poor profiles
+STANDARD_14_FONTS = {
+    "Helvetica", "Helvetica-Bold", "Helvetica-Oblique", "Helvetica-BoldOblique",
+    "Times-Roman", "Times-Bold", "Times-Italic", "Times-BoldItalic",
+    "Courier", "Courier-Bold", "Courier-Oblique", "Courier-BoldOblique", "Symbol", "ZapfDingbats",
+}
+
+
+def _check_xref(data):
+    """
+    Locate the last startxref and check it points at a classic xref table or an
+    xref stream. Returns an error string, or None if the structure looks sound.
+    """
+    startxref_matches = list(re.finditer(rb'startxref\s+(\d+)', data[-4096:]))
+    if not startxref_matches:
+        return "no 'startxref' marker found near the end of the file"
+    offset = int(startxref_matches[-1].group(1))
+    if offset <= 0 or offset >= len(data):
+        return f"startxref points outside the file (offset {offset}, size {len(data)})"
+
+    head = data[offset:offset + 64]
+    if head.startswith(b'xref'):
+        # Classic table: subsection headers "start count" followed by 20-byte entries
+        position = offset + 4
+        entries_checked = 0
+        while True:
+            header = re.match(rb'\s*(\d+)\s+(\d+)[ \t]*\r?\n', data[position:position + 64])
+            if not header:
+                break
+            count = int(header.group(2))
+            position += header.end()
+            table = data[position:position + count * 20]
+            entries = re.findall(rb'\d{10} \d{5} [nf]', table)
+            if len(entries) != count:
+                return f"cross-reference table is damaged ({len(entries)} of {count} entries readable)"
+            position += count * 20
+            entries_checked += count
+        if entries_checked == 0 or not re.match(rb'\s*trailer', data[position:position + 64]):
+            return "cross-reference table has no valid entries or trailer"
+        return None
+    if re.match(rb'\s*\d+\s+\d+\s+obj', head) and b'/XRef' in data[offset:offset + 2048]:
+        return None  # cross-reference stream (PDF 1.5+)
+    return f"startxref offset {offset} does not point at a cross-reference table"
+
+
+def _sample_indexes(page_count, sample_size):
+    if page_count <= sample_size:
+        return list(range(page_count))
+    step = page_count / sample_size
+    return sorted({int(i * step) for i in range(sample_size)})
+
+
+def validate_pdf_file(file_path):
+    """
+    Run all structural checks on one file.
+
+    Returns:
+        dict: filename, ok (bool), errors (list of actionable messages), warnings,
+              page_count, encrypted, text_coverage (0-1 or None), embedded_fonts, duration_ms.
+    """
+    start = time.time()
+    filename = os.path.basename(file_path) if file_path else "Unknown"
+    result = {"filename": filename, "ok": False, "errors": [], "warnings": [], "page_count": None,
+              "encrypted": False, "text_coverage": None, "embedded_fonts": None, "duration_ms": 0}
+
+    def finish():
+        result["ok"] = not result["errors"]
+        result["duration_ms"] = round((time.time() - start) * 1000, 1)
+        return result
+
+    if not file_path or not os.path.exists(file_path):
+        result["errors"].append("File not found. Please upload it again.")
+        return finish()
+    if not filename.lower().endswith(".pdf"):
+        result["errors"].append("Not a .pdf file. Only PDF documents are supported.")
+        return finish()
+    with open(file_path, "rb") as f:
+        data = f.read()
+    if not data:
+        result["errors"].append("File is empty. Please re-export it and upload again.")
+        return finish()
+
+    # 1. Magic bytes (a few writers put junk before the header, so allow 1 KB)
+    if b'%PDF-' not in data[:1024]:
+        result["errors"].append("Not a valid PDF (missing %PDF header). It may be a renamed Word/image file; export it to PDF again.")
+        return finish()
+    if b'%%EOF' not in data[-2048:]:
+        result["warnings"].append("No %%EOF marker at the end; the file may be truncated.")
+
+    # 2. Cross-reference table
+    xref_error = _check_xref(data)
+    if xref_error:
+        # Many viewers (and pypdf) can rebuild a broken xref, so only fail if parsing fails below
+        result["warnings"].append(f"Damaged structure: {xref_error}.")
+
+    # 3. Encryption
+    result["encrypted"] = bool(re.search(rb'/Encrypt\s', data[-8192:]) or re.search(rb'/Encrypt\s+\d+\s+\d+\s+R', data))
+
+    reader = None
+    if PdfReader is not None:
+        try:
+            reader = PdfReader(io.BytesIO(data), strict=False)
+            if reader.is_encrypted:
+                result["encrypted"] = True
+                if not reader.decrypt(""):
+                    result["errors"].append("PDF is password-protected. Remove the password (e.g. print/save as a new PDF) and upload again.")
+                    return finish()
+                result["warnings"].append("PDF is encrypted with an owner password only; it can be read.")
+        except Exception as e:
+            if result["encrypted"]:
+                result["errors"].append(f"PDF uses unsupported encryption ({type(e).__name__}). Remove the protection (e.g. print/save as a new PDF) and upload again.")
+            else:
+                result["errors"].append(f"PDF could not be parsed ({type(e).__name__}); the file is corrupt. Re-download or re-export it and upload again.")
+            return finish()
+    elif result["encrypted"]:
+        result["errors"].append("PDF is encrypted. Remove the password (e.g. print/save as a new PDF) and upload again.")
+        return finish()
+
+    # 4. Page count
+    try:
+        result["page_count"] = len(reader.pages) if reader is not None else count_pdf_pages(data)
+    except Exception as e:
+        result["errors"].append(f"Page tree is unreadable ({type(e).__name__}); the file is corrupt. Re-export it and upload again.")
+        return finish()
+    if not result["page_count"]:
+        result["errors"].append("PDF has no pages.")
+        return finish()
+
+    # 5. Text coverage and 6. embedded fonts (sampled pages only, to stay fast)
+    if reader is not None:
+        sampled = _sample_indexes(result["page_count"], TEXT_SAMPLE_PAGES)
+        pages_with_text = 0
+        has_fonts = False
+        embedded = False
+        for page_index in sampled:
+            try:
+                page = reader.pages[page_index]
+                if len((page.extract_text() or "").strip()) >= MIN_PAGE_TEXT_CHARS:
+                    pages_with_text += 1
+                fonts = (page.get("/Resources") or {}).get("/Font") or {}
+                for font_ref in fonts.values():
+                    font = font_ref.get_object()
+                    if str(font.get("/BaseFont", "")).lstrip("/") in STANDARD_14_FONTS:
+                        continue  # viewers always have these; they are never embedded
+                    has_fonts = True
+                    descriptor = font.get("/FontDescriptor")
+                    if descriptor is None and font.get("/DescendantFonts"):
+                        descriptor = font["/DescendantFonts"][0].get_object().get("/FontDescriptor")
+                    if descriptor is not None and any(key in descriptor.get_object() for key in ("/FontFile", "/FontFile2", "/FontFile3")):
+                        embedded = True
+            except Exception:
+                continue
+        result["text_coverage"] = round(pages_with_text / len(sampled), 2) if sampled else 0.0
+        result["embedded_fonts"] = embedded
+        if pages_with_text == 0:
+            message = "PDF appears to be scanned/image-only (no extractable text on sampled pages). Run OCR on it (e.g. 'Save as searchable PDF') and upload again."
+            (result["errors"] if REJECT_IMAGE_ONLY_PDFS else result["warnings"]).append(message)
+        elif result["text_coverage"] < 0.5:
+            result["warnings"].append(f"Only {int(result['text_coverage'] * 100)}% of sampled pages have extractable text; scanned pages will be analysed less reliably.")
+        if has_fonts and not embedded:
+            result["warnings"].append("No embedded fonts found; text may be extracted with wrong characters.")
+    else:
+        result["embedded_fonts"] = bool(re.search(rb'/FontFile[23]?\s', data))
+
+    return finish()
+
+
+def validate_pdf_files(file_paths, max_workers=VALIDATION_MAX_WORKERS):
+    """Validate several files in parallel. Returns results in input order."""
+    file_paths = [p for p in (file_paths or []) if p]
+    if not file_paths:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(file_paths))) as executor:
+        return list(executor.map(validate_pdf_file, file_paths))
+
+
+def format_validation_errors(results):
+    """User-facing message listing every file that failed validation (empty string if none)."""
+    failed = [r for r in results if not r["ok"]]
+    if not failed:
+        return ""
+    lines = [f"{len(failed)} of {len(results)} file(s) cannot be processed:"]
+    for r in failed:
+        lines.extend(f"- {r['filename']}: {error}" for error in r["errors"])
+    return "\n".join(lines)
@@ -1,14 +1,118 @@
 """
 Refinement module for ProfileDash
-Handles both fact-checking and insight refinement for generated content.
+Handles both fact-checking and insight refinement for generated content, either as
+four sequential steps or as two critiques plus one merged improvement. Improvements
+either rewrite the section or return an edit list applied locally (html_patch.py).
 """
+import os
+import re
+import json
 import traceback
 # Use relative imports consistently
-from .api_client import cached_generate_content, create_fact_model, create_insight_model
+from .api_client import cached_generate_content, evict_cached_response, create_fact_model, create_insight_model
 from .html_generator import repair_html, clean_llm_output, validate_html
+from .document_processor import CHARS_PER_TOKEN
+from .html_patch import parse_html_patch, apply_html_patch, HtmlPatchError
 # Prompts needed if this module is activated
 from .prompts import persona, output_format
 
+# Every critique ends with a machine-readable verdict line; an improvement call is only
+# worth making when the verdict says the draft needs changes.
+VERDICT_INSTRUCTION = (
+    "\nFinally, end your critique with exactly one line of the form:\n"
+    'VERDICT: {"issue_count": <number of issues raised>, "severity": "none" | "minor" | "major", "no_change_needed": true | false}\n'
+    'Set "no_change_needed" to true only if the draft needs no revision at all.'
+)
+VERDICT_PATTERN = re.compile(r"^\s*\**VERDICT\**:\s*(\{.*\})\s*$", re.MULTILINE | re.IGNORECASE)
+SEVERITIES = ("none", "minor", "major")
+# Placeholders used when a critique comes back empty: nothing for an improvement to address
+EMPTY_CRITIQUE_PREFIXES = ("Critique: No factual inaccuracies found", "Critique: No specific insight improvements suggested")
+# What the insight critique sees besides the section and its spec. It judges depth and reasoning
+# and assumes the facts are correct (the fact critique checks them against the documents), so by
+# default it gets no documents: 'none', 'digest' (compact document outline, see
+# build_document_digest) or 'documents' (the full document set, as before).
+INSIGHT_CRITIQUE_CONTEXTS = ("none", "digest", "documents")
+INSIGHT_CRITIQUE_CONTEXT = os.environ.get("PROFILEDASH_INSIGHT_CRITIQUE_CONTEXT", "none")
+# How an improvement call returns its revision: 'rewrite' re-emits the whole section HTML;
+# 'patch' returns a JSON edit list (html_patch.py) applied locally to the previous HTML, which
+# keeps output tokens small for long, table-heavy sections. A patch that does not apply cleanly
+# falls back to a full rewrite (one extra call).
+IMPROVEMENT_OUTPUTS = ("rewrite", "patch")
+IMPROVEMENT_OUTPUT = os.environ.get("PROFILEDASH_IMPROVEMENT_OUTPUT", "rewrite")
+REWRITE_OUTPUT_INSTRUCTION = "Output *only* the revised HTML for the section, adhering to the original HTML requirements."
+PATCH_OUTPUT_INSTRUCTION = (
+    "OUTPUT FORMAT FOR THIS REVISION: do NOT output the whole section. Output *only* a JSON array of edits "
+    "that turn the 'Original Draft Answer' into the revised answer, for example:\n"
+    '[{"op": "replace", "find": "<td>12.3</td>", "html": "<td>12.8</td>"},\n'
+    ' {"op": "insert_after", "find": "<p>Revenue grew 5% in FY2023.</p>", "html": "<p>The increase was driven by ...</p>"},\n'
+    ' {"op": "delete", "find": "<li>Unsupported claim.</li>"}]\n'
+    '"op" is one of replace, insert_before, insert_after, delete. "find" must be copied verbatim from the draft and '
+    "occur in it exactly once (include enough surrounding text to make it unique); alternatively use \"id\" to target "
+    "the whole element with that id attribute. \"html\" is the new HTML; it follows the HTML rules above for the elements "
+    "it contains (the section wrapper and header stay as they are). Edits are applied in order. Output [] if nothing needs to change."
+)
+
+
+def parse_critique_verdict(critique_text):
+    """
+    Split a critique into its structured verdict and the critique text without the verdict line.
+
+    Returns:
+        tuple: ({'issueCount', 'severity', 'noChangeNeeded', 'parsed'}, critique text). Without a
+               readable verdict line, the critique counts as needing changes (unless it is empty).
+    """
+    critique_text = critique_text or ""
+    matches = list(VERDICT_PATTERN.finditer(critique_text))
+    verdict = {"issueCount": None, "severity": None, "noChangeNeeded": critique_text.startswith(EMPTY_CRITIQUE_PREFIXES), "parsed": False}
+    if not matches:
+        return verdict, critique_text.strip()
+    body = (critique_text[:matches[-1].start()] + critique_text[matches[-1].end():]).strip()
+    try:
+        raw = json.loads(matches[-1].group(1))
+        issue_count = int(raw.get("issue_count")) if raw.get("issue_count") is not None else None
+        severity = str(raw.get("severity", "")).lower() if str(raw.get("severity", "")).lower() in SEVERITIES else None
+        no_change = raw.get("no_change_needed") is True or (raw.get("no_change_needed") is None and (issue_count == 0 or severity == "none"))
+        # A verdict contradicting itself (issues listed, yet 'no change') is treated as needing changes
+        if no_change and ((issue_count or 0) > 0 and severity not in (None, "none")):
+            no_change = False
+        verdict.update(issueCount=issue_count, severity=severity, noChangeNeeded=no_change, parsed=True)
+    except (ValueError, TypeError, AttributeError) as e:
+        print(f"Refinement Warning: Unreadable critique verdict ({e}). Treating the critique as needing changes.")
+    return verdict, body
+
+
+def estimate_input_tokens(parts, pdf_tokens=0):
+    """Rough input tokens of a call: text parts by length, plus the run's document estimate if PDFs are attached."""
+    text_tokens = sum(len(part) for part in parts if isinstance(part, str)) // CHARS_PER_TOKEN
+    return text_tokens + (pdf_tokens if any(isinstance(part, dict) for part in parts) else 0)
+
+def patch_improvement(model, instruction, answer, documents, section_num=None, section_title=None, label="Refinement", outcome=None):
+    """
+    Ask for a revision as an edit list (PATCH_OUTPUT_INSTRUCTION) and apply it to `answer` locally.
+
+    Returns:
+        tuple: (response_object, patched_html), or None if the call failed or the patch did not
+               apply cleanly (the caller then asks for a full rewrite). outcome (dict), if given,
+               gets 'patch' ('applied' or 'fallback') plus 'edits' or 'reason'.
+    """
+    prompt = f"{persona}\n{instruction}\n{output_format}\n{PATCH_OUTPUT_INSTRUCTION}"
+    response = None
+    try:
+        print(f"{label}: Generating patch for section {section_num}...")
+        response = cached_generate_content(model, [prompt] + documents, section_num)
+        edits = parse_html_patch(getattr(response, "text", None))
+        patched_html = repair_html(apply_html_patch(answer, edits), section_num, section_title)
+        if not validate_html(patched_html):
+            raise HtmlPatchError("the patched HTML failed validation")
+    except Exception as e:
+        print(f"{label} Warning: Patch for section {section_num} not applied ({e}). Falling back to a full rewrite.")
+        if response is not None: evict_cached_response(model, [prompt] + documents) # a rerun would replay the same broken patch
+        if outcome is not None: outcome.update(patch="fallback", reason=str(e)[:200])
+        return None
+    print(f"{label}: Applied {len(edits)} edits to section {section_num}.")
+    if outcome is not None: outcome.update(patch="applied", edits=len(edits))
+    return response, patched_html
+
 # --- Fact Refinement Functions ---
 
 def get_fact_critique(initial_instruction, answer, documents):
@@ -21,7 +125,7 @@ def get_fact_critique(initial_instruction, answer, documents):
         documents (list): The list of document parts (base64) for context.
 
     Returns:
-        tuple: (critique_response, critique_text)
+        tuple: (critique_response, critique_text); the text ends with a VERDICT line (see parse_critique_verdict)
     """
     instruction = (
         f"Context: {initial_instruction}\n"
@@ -31,6 +135,7 @@ def get_fact_critique(initial_instruction, answer, documents):
         "Identify specific gaps towards the initial instructions. Identify statements in the draft that are unsupported or contradicted by the documents. "
         "Do not critique style or insight unless it relates to factual accuracy."
         "Output only the critique text."
+        f"{VERDICT_INSTRUCTION}"
     )
 
     prompt = f"{persona}\n{instruction}"
@@ -55,7 +160,7 @@ def get_fact_critique(initial_instruction, answer, documents):
     return fact_critique_response, fact_critique_text
 
 
-def fact_improvement_response(initial_instruction, answer, fact_critique_text, documents, section_num=None, section_title=None):
+def fact_improvement_response(initial_instruction, answer, fact_critique_text, documents, section_num=None, section_title=None, output_mode=None, outcome=None):
     """
     Generate an improved answer based on fact critique.
 
@@ -66,6 +171,8 @@ def fact_improvement_response(initial_instruction, answer, fact_critique_text, d
         documents (list): The list of document parts (base64) for context.
         section_num: Section number.
         section_title: Section title.
+        output_mode: 'rewrite' or 'patch' (default IMPROVEMENT_OUTPUT).
+        outcome (dict): If given, records how a patch went (see patch_improvement).
 
     Returns:
         tuple: (response_object, cleaned_repaired_html_text)
@@ -79,12 +186,14 @@ def fact_improvement_response(initial_instruction, answer, fact_critique_text, d
         "Do NOT change the style or structure significantly unless required to fix a factual error. "
         "Ensure the revised answer remains grounded in the provided documents."
         "Do not reduce the amount of data or information in the original answer unless required to fix a factual error."
-        "Output *only* the revised HTML for the section, adhering to the original HTML requirements."
     )
 
-    prompt = f"{persona}\n{instruction}\n{output_format}"
+    prompt = f"{persona}\n{instruction}{REWRITE_OUTPUT_INSTRUCTION}\n{output_format}"
     improved_input = [prompt] + documents
     fact_model = create_fact_model()
+    if (output_mode or IMPROVEMENT_OUTPUT) == "patch":
+        patched = patch_improvement(fact_model, instruction, answer, documents, section_num, section_title, "Fact Refinement", outcome)
+        if patched: return patched
 
     fact_improvement_response = None
     fact_improvement_text_raw = ""
@@ -118,30 +227,44 @@ def fact_improvement_response(initial_instruction, answer, fact_critique_text, d
 
 # --- Insight Refinement Functions ---
 
-def get_insight_critique(initial_instruction, answer, documents):
+def get_insight_critique(initial_instruction, answer, documents=None, digest=None):
     """
     Generate an insight critique for the given answer.
 
     Args:
         initial_instruction: The original instruction/question for the section.
         answer: The answer content to be critiqued (HTML expected).
-        documents (list): The list of document parts (base64) for context.
+        documents (list): The document parts (base64) for context; None or empty to critique
+                          the section on its own (see INSIGHT_CRITIQUE_CONTEXT).
+        digest (str): Optional compact outline of the documents, used when no documents are attached.
 
     Returns:
-        tuple: (critique_response, critique_text)
+        tuple: (critique_response, critique_text); the text ends with a VERDICT line (see parse_critique_verdict)
     """
+    if documents:
+        grounding = (
+            "Please critique the draft answer based *only* on the provided documents. "
+            "Focus **exclusively on the depth, breadth, and novelty of the reasoning and insights**. "
+            "Are the conclusions well-supported by facts from the documents? Is the analysis superficial or does it uncover non-obvious connections? "
+        )
+    else:
+        grounding = (
+            (f"Outline of the source documents (for orientation only; they are not attached):\n{digest}\n\n" if digest else "")
+            + "Please critique the draft answer as it stands; the facts in it have been checked separately against the source documents. "
+            "Focus **exclusively on the depth, breadth, and novelty of the reasoning and insights**. "
+            "Are the conclusions well-supported by the facts presented in the draft? Is the analysis superficial or does it uncover non-obvious connections? "
+        )
     instruction = (
          f"Context: {initial_instruction}\n"
          f"Draft Answer to Critique:\n```html\n{answer}\n```\n\n"
-         "Please critique the draft answer based *only* on the provided documents. "
-         "Focus **exclusively on the depth, breadth, and novelty of the reasoning and insights**. "
-         "Are the conclusions well-supported by facts from the documents? Is the analysis superficial or does it uncover non-obvious connections? "
+         f"{grounding}"
          "Does it address the 'why' behind the facts? Avoid critiquing factual correctness (assume facts are correct for this critique) or HTML format."
          "Output only the critique text."
+         f"{VERDICT_INSTRUCTION}"
     )
 
     prompt = f"{persona}\n{instruction}"
-    insight_critique_input = [prompt] + documents
+    insight_critique_input = [prompt] + (documents or [])
     insight_model = create_insight_model()
 
     insight_critique_response = None
@@ -162,7 +285,7 @@ def get_insight_critique(initial_instruction, answer, documents):
     return insight_critique_response, insight_critique_text
 
 
-def insight_improvement_response(initial_instruction, answer, insight_critique_text, documents, section_num=None, section_title=None):
+def insight_improvement_response(initial_instruction, answer, insight_critique_text, documents, section_num=None, section_title=None, output_mode=None, outcome=None):
     """
     Generate an improved answer based on insight critique.
 
@@ -173,6 +296,8 @@ def insight_improvement_response(initial_instruction, answer, insight_critique_t
         documents (list): The list of document parts (base64) for context.
         section_num: Section number.
         section_title: Section title.
+        output_mode: 'rewrite' or 'patch' (default IMPROVEMENT_OUTPUT).
+        outcome (dict): If given, records how a patch went (see patch_improvement).
 
     Returns:
         tuple: (response_object, cleaned_repaired_html_text)
@@ -185,12 +310,14 @@ def insight_improvement_response(initial_instruction, answer, insight_critique_t
         "Enhance the analysis, provide deeper reasoning, and draw non-obvious connections supported by the documents. "
         "Do NOT reduce the amount of data or information in the original answer unless required to fix a factual error."
         "Do NOT add new factual information not present in the documents. Maintain factual accuracy. "
-        "Output *only* the revised HTML for the section, adhering to the original HTML requirements."
     )
 
-    prompt = f"{persona}\n{instruction}\n{output_format}"
+    prompt = f"{persona}\n{instruction}{REWRITE_OUTPUT_INSTRUCTION}\n{output_format}"
     improved_input = [prompt] + documents
     insight_model = create_insight_model()
+    if (output_mode or IMPROVEMENT_OUTPUT) == "patch":
+        patched = patch_improvement(insight_model, instruction, answer, documents, section_num, section_title, "Insight Refinement", outcome)
+        if patched: return patched
 
     insight_improvement_response = None
     insight_improvement_text_raw = ""
@@ -219,4 +346,73 @@ def insight_improvement_response(initial_instruction, answer, insight_critique_t
          print(f"Insight Refinement Warning: Insight-improved HTML for section {section_num} failed validation after repair.")
          return insight_improvement_response, insight_improvement_text
 
-    return insight_improvement_response, insight_improvement_text 
\ No newline at end of file
+    return insight_improvement_response, insight_improvement_text 
+
+# --- Merged Refinement (parallel critiques, one improvement) ---
+
+def merged_improvement_response(initial_instruction, answer, fact_critique_text, insight_critique_text, documents, section_num=None, section_title=None, output_mode=None, outcome=None):
+    """
+    Generate an improved answer addressing a fact critique and an insight critique in one call
+    (both critiques were written against the same draft).
+
+    Args:
+        initial_instruction: Original instruction/context.
+        answer: Original answer HTML.
+        fact_critique_text: Fact critique text, or None if there is nothing to fix.
+        insight_critique_text: Insight critique text, or None if there is nothing to improve.
+        documents (list): The list of document parts (base64) for context.
+        section_num: Section number.
+        section_title: Section title.
+        output_mode: 'rewrite' or 'patch' (default IMPROVEMENT_OUTPUT).
+        outcome (dict): If given, records how a patch went (see patch_improvement).
+
+    Returns:
+        tuple: (response_object, cleaned_repaired_html_text)
+    """
+    instruction = (
+        f"Context: {initial_instruction}\n"
+        f"Original Draft Answer:\n```html\n{answer}\n```\n\n"
+        f"Fact Critique (points to address first):\n```\n{fact_critique_text or 'No factual issues found.'}\n```\n\n"
+        f"Insight Critique (points to address next):\n```\n{insight_critique_text or 'No insight improvements suggested.'}\n```\n\n"
+        "INSTRUCTIONS: Revise the 'Original Draft Answer' based *only* on the provided documents. "
+        "First fix the factual issues raised in the 'Fact Critique': add missing information from the documents where needed and correct or remove unsupported statements. "
+        "Then address the strategic and analytical points raised in the 'Insight Critique': enhance the analysis, provide deeper reasoning, and draw non-obvious connections supported by the documents. "
+        "Where the two critiques conflict, factual accuracy takes precedence. "
+        "Do NOT add new factual information not present in the documents. "
+        "Do NOT reduce the amount of data or information in the original answer unless required to fix a factual error. "
+    )
+
+    prompt = f"{persona}\n{instruction}{REWRITE_OUTPUT_INSTRUCTION}\n{output_format}"
+    improved_input = [prompt] + documents
+    fact_model = create_fact_model() # fact accuracy first: the conservative model
+    if (output_mode or IMPROVEMENT_OUTPUT) == "patch":
+        patched = patch_improvement(fact_model, instruction, answer, documents, section_num, section_title, "Merged Refinement", outcome)
+        if patched: return patched
+
+    merged_improvement_response = None
+    merged_improvement_text_raw = ""
+    try:
+        print(f"Merged Refinement: Generating improved response for section {section_num}...")
+        merged_improvement_response = cached_generate_content(fact_model, improved_input, section_num)
+
+        if merged_improvement_response is None or not hasattr(merged_improvement_response, 'text'):
+            raise ValueError(f"API call for merged improvement (Section {section_num}) did not return a valid response object.")
+
+        merged_improvement_text_raw = merged_improvement_response.text
+        if not merged_improvement_text_raw:
+             print(f"Merged Refinement Warning: API returned empty text for merged improvement (Section {section_num}). Returning original.")
+             return merged_improvement_response, answer
+
+        print(f"Merged Refinement: Improved response generated for section {section_num}.")
+
+    except Exception as e:
+        print(f"Merged Refinement ERROR during improvement API call for section {section_num}: {e}")
+        return None, answer
+
+    merged_improvement_text_cleaned = clean_llm_output(merged_improvement_text_raw, section_num, section_title)
+    merged_improvement_text = repair_html(merged_improvement_text_cleaned, section_num, section_title)
+
+    if not validate_html(merged_improvement_text):
+         print(f"Merged Refinement Warning: Merged-improved HTML for section {section_num} failed validation after repair.")
+
+    return merged_improvement_response, merged_improvement_text
@@ -0,0 +1,234 @@
+"""
+Refinement evaluation module for ProfileDash
+Compares the refinement modes on recorded runs before a mode becomes the default:
+every selected section of a finished run is refined again from its checkpointed
+initial HTML, once per mode, against the run's stored documents. The report gives
+per section and overall: API calls, critical-path seconds, local quality score
+(section_quality.py), output length and, with --judge, a blind pairwise verdict of
+the model on which version is more accurate and insightful.
+
+Usage:
+    python -m src.refinement_eval <run_id> [<run_id> ...] [--modes sequential,merged] [--sections 7-9,23] [--judge] [--output-dir refinement_eval]
+
+Needs GOOGLE_API_KEY; the runs' documents must still be in the document store.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import google.generativeai as genai
+
+from .api_client import cached_generate_content, create_fact_model
+from .document_processor import encode_document_part, build_document_digest
+from .document_store import load_document_bytes, load_document_entry
+from .run_store import RunCheckpoint, load_run_meta, UNFINISHED_STATUSES
+from .section_dag import section_dependencies, uses_documents, build_upstream_context, parse_section_selection
+from .section_definitions import sections, section_groups
+from .section_quality import score_section_html
+from .consistency import group_sections_for_review, review_profile_consistency, format_section_issues
+from .refinement import INSIGHT_CRITIQUE_CONTEXT
+from .background_processor import REFINEMENT_MODES, REFINEMENT_STEPS, MERGED_CRITIQUE_STEPS, _run_refinement_step
+
+EVAL_OUTPUT_DIR = "refinement_eval"
+JUDGE_INSTRUCTION = (
+    "You are reviewing two versions (A and B) of the same company profile section, written from the provided documents "
+    "for this brief:\n{spec}\n\nVersion A:\n```html\n{a}\n```\n\nVersion B:\n```html\n{b}\n```\n\n"
+    "Judge which version is better: first factual accuracy and completeness against the documents, then depth of insight. "
+    'Answer with one line of JSON only: {{"winner": "A" | "B" | "tie", "reason": "<one sentence>"}}'
+)
+
+
+def load_run_inputs(run_id):
+    """(run metadata, checkpoint, encoded documents, document digest) of a finished run; raises ValueError if it cannot be evaluated."""
+    meta = load_run_meta(run_id)
+    if meta is None or meta.get("status") in UNFINISHED_STATUSES:
+        raise ValueError(f"Run {run_id} is unknown or unfinished.")
+    documents = []
+    for document in meta.get("documents") or []:
+        content = load_document_bytes(document["sha256"])
+        if content is None:
+            raise ValueError(f"Document {document['filename']} of run {run_id} is no longer in the document store.")
+        documents.append(encode_document_part(content))
+    if not documents:
+        raise ValueError(f"Run {run_id} has no stored documents.")
+    digest = build_document_digest({d["filename"]: load_document_entry(d["sha256"], touch=False) for d in meta["documents"]}) if INSIGHT_CRITIQUE_CONTEXT == "digest" else None
+    return meta, RunCheckpoint(run_id), documents, digest
+
+
+def refinement_sources(section_def, checkpoint, documents, initial_html_by_num):
+    """The sources a section was refined against: extraction notes (map-reduce), upstream context and/or the documents."""
+    _, _, notes = checkpoint.load_step(section_def["number"], "initial")
+    if notes:
+        return [f"SOURCE NOTES (extracted page by page from the provided documents):\n{notes}"]
+    if not section_dependencies(section_def):
+        return documents
+    upstream_context, missing = build_upstream_context(section_def, initial_html_by_num, sections)
+    return (documents if missing or uses_documents(section_def) else []) + ([f"EARLIER PROFILE SECTIONS (compiled from the provided documents):\n{upstream_context}"] if upstream_context else [])
+
+
+def refine_section(mode, section_def, initial_html, sources, digest=None, log_func=print, review=None):
+    """
+    Refine one section in `mode`. In 'profile' mode, review is the whole-profile review
+    ({'issues': section number -> critique text, 'seconds'}). Returns {'html', 'calls', 'criticalPathSeconds', 'failed'}.
+    """
+    state = {"html": initial_html, "critique": None, "critiques": {}, "failed": False}
+    if mode == "profile" and review["issues"].get(section_def["number"]):
+        state["critiques"]["consistency_review"] = review["issues"][section_def["number"]]
+    timings, skipped = {}, set()
+
+    def timed_step(step):
+        start = time.time()
+        _run_refinement_step(step, section_def, state, sources, log_func, digest)
+        timings[step] = time.time() - start
+        if step in (state.pop("skipped_improvement", None), state.pop("critique_failed", None)): # clean verdict or failed critique, no call made
+            skipped.add(step)
+
+    if mode == "merged":
+        with ThreadPoolExecutor(max_workers=len(MERGED_CRITIQUE_STEPS)) as executor:
+            list(executor.map(timed_step, MERGED_CRITIQUE_STEPS))
+        timed_step("merged_improve")
+        critical_path = max(timings[step] for step in MERGED_CRITIQUE_STEPS) + timings["merged_improve"]
+    elif mode == "profile": # the review call is shared by the whole profile (counted once in the summary)
+        timed_step("consistency_improve")
+        critical_path = review["seconds"] + timings["consistency_improve"]
+    else:
+        for step in REFINEMENT_STEPS:
+            timed_step(step)
+        critical_path = sum(timings.values())
+    return {"html": state["html"], "calls": len(timings) - len(skipped), "criticalPathSeconds": round(critical_path, 1), "failed": state["failed"]}
+
+
+def judge_pair(section_def, sources, html_a, html_b):
+    """Blind pairwise verdict ('A', 'B' or 'tie', reason) of the fact model on two versions of a section."""
+    prompt = JUDGE_INSTRUCTION.format(spec=section_def["specs"], a=html_a, b=html_b)
+    try:
+        response = cached_generate_content(create_fact_model(), [prompt] + sources, section_def["number"])
+        text = getattr(response, "text", "").strip().strip("`").replace("json\n", "")
+        verdict = json.loads(text[text.find("{"):text.rfind("}") + 1])
+        return str(verdict.get("winner", "tie")).strip().upper().replace("TIE", "tie"), verdict.get("reason", "")
+    except Exception as e:
+        print(f"Refinement Eval: Judge failed for S{section_def['number']}: {type(e).__name__} - {e}")
+        return None, str(e)
+
+
+def evaluate_run(run_id, section_numbers=None, modes=REFINEMENT_MODES, judge=False):
+    """Refine the run's sections in every mode. Returns (one result dict per section, the profile review or None)."""
+    meta, checkpoint, documents, digest = load_run_inputs(run_id)
+    initial_html_by_num = {}
+    for section_def in sections:
+        html, _, _ = checkpoint.load_step(section_def["number"], "initial")
+        if html and '<p class="error">' not in html:
+            initial_html_by_num[section_def["number"]] = html
+    selected = [s for s in sections if s["number"] in initial_html_by_num and (not section_numbers or s["number"] in section_numbers)]
+    print(f"Refinement Eval: Run {run_id} ({meta.get('companyName')}): {len(selected)} sections, modes {', '.join(modes)}.")
+    review = None
+    if "profile" in modes: # the review always covers the whole profile, even if only some sections are compared
+        start, issues = time.time(), []
+        groups = group_sections_for_review(sections, initial_html_by_num)
+        try:
+            for group in groups:
+                issues.extend(review_profile_consistency(group, initial_html_by_num, documents))
+        except Exception as e:
+            raise ValueError(f"Profile review failed: {type(e).__name__} - {e}")
+        by_section = {}
+        for issue in issues: by_section.setdefault(issue["section"], []).append(issue)
+        review = {"runId": run_id, "calls": len(groups), "seconds": round(time.time() - start, 1), "issues": {num: format_section_issues(found) for num, found in by_section.items()}}
+        print(f"Refinement Eval: Profile review: {len(issues)} issues in {len(by_section)} sections ({len(groups)} calls, {review['seconds']:.0f}s).")
+    results = []
+    for section_def in selected:
+        num = section_def["number"]
+        sources = refinement_sources(section_def, checkpoint, documents, initial_html_by_num)
+        result = {"runId": run_id, "section": num, "title": section_def["title"],
+                  "initialScore": score_section_html(section_def, initial_html_by_num[num])["score"], "modes": {}}
+        for mode in modes:
+            refined = refine_section(mode, section_def, initial_html_by_num[num], sources, digest, log_func=lambda message: None, review=review)
+            refined["score"] = score_section_html(section_def, refined["html"])["score"]
+            refined["length"] = len(refined["html"])
+            result["modes"][mode] = refined
+            print(f"Refinement Eval: S{num} {mode}: {refined['calls']} calls, {refined['criticalPathSeconds']:.0f}s critical path, score {refined['score']:.0f}")
+        if judge and len(modes) == 2:
+            swap = random.random() < 0.5 # blind: the judge does not know which mode wrote which version
+            first, second = (modes[1], modes[0]) if swap else modes
+            winner, reason = judge_pair(section_def, sources, result["modes"][first]["html"], result["modes"][second]["html"])
+            result["judge"] = {"winner": {"A": first, "B": second}.get(winner, "tie" if winner else None), "reason": reason}
+        results.append(result)
+    return results, review
+
+
+def summarize(results, modes, reviews=()):
+    """Totals per mode (the 'profile' calls include its whole-profile reviews) and the judge's tally."""
+    summary = {}
+    for mode in modes:
+        refined = [r["modes"][mode] for r in results if mode in r["modes"]]
+        summary[mode] = {
+            "sections": len(refined), "calls": sum(r["calls"] for r in refined) + (sum(review["calls"] for review in reviews) if mode == "profile" else 0),
+            "meanCriticalPathSeconds": round(sum(r["criticalPathSeconds"] for r in refined) / max(1, len(refined)), 1),
+            "meanScore": round(sum(r["score"] for r in refined) / max(1, len(refined)), 1),
+            "failed": sum(1 for r in refined if r["failed"]),
+            "judgeWins": sum(1 for r in results if r.get("judge", {}).get("winner") == mode),
+        }
+    summary["judgeTies"] = sum(1 for r in results if r.get("judge", {}).get("winner") == "tie")
+    return summary
+
+
+def write_report(results, summary, output_dir):
+    """results.json plus one side-by-side HTML page per section."""
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, "results.json"), "w", encoding="utf-8") as f:
+        json.dump({"summary": summary, "sections": [{**r, "modes": {m: {k: v for k, v in d.items() if k != "html"} for m, d in r["modes"].items()}} for r in results]}, f, indent=2)
+    for r in results:
+        columns = "".join(f"<div style='flex:1;padding:8px'><h3>{mode} ({d['calls']} calls, score {d['score']:.0f})</h3>{d['html']}</div>" for mode, d in r["modes"].items())
+        with open(os.path.join(output_dir, f"{r['runId'][:8]}_section_{r['section']}.html"), "w", encoding="utf-8") as f:
+            f.write(f"<html><body><h2>{r['section']}. {r['title']}</h2><p>{json.dumps(r.get('judge'))}</p><div style='display:flex'>{columns}</div></body></html>")
+
+
+def main(argv=None):
+    """Command-line entry point to compare the refinement modes on recorded runs."""
+    parser = argparse.ArgumentParser(prog="python -m src.refinement_eval", description="Compare ProfileDash refinement modes on recorded runs.")
+    parser.add_argument("run_ids", nargs="+", help="Finished runs (in the run store) to re-refine")
+    parser.add_argument("--sections", default="", help=f"Only these sections, e.g. '7-9,23' or a group ({', '.join(section_groups)})")
+    parser.add_argument("--modes", default="sequential,merged", help=f"Comma-separated refinement modes to compare ({', '.join(REFINEMENT_MODES)})")
+    parser.add_argument("--judge", action="store_true", help="Ask the model for a blind pairwise verdict per section between the two modes (one extra call each)")
+    parser.add_argument("--output-dir", default=EVAL_OUTPUT_DIR, help="Where results.json and the side-by-side pages are written")
+    args = parser.parse_args(argv)
+    try:
+        section_numbers = parse_section_selection(args.sections, sections, section_groups) if args.sections else None
+    except ValueError as e:
+        parser.error(str(e))
+    modes = tuple(mode.strip() for mode in args.modes.split(",") if mode.strip())
+    if not modes or any(mode not in REFINEMENT_MODES for mode in modes):
+        parser.error(f"--modes must list modes out of {', '.join(REFINEMENT_MODES)}.")
+    if args.judge and len(modes) != 2:
+        parser.error("--judge compares exactly two modes.")
+    if not os.getenv("GOOGLE_API_KEY"):
+        parser.error("GOOGLE_API_KEY not found in the environment.")
+    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+
+    results, reviews = [], []
+    for run_id in args.run_ids:
+        try:
+            run_results, review = evaluate_run(run_id, section_numbers, modes, args.judge)
+            results.extend(run_results); reviews.extend([review] if review else [])
+        except ValueError as e:
+            print(f"Refinement Eval: Skipping run {run_id}: {e}")
+    if not results:
+        return 1
+    summary = summarize(results, modes, reviews)
+    write_report(results, summary, args.output_dir)
+    print("\n=== Refinement mode comparison ===")
+    for mode in modes:
+        s = summary[mode]
+        print(f"{mode:<11} {s['sections']:>3} sections  {s['calls']:>4} calls  {s['meanCriticalPathSeconds']:6.1f}s mean critical path  "
+              f"score {s['meanScore']:5.1f}  {s['failed']} failed" + (f"  judge wins {s['judgeWins']}" if args.judge else ""))
+    if args.judge: print(f"judge ties  {summary['judgeTies']}")
+    print(f"Report written to {args.output_dir}/results.json")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,232 @@
+"""
+Run cache module for ProfileDash
+Whole-run result cache: a run over exactly the same documents (by content hash) with
+unchanged section definitions, prompts and model configuration restores every
+section's initial and refined HTML from the cache instead of calling the API. Runs
+only rebuild and email the profiles on a hit.
+
+Key: sha256 of the sorted document hashes, the prompt version (fingerprint of the
+prompt-bearing modules), the model configuration, the section selection and the
+upload size limit (which decides map-reduce mode).
+
+Layout: <RUN_CACHE_DIR>/<key>/meta.json
+        <RUN_CACHE_DIR>/<key>/initial/section_N.html (+ section_N_notes.txt), refined/section_N.html
+
+Usage (CLI):
+    python -m src.run_cache fingerprint
+    python -m src.run_cache list
+    python -m src.run_cache show <key-prefix>
+    python -m src.run_cache invalidate (--prompt-version <prefix> | --stale | --all)
+    python -m src.run_cache remove <key-prefix>
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import inspect
+import argparse
+import threading
+from datetime import datetime
+
+from . import api_client
+
+RUN_CACHE_DIR = os.environ.get("PROFILEDASH_RUN_CACHE", "run_cache")
+RUN_CACHE_ENABLED = os.environ.get("PROFILEDASH_RUN_CACHE_ENABLED", "1") != "0"
+RUN_CACHE_FORMAT_VERSION = 1
+CACHE_META_FILENAME = "meta.json"
+# Modules whose text shapes the generated HTML (prompts, section definitions, pipeline options)
+PROMPT_MODULES = ("section_definitions.py", "prompts.py", "section_processor.py", "refinement.py", "section_dag.py", "map_reduce.py", "page_dedup.py")
+
+_cache_lock = threading.Lock()
+_fingerprints = {}
+
+
+def prompt_version():
+    """Short fingerprint of the prompt-bearing modules; changes whenever a prompt or section definition does."""
+    if "prompt" not in _fingerprints:
+        digest = hashlib.sha256()
+        module_dir = os.path.dirname(os.path.abspath(__file__))
+        for filename in PROMPT_MODULES:
+            with open(os.path.join(module_dir, filename), "rb") as f:
+                digest.update(filename.encode("utf-8") + b"\0" + f.read())
+        _fingerprints["prompt"] = digest.hexdigest()[:16]
+    return _fingerprints["prompt"]
+
+
+def model_config_fingerprint():
+    """Short fingerprint of the model name and the generation settings of the models used."""
+    if "model" not in _fingerprints:
+        config = api_client.MODEL_NAME + "".join(inspect.getsource(func) for func in (
+            api_client.create_model_config, api_client.create_insight_model, api_client.create_fact_model))
+        _fingerprints["model"] = hashlib.sha256(config.encode("utf-8")).hexdigest()[:16]
+    return _fingerprints["model"]
+
+
+def run_cache_key(document_hashes, section_numbers=None, max_upload_bytes=None, refinement_config=None):
+    """
+    Cache key of a run over these documents with the current prompts and model configuration.
+    refinement_config (e.g. the run's refinement mode and improvement settings) keeps runs
+    refined differently apart.
+    """
+    key_material = json.dumps({
+        "documents": sorted(document_hashes), "promptVersion": prompt_version(), "modelConfig": model_config_fingerprint(),
+        "sections": sorted(section_numbers) if section_numbers else None, "maxUploadBytes": max_upload_bytes,
+        "refinement": refinement_config, "format": RUN_CACHE_FORMAT_VERSION,
+    }, sort_keys=True)
+    return hashlib.sha256(key_material.encode("utf-8")).hexdigest()
+
+
+def cache_entry_dir(key, cache_dir=None):
+    return os.path.join(cache_dir or RUN_CACHE_DIR, key)
+
+
+def load_cached_run(key, cache_dir=None):
+    """A cache entry's metadata (with 'sections' in run store checkpoint form), or None on a miss."""
+    meta_path = os.path.join(cache_entry_dir(key, cache_dir), CACHE_META_FILENAME)
+    if not os.path.exists(meta_path):
+        return None
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except Exception as e:
+        print(f"Run Cache Warning: Could not read {meta_path}: {e}")
+        return None
+    if meta.get("promptVersion") != prompt_version() or meta.get("modelConfig") != model_config_fingerprint():
+        return None
+    return meta
+
+
+def store_cached_run(key, checkpoint, section_numbers, document_hashes, company_name, cache_dir=None):
+    """
+    Store a successful run's initial and refined sections (read from its checkpoint).
+    Returns True if the entry was written.
+    """
+    entry_dir = cache_entry_dir(key, cache_dir)
+    tmp_dir = entry_dir + f".tmp{os.getpid()}_{threading.get_ident()}"
+    try:
+        for step in ("initial", "refined"):
+            os.makedirs(os.path.join(tmp_dir, step), exist_ok=True)
+        for num in section_numbers:
+            for step, filenames in (("initial", (f"section_{num}.html", f"section_{num}_notes.txt")), ("refined", (f"section_{num}.html",))):
+                for filename in filenames:
+                    source = os.path.join(checkpoint.run_dir, step, filename)
+                    if os.path.exists(source):
+                        shutil.copyfile(source, os.path.join(tmp_dir, step, filename))
+                    elif filename.endswith(".html"):
+                        raise FileNotFoundError(f"S{num} has no checkpointed '{step}' HTML")
+        meta = {
+            "key": key, "runId": checkpoint.run_id, "companyName": company_name, "documents": sorted(document_hashes),
+            "promptVersion": prompt_version(), "modelConfig": model_config_fingerprint(), "modelName": api_client.MODEL_NAME,
+            "sectionNumbers": sorted(section_numbers), "sections": {str(num): {"step": "refined", "failed": False} for num in section_numbers},
+            "createdAt": time.time(), "format": RUN_CACHE_FORMAT_VERSION,
+        }
+        with open(os.path.join(tmp_dir, CACHE_META_FILENAME), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        with _cache_lock:
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(tmp_dir, entry_dir)
+        return True
+    except Exception as e:
+        print(f"Run Cache Warning: Could not store run {checkpoint.run_id}: {e}")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return False
+
+
+def list_cached_runs(cache_dir=None):
+    """Metadata of every cache entry (current or stale)."""
+    root = cache_dir or RUN_CACHE_DIR
+    if not os.path.isdir(root):
+        return []
+    entries = []
+    for key in os.listdir(root):
+        meta_path = os.path.join(root, key, CACHE_META_FILENAME)
+        if not os.path.exists(meta_path):
+            continue
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                entries.append(json.load(f))
+        except Exception as e:
+            print(f"Run Cache Warning: Could not read {meta_path}: {e}")
+    return entries
+
+
+def remove_cached_run(key, cache_dir=None):
+    with _cache_lock:
+        shutil.rmtree(cache_entry_dir(key, cache_dir), ignore_errors=True)
+
+
+def invalidate_cached_runs(prompt_version_prefix=None, stale=False, cache_dir=None):
+    """
+    Remove entries of a prompt version (prefix match), all entries whose prompt version or
+    model configuration is no longer current (`stale`), or every entry if neither is given.
+    Returns the removed keys.
+    """
+    removed = []
+    for meta in list_cached_runs(cache_dir):
+        if prompt_version_prefix is not None and not meta.get("promptVersion", "").startswith(prompt_version_prefix):
+            continue
+        if stale and meta.get("promptVersion") == prompt_version() and meta.get("modelConfig") == model_config_fingerprint():
+            continue
+        remove_cached_run(meta["key"], cache_dir)
+        removed.append(meta["key"])
+    if removed:
+        print(f"Run Cache: Invalidated {len(removed)} entries.")
+    return removed
+
+
+def _resolve_prefix(prefix, cache_dir=None):
+    matches = [meta["key"] for meta in list_cached_runs(cache_dir) if meta["key"].startswith(prefix)]
+    if len(matches) != 1:
+        print(f"Expected exactly one cache entry matching '{prefix}', found {len(matches)}.")
+        return None
+    return matches[0]
+
+
+def main(argv=None):
+    """Command-line entry point to inspect and invalidate the run cache."""
+    parser = argparse.ArgumentParser(prog="python -m src.run_cache", description="Inspect and invalidate the ProfileDash run cache.")
+    parser.add_argument("--cache-dir", default=None, help=f"Cache directory (default: {RUN_CACHE_DIR})")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("fingerprint", help="Show the current prompt version and model configuration fingerprint")
+    subparsers.add_parser("list", help="List cache entries")
+    show_parser = subparsers.add_parser("show", help="Show one entry's metadata")
+    show_parser.add_argument("key_prefix")
+    invalidate_parser = subparsers.add_parser("invalidate", help="Remove entries by prompt version")
+    invalidate_group = invalidate_parser.add_mutually_exclusive_group(required=True)
+    invalidate_group.add_argument("--prompt-version", help="Prompt version (prefix) whose entries are removed")
+    invalidate_group.add_argument("--stale", action="store_true", help="Remove entries of other prompt versions or model configurations")
+    invalidate_group.add_argument("--all", action="store_true", help="Remove every entry")
+    remove_parser = subparsers.add_parser("remove", help="Remove one entry")
+    remove_parser.add_argument("key_prefix")
+    args = parser.parse_args(argv)
+
+    if args.command == "fingerprint":
+        print(f"Prompt version: {prompt_version()}\nModel config:   {model_config_fingerprint()} ({api_client.MODEL_NAME})")
+    elif args.command == "list":
+        entries = sorted(list_cached_runs(args.cache_dir), key=lambda meta: meta.get("createdAt", 0), reverse=True)
+        for meta in entries:
+            created = datetime.fromtimestamp(meta.get("createdAt", 0)).strftime("%Y-%m-%d %H:%M")
+            current = meta.get("promptVersion") == prompt_version() and meta.get("modelConfig") == model_config_fingerprint()
+            print(f"{meta['key'][:12]}  prompts {meta.get('promptVersion')}  {'current' if current else 'stale  '}  {created}  "
+                  f"{len(meta.get('sectionNumbers', [])):>2} sections  {len(meta.get('documents', []))} docs  {meta.get('companyName')}")
+        print(f"{len(entries)} entries (current prompt version {prompt_version()}).")
+    elif args.command == "show":
+        key = _resolve_prefix(args.key_prefix, args.cache_dir)
+        if not key: return 1
+        print(json.dumps(next(meta for meta in list_cached_runs(args.cache_dir) if meta["key"] == key), indent=2))
+    elif args.command == "invalidate":
+        removed = invalidate_cached_runs(None if args.all else args.prompt_version, stale=args.stale, cache_dir=args.cache_dir)
+        print(f"Removed {len(removed)} entries.")
+    elif args.command == "remove":
+        key = _resolve_prefix(args.key_prefix, args.cache_dir)
+        if not key: return 1
+        remove_cached_run(key, args.cache_dir)
+        print(f"Removed {key}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
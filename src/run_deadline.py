@@ -0,0 +1,108 @@
+"""
+Run deadline module for ProfileDash
+Run-level SLA: a run has a time budget (PROFILEDASH_RUN_SLA_MINUTES, or per run) and,
+once it runs short, refinement degrades instead of delaying the refined profile.
+Each refinement step is checked just before it starts:
+
+    full          every step runs
+    skip_insight  the insight critique/improvement is dropped (fact-checking still runs)
+    low_scoring   only sections whose initial content scores below SLA_LOW_SCORE_THRESHOLD
+                  (section_quality.py) are still fact-checked; the others ship as they are
+    ship          no further refinement step starts; every section ships with its last
+                  completed step
+
+The level follows the share of the budget already used and, per section, whether the
+steps it has left (expected durations from the latency history) still fit the budget.
+Once a step is skipped, the section's refinement ends there (in merged refinement mode, a
+skipped insight critique only leaves the merged improvement with the fact critique).
+"""
+
+import os
+import time
+import threading
+
+from .section_quality import score_section_html
+
+RUN_SLA_MINUTES = float(os.environ.get("PROFILEDASH_RUN_SLA_MINUTES", "0"))  # 0 = no deadline
+DEGRADATION_LEVELS = ("full", "skip_insight", "low_scoring", "ship")
+SKIP_INSIGHT_AT = 0.75           # share of the budget used after which insight passes are dropped
+LOW_SCORING_AT = 0.9             # ... after which only low-scoring sections are still refined
+SHIP_RESERVE_SECONDS = 60.0      # kept for aggregating, saving and emailing the refined profile
+SLA_LOW_SCORE_THRESHOLD = 60.0   # quality score below which a section is still refined at 'low_scoring'
+INSIGHT_STEPS = ("insight_critique", "insight_improve")
+FACT_STEPS = ("fact_critique", "fact_improve", "merged_improve", "consistency_improve")
+REFINEMENT_ORDER = ("fact_critique", "fact_improve") + INSIGHT_STEPS
+
+
+class RunDeadline:
+    """
+    Deadline of one run. check_step() is called from scheduler worker threads;
+    `degraded` ({section number: {'level', 'step', 'reason'}}) records every section
+    whose refinement was cut short.
+    """
+
+    def __init__(self, deadline_at, sla_minutes, estimator=None, degraded=None, low_score_threshold=SLA_LOW_SCORE_THRESHOLD):
+        self.deadline_at = deadline_at
+        self.sla_seconds = sla_minutes * 60
+        self.estimator = estimator
+        self.low_score_threshold = low_score_threshold
+        self.degraded = {int(num): record for num, record in (degraded or {}).items()}
+        self.scores = {}
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        return self.deadline_at - time.time()
+
+    def _expected_seconds(self, section_def, steps):
+        if not self.estimator:
+            return 0.0
+        return sum(self.estimator.expected(step, section_def) for step in steps)
+
+    def level(self, section_def=None, step=None):
+        """Degradation level now, for a section about to run `step` (or for the run as a whole)."""
+        remaining = self.remaining() - SHIP_RESERVE_SECONDS
+        if remaining <= 0:
+            return "ship"
+        used = 1 - remaining / self.sla_seconds if self.sla_seconds else 0.0
+        level = "low_scoring" if used >= LOW_SCORING_AT else "skip_insight" if used >= SKIP_INSIGHT_AT else "full"
+        if section_def and step:
+            steps_left = REFINEMENT_ORDER[REFINEMENT_ORDER.index(step):] if step in REFINEMENT_ORDER else (step,)
+            fact_steps_left = [s for s in steps_left if s in FACT_STEPS]
+            if self._expected_seconds(section_def, fact_steps_left) > remaining:
+                level = max(level, "low_scoring", key=DEGRADATION_LEVELS.index)
+            elif self._expected_seconds(section_def, steps_left) > remaining:
+                level = max(level, "skip_insight", key=DEGRADATION_LEVELS.index)
+        return level
+
+    def score(self, section_def, html):
+        num = section_def["number"]
+        if num not in self.scores:
+            self.scores[num] = score_section_html(section_def, html)["score"]
+        return self.scores[num]
+
+    def check_step(self, section_def, step, html):
+        """None if `step` should run, otherwise the reason it is skipped (recorded in `degraded`)."""
+        level = self.level(section_def, step)
+        minutes_left = max(0.0, self.remaining()) / 60
+        if level == "full" or (level == "skip_insight" and step not in INSIGHT_STEPS):
+            return None
+        if level == "low_scoring" and step not in INSIGHT_STEPS:
+            score = self.score(section_def, html)
+            if score < self.low_score_threshold:
+                return None
+            reason = f"{minutes_left:.1f} min of the {self.sla_seconds / 60:g} min budget left; quality score {score:.0f} is above {self.low_score_threshold:.0f}, so fact-checking was skipped"
+        elif level == "ship":
+            reason = f"the {self.sla_seconds / 60:g} min budget is used up; shipped after its last completed step"
+        else:
+            reason = f"{minutes_left:.1f} min of the {self.sla_seconds / 60:g} min budget left; insight pass skipped"
+        with self._lock:
+            self.degraded[section_def["number"]] = {"level": level, "step": step, "reason": reason}
+        return reason
+
+    def summary(self):
+        """Degradation record for the run metadata, logs and email."""
+        with self._lock:
+            sections = {str(num): dict(record) for num, record in sorted(self.degraded.items())}
+        return {"slaMinutes": self.sla_seconds / 60, "deadlineAt": self.deadline_at, "sections": sections,
+                "finishedLevel": self.level(), "secondsLeft": round(self.remaining(), 1)}
+
@@ -0,0 +1,355 @@
+"""
+Run store module for ProfileDash
+Checkpoints each run on local disk so it can resume after a process restart: run
+metadata (user, status, document hashes), each section's HTML after every completed
+step and the critique/notes the next step needs. On startup, unfinished runs are
+re-queued and continue from the last completed step of each section.
+
+A finished run can also be the parent of a regeneration run (a new run seeded with
+the parent's checkpoint, minus the sections picked for regeneration or re-refinement)
+or the base of a delta run (new document set; only sections fed by the added or
+removed documents are regenerated).
+
+Layout: <RUN_STORE_DIR>/<run_id>/run.json (+ initial_profile.html, refined_profile.html)
+        <RUN_STORE_DIR>/<run_id>/<step>/section_N.html (+ section_N_critique.txt, section_N_notes.txt)
+"""
+
+import os
+import json
+import time
+import shutil
+import threading
+import traceback
+
+from .html_generator import save_section, load_section
+from .document_store import load_document_bytes, load_document_entry
+
+RUN_STORE_DIR = os.environ.get("PROFILEDASH_RUN_STORE", "runs")
+RUN_STORE_KEEP_DAYS = 7      # finished runs are pruned after this many days
+MAX_RESUME_ATTEMPTS = 2      # a run that keeps crashing the process is given up after this many restarts
+RUN_META_FILENAME = "run.json"
+UNFINISHED_STATUSES = ("queued", "running")
+REGENERATION_MODES = ("generate", "refine")  # regenerate from the documents, or only re-run the refinement
+SECTION_STEP_DIRS = ("initial", "fact_critique", "fact_improve", "insight_critique", "insight_improve", "merged_improve", "consistency_improve", "refined")
+
+_run_store_lock = threading.Lock()
+
+
+def _run_dir(run_id, store_dir=None):
+    return os.path.join(store_dir or RUN_STORE_DIR, run_id)
+
+
+def _write_json(path, data):
+    # Write to a temp file first so a crash never leaves a half-written run.json
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _read_text(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def load_run_meta(run_id, store_dir=None):
+    """A run's metadata, or None if it has no checkpoint."""
+    meta_path = os.path.join(_run_dir(run_id, store_dir), RUN_META_FILENAME)
+    if not os.path.exists(meta_path):
+        return None
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Run Store Warning: Could not read {meta_path}: {e}")
+        return None
+
+
+class RunCheckpoint:
+    """
+    Checkpoint of one run. Every write is best-effort: a failing checkpoint logs a
+    warning and never fails the run itself.
+    """
+
+    def __init__(self, run_id, store_dir=None):
+        self.run_id = run_id
+        self.run_dir = _run_dir(run_id, store_dir)
+        self.meta = load_run_meta(run_id, store_dir) or {"runId": run_id, "status": "queued", "sections": {}, "createdAt": time.time()}
+        self._lock = threading.Lock()
+
+    @property
+    def resuming(self):
+        """True if an earlier attempt of this run already completed some steps."""
+        return bool(self.meta.get("sections"))
+
+    def _save_meta(self):
+        try:
+            os.makedirs(self.run_dir, exist_ok=True)
+            self.meta["updatedAt"] = time.time()
+            _write_json(os.path.join(self.run_dir, RUN_META_FILENAME), self.meta)
+        except Exception as e:
+            print(f"Run Store Warning: Could not write checkpoint for run {self.run_id}: {e}")
+
+    def update(self, **fields):
+        """Merge top-level fields into the run metadata and write it."""
+        with self._lock:
+            self.meta.update(fields)
+            self._save_meta()
+
+    def begin(self, user_email, app_version):
+        """Mark the run as running (counting restarts if it is resumed)."""
+        with self._lock:
+            if self.meta.get("status") == "running":
+                self.meta["resumeCount"] = self.meta.get("resumeCount", 0) + 1
+            self.meta.update({"status": "running", "userEmail": user_email, "appVersion": app_version, "startedAt": time.time()})
+            self._save_meta()
+
+    def finish(self, status):
+        """Mark the run as finished ('completed' or 'failed'); it will not be resumed."""
+        self.update(status=status, finishedAt=time.time())
+
+    # --- Sections ---
+
+    def section_progress(self, section_num):
+        """{'step', 'failed'} of a section's last completed step, or None. Steps: 'initial',
+        the refinement steps, then 'refined' once the final content has been saved."""
+        return self.meta.get("sections", {}).get(str(section_num))
+
+    def save_step(self, section_num, step, html, critique=None, notes=None, failed=False):
+        """Persist a section's state after `step` completed, then record the step as done."""
+        step_dir = os.path.join(self.run_dir, step)
+        try:
+            os.makedirs(step_dir, exist_ok=True)
+            save_section(step_dir, section_num, html or "")
+            for suffix, text in (("critique", critique), ("notes", notes)):
+                if text is not None:
+                    with open(os.path.join(step_dir, f"section_{section_num}_{suffix}.txt"), "w", encoding="utf-8") as f:
+                        f.write(str(text))
+        except Exception as e:
+            print(f"Run Store Warning: Could not checkpoint S{section_num} step '{step}' of run {self.run_id}: {e}")
+            return
+        with self._lock:
+            self.meta.setdefault("sections", {})[str(section_num)] = {"step": step, "failed": bool(failed)}
+            self._save_meta()
+
+    def load_step(self, section_num, step):
+        """(html, critique, notes) checkpointed for a section after `step`; missing parts are None."""
+        step_dir = os.path.join(self.run_dir, step)
+        try:
+            return (load_section(step_dir, section_num),
+                    _read_text(os.path.join(step_dir, f"section_{section_num}_critique.txt")),
+                    _read_text(os.path.join(step_dir, f"section_{section_num}_notes.txt")))
+        except Exception as e:
+            print(f"Run Store Warning: Could not load S{section_num} step '{step}' of run {self.run_id}: {e}")
+            return None, None, None
+
+
+    def adopt_sections(self, parent_meta, redo_sections=(), mode="generate", source_dir=None):
+        """
+        Copy a finished run's section checkpoints into this run (regeneration and delta runs,
+        or a run cache entry laid out the same way in `source_dir`). Sections in `redo_sections`
+        are left out ('generate') or keep only their initial content ('refine'). Returns the
+        numbers of the sections restored as they were.
+        """
+        redo = {str(num) for num in redo_sections}
+        parent_dir = source_dir or os.path.join(os.path.dirname(self.run_dir), parent_meta["runId"])
+        adopted, kept_sections = [], {}
+        for num, progress in parent_meta.get("sections", {}).items():
+            if num in redo and mode == "generate":
+                continue
+            for step in ("initial",) if num in redo else SECTION_STEP_DIRS:
+                for filename in (f"section_{num}.html", f"section_{num}_critique.txt", f"section_{num}_notes.txt"):
+                    source = os.path.join(parent_dir, step, filename)
+                    if os.path.exists(source):
+                        os.makedirs(os.path.join(self.run_dir, step), exist_ok=True)
+                        shutil.copyfile(source, os.path.join(self.run_dir, step, filename))
+            kept_sections[num] = {"step": "initial", "failed": False} if num in redo else progress
+            if num not in redo: adopted.append(int(num))
+        with self._lock:
+            self.meta.setdefault("sections", {}).update(kept_sections)
+            self._save_meta()
+        return sorted(adopted)
+
+
+def diff_documents(base_documents, documents):
+    """
+    (added, removed) documents of a run compared with an earlier run, by content hash.
+    Each is a list of {'filename', 'sha256', 'documentType'}; the type of documents
+    recorded without one is looked up in the document store ('other' if unknown).
+    """
+    base_hashes, hashes = {d["sha256"] for d in base_documents}, {d["sha256"] for d in documents}
+    def with_type(document):
+        document_type = document.get("documentType") or (load_document_entry(document["sha256"], touch=False) or {}).get("document_type")
+        return {**document, "documentType": document_type or "other"}
+    return ([with_type(d) for d in documents if d["sha256"] not in base_hashes],
+            [with_type(d) for d in base_documents if d["sha256"] not in hashes])
+
+
+def run_output_dir(run_id, store_dir=None):
+    """Folder a run writes its aggregated profiles to (initial_profile.html, refined_profile.html)."""
+    return _run_dir(run_id, store_dir)
+
+
+def load_run_profile(run_id, kind, store_dir=None):
+    """A run's aggregated 'initial' or 'refined' profile HTML, or None if it is not written yet."""
+    return _read_text(os.path.join(_run_dir(run_id, store_dir), f"{kind}_profile.html"))
+
+
+def create_run_checkpoint(run_id, user_email, file_paths, app_version, section_numbers=None, store_dir=None):
+    """Record a submitted run (before it starts) so it can be re-queued if the process restarts."""
+    checkpoint = RunCheckpoint(run_id, store_dir)
+    checkpoint.update(status="queued", userEmail=user_email, appVersion=app_version, uploadPaths=list(file_paths), submittedAt=time.time(),
+                      sectionNumbers=sorted(section_numbers) if section_numbers else None)
+    return checkpoint
+
+
+def unfinished_sections(meta):
+    """Section numbers of a run that failed, never completed their refinement or had it cut short by the run deadline."""
+    degraded = (meta.get("degradation") or {}).get("sections") or {}
+    return sorted(int(num) for num, progress in meta.get("sections", {}).items() if progress["failed"] or progress["step"] != "refined" or num in degraded)
+
+
+def create_regeneration_checkpoint(parent_run_id, run_id, section_numbers, mode, user_email, app_version, store_dir=None):
+    """
+    Seed a new run with a finished run's checkpoint so only `section_numbers` are redone:
+    'generate' drops their checkpoints entirely (new initial content from the documents,
+    then refinement), 'refine' keeps their initial content and re-runs the refinement.
+    Every other section is restored as it was, so the new run only rebuilds the profiles.
+
+    Returns:
+        RunCheckpoint: The new run's checkpoint (status 'queued'); raises ValueError if the
+        parent run is unknown, unfinished or has no stored documents.
+    """
+    if mode not in REGENERATION_MODES:
+        raise ValueError(f"Unknown regeneration mode '{mode}' (use {' or '.join(REGENERATION_MODES)}).")
+    parent = load_run_meta(parent_run_id, store_dir)
+    if parent is None:
+        raise ValueError(f"Run {parent_run_id} is unknown or has been pruned.")
+    if parent.get("status") in UNFINISHED_STATUSES:
+        raise ValueError(f"Run {parent_run_id} is still {parent['status']}. Wait for it to finish before regenerating sections.")
+    if not parent.get("documents"):
+        raise ValueError(f"Run {parent_run_id} has no stored documents to regenerate from.")
+    selected = {str(num) for num in section_numbers}
+    checkpoint = RunCheckpoint(run_id, store_dir)
+    checkpoint.adopt_sections(parent, selected, mode)
+    parent_dir = _run_dir(parent_run_id, store_dir)
+    # The initial profile only changes when sections get new initial content
+    initial_unchanged = mode == "refine" and os.path.exists(os.path.join(parent_dir, "initial_profile.html"))
+    if initial_unchanged:
+        shutil.copyfile(os.path.join(parent_dir, "initial_profile.html"), os.path.join(checkpoint.run_dir, "initial_profile.html"))
+    parent_sections = parent.get("sectionNumbers")
+    checkpoint.update(
+        status="queued", userEmail=user_email, appVersion=app_version, submittedAt=time.time(),
+        documents=parent["documents"], uploadPaths=[], companyName=parent.get("companyName"), initialEmailSent=initial_unchanged,
+        sectionNumbers=sorted(set(parent_sections) | {int(num) for num in selected}) if parent_sections else None,
+        regeneration={"parentRunId": parent_run_id, "sections": sorted(int(num) for num in selected), "mode": mode}
+    )
+    return checkpoint
+
+
+# --- Listing, resuming and pruning ---
+
+def list_runs(store_dir=None):
+    """Metadata of every checkpointed run."""
+    root = store_dir or RUN_STORE_DIR
+    if not os.path.isdir(root):
+        return []
+    runs = []
+    for run_id in os.listdir(root):
+        meta = load_run_meta(run_id, store_dir)
+        if meta is not None:
+            runs.append(meta)
+    return runs
+
+
+def unfinished_runs(store_dir=None):
+    """Runs that were queued or running when the process stopped, oldest first."""
+    return sorted((meta for meta in list_runs(store_dir) if meta.get("status") in UNFINISHED_STATUSES),
+                  key=lambda meta: meta.get("submittedAt") or meta.get("createdAt", 0))
+
+
+def user_runs(user_email, store_dir=None):
+    """A user's checkpointed runs, newest first."""
+    return sorted((meta for meta in list_runs(store_dir) if meta.get("userEmail") == user_email),
+                  key=lambda meta: meta.get("submittedAt") or meta.get("createdAt", 0), reverse=True)
+
+
+def active_document_hashes(store_dir=None):
+    """Document hashes referenced by unfinished runs (kept out of document store eviction)."""
+    return {document["sha256"] for meta in unfinished_runs(store_dir) for document in meta.get("documents", [])}
+
+
+def prepare_resume(meta, store_dir=None):
+    """
+    Input files for re-running an unfinished run: its documents restored from the
+    document store by hash (written under the run's folder), or the original upload
+    paths if the run never got past ingestion and they still exist.
+
+    Returns:
+        list: File paths, or None if the run cannot be resumed.
+    """
+    documents = meta.get("documents") or []
+    if documents:
+        inputs_dir = os.path.join(_run_dir(meta["runId"], store_dir), "inputs")
+        os.makedirs(inputs_dir, exist_ok=True)
+        paths = []
+        for document in documents:
+            content = load_document_bytes(document["sha256"])
+            if content is None:
+                print(f"Run Store: Document {document['filename']} ({document['sha256'][:12]}) of run {meta['runId']} is no longer in the document store.")
+                return None
+            path = os.path.join(inputs_dir, document["filename"])
+            with open(path, "wb") as f:
+                f.write(content)
+            paths.append(path)
+        return paths
+    upload_paths = meta.get("uploadPaths") or []
+    if upload_paths and all(os.path.exists(path) for path in upload_paths):
+        return upload_paths
+    return None
+
+
+def prune_runs(keep_days=RUN_STORE_KEEP_DAYS, store_dir=None):
+    """Delete finished runs older than `keep_days`. Returns the removed run ids."""
+    cutoff = time.time() - keep_days * 86400
+    removed = []
+    for meta in list_runs(store_dir):
+        if meta.get("status") in UNFINISHED_STATUSES or meta.get("updatedAt", meta.get("createdAt", 0)) > cutoff:
+            continue
+        with _run_store_lock:
+            shutil.rmtree(_run_dir(meta["runId"], store_dir), ignore_errors=True)
+        removed.append(meta["runId"])
+    if removed:
+        print(f"Run Store: Pruned {len(removed)} finished runs older than {keep_days} days.")
+    return removed
+
+
+def resume_unfinished_runs(submit_func, log_func=print, store_dir=None):
+    """
+    Re-submit every unfinished run via `submit_func(meta, file_paths)`. Runs whose
+    inputs are gone or that exceeded MAX_RESUME_ATTEMPTS are marked failed.
+
+    Returns:
+        tuple: (resumed run metadata list, abandoned run metadata list)
+    """
+    resumed, abandoned = [], []
+    for meta in unfinished_runs(store_dir):
+        run_id = meta["runId"]
+        try:
+            paths = prepare_resume(meta, store_dir) if meta.get("resumeCount", 0) < MAX_RESUME_ATTEMPTS else None
+            if paths is None:
+                log_func(f"Run Store: Cannot resume run {run_id} for {meta.get('userEmail')} (inputs missing or too many restarts). Marking it failed.")
+                RunCheckpoint(run_id, store_dir).finish("failed")
+                abandoned.append(meta)
+                continue
+            completed_steps = len(meta.get("sections", {}))
+            log_func(f"Run Store: Resuming run {run_id} for {meta.get('userEmail')} ({completed_steps} sections with checkpointed steps).")
+            submit_func(meta, paths)
+            resumed.append(meta)
+        except Exception as e:
+            log_func(f"Run Store: Error resuming run {run_id}: {type(e).__name__} - {e}")
+            traceback.print_exc()
+            abandoned.append(meta)
+    return resumed, abandoned
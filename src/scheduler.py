@@ -0,0 +1,257 @@
+"""
+Scheduler module for ProfileDash
+A small dependency-aware task scheduler on one bounded thread pool. Tasks are
+identified by hashable keys (e.g. ("initial", 7) or ("refine", 7, "fact_critique")),
+may depend on other task keys, carry a priority, and can be added while the
+scheduler is running (typically from another task's completion callback), which
+is how a section moves to its next step as soon as its own previous step is done.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class TaskScheduler:
+    """
+    Runs tasks on at most `max_workers` threads, highest priority first among the
+    tasks whose dependencies have completed. Only `max_workers` tasks are handed to
+    the pool at a time, so priorities keep applying to everything still waiting.
+
+    Completion callbacks run on the thread that called run(), one at a time, so
+    they can update shared workflow state and add follow-up tasks without locking.
+    A dependency only orders tasks: a dependant still runs if its dependency failed
+    (it can check error(key)).
+    """
+
+    def __init__(self, max_workers, log_func=print, name="Scheduler", on_task_complete=None):
+        self.max_workers = max(1, int(max_workers))
+        self.log_func = log_func
+        self.name = name
+        self._lock = threading.Lock()
+        self._sequence = itertools.count()
+        self._tasks = {}          # key -> task dict
+        self._waiting = {}        # key -> set of unfinished dependency keys
+        self._ready = []          # heap of (-priority, sequence, key)
+        self._finished = set()
+        self._results = {}
+        self._errors = {}
+        self._current = threading.local() # per thread: key of the task or completion callback running (parent of tasks it adds)
+        self.on_task_complete = on_task_complete # called with every finished key, after its own callback (e.g. to re-prioritize)
+        self.durations = {}       # key -> seconds spent running the task
+        self.started_at = None
+        self.finished_at = None
+
+    # --- Building the task graph ---
+
+    def add_task(self, key, func, *args, deps=(), priority=0, on_complete=None, **kwargs):
+        """
+        Add a task. `on_complete(key, result, error)` is called once it has run
+        (error is the exception raised by `func`, or None).
+        """
+        with self._lock:
+            if key in self._tasks:
+                raise ValueError(f"{self.name}: duplicate task key {key!r}")
+            self._tasks[key] = {"func": func, "args": args, "kwargs": kwargs, "priority": priority,
+                                "on_complete": on_complete, "deps": tuple(deps), "parent": getattr(self._current, "key", None),
+                                "sequence": next(self._sequence)}
+            unfinished = {dep for dep in deps if dep not in self._finished}
+            if unfinished:
+                self._waiting[key] = unfinished
+            else:
+                self._push_ready(key)
+
+    def set_priority(self, key, priority):
+        """Change the priority of a task that has not started yet. Returns False if it already started."""
+        with self._lock:
+            task = self._tasks.get(key)
+            if task is None or key in self._finished or task.get("started"):
+                return False
+            task["priority"] = priority
+            if key not in self._waiting:
+                self._ready = [entry for entry in self._ready if entry[2] != key]
+                heapq.heapify(self._ready)
+                self._push_ready(key)
+            return True
+
+    def queued_keys(self, predicate=None):
+        """Keys of the tasks that have not started yet (all of them, or those matching `predicate`)."""
+        with self._lock:
+            return [key for key, task in self._tasks.items()
+                    if key not in self._finished and not task.get("started") and (predicate is None or predicate(key))]
+
+    def cancel(self, predicate=None):
+        """
+        Drop tasks that have not started yet (all of them, or those whose key
+        matches `predicate`). Their completion callbacks are not called; tasks
+        depending on them are dropped as well. Returns the dropped keys.
+        """
+        with self._lock:
+            dropped = [key for key, task in self._tasks.items()
+                       if key not in self._finished and not task.get("started") and (predicate is None or predicate(key))]
+            dropped_set = set(dropped)
+            changed = True
+            while changed:  # dependants of dropped tasks can never become ready
+                changed = False
+                for key, deps in self._waiting.items():
+                    if key not in dropped_set and deps & dropped_set:
+                        dropped_set.add(key); dropped.append(key); changed = True
+            for key in dropped:
+                self._waiting.pop(key, None)
+                self._tasks.pop(key, None)
+            self._ready = [entry for entry in self._ready if entry[2] not in dropped_set]
+            heapq.heapify(self._ready)
+        return dropped
+
+    def _push_ready(self, key):
+        task = self._tasks[key]
+        heapq.heappush(self._ready, (-task["priority"], task["sequence"], key))
+
+    # --- Results ---
+
+    def result(self, key, default=None):
+        return self._results.get(key, default)
+
+    def error(self, key):
+        return self._errors.get(key)
+
+    def is_finished(self, key):
+        return key in self._finished
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._tasks) - len(self._finished)
+
+    # --- Running ---
+
+    def _run_task(self, key):
+        task = self._tasks[key]
+        start = time.time()
+        self._current.key = key
+        try:
+            return task["func"](*task["args"], **task["kwargs"])
+        finally:
+            self._current.key = None
+            self.durations[key] = time.time() - start
+
+    def _complete(self, key, result, error):
+        """Record a finished task, release its dependants and run its callback."""
+        with self._lock:
+            self._finished.add(key)
+            if error is None:
+                self._results[key] = result
+            else:
+                self._errors[key] = error
+            for waiting_key in list(self._waiting):
+                deps = self._waiting[waiting_key]
+                deps.discard(key)
+                if not deps:
+                    del self._waiting[waiting_key]
+                    self._push_ready(waiting_key)
+            on_complete = self._tasks[key]["on_complete"]
+        if on_complete:
+            self._current.key = key
+            try:
+                on_complete(key, result, error)
+            except Exception as callback_e:
+                self.log_func(f"{self.name}: Completion callback for {key!r} failed: {type(callback_e).__name__} - {callback_e}")
+                traceback.print_exc()
+            finally:
+                self._current.key = None
+        if self.on_task_complete:
+            try:
+                self.on_task_complete(key)
+            except Exception as hook_e:
+                self.log_func(f"{self.name}: on_task_complete for {key!r} failed: {type(hook_e).__name__} - {hook_e}")
+
+    def run(self):
+        """
+        Run until no task is left. Blocks the calling thread. Can be called again after
+        adding more tasks; the makespan then spans every run.
+        """
+        self.started_at = self.started_at or time.time()
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                with self._lock:
+                    while self._ready and len(in_flight) < self.max_workers:
+                        _, _, key = heapq.heappop(self._ready)
+                        self._tasks[key]["started"] = True
+                        in_flight[executor.submit(self._run_task, key)] = key
+                    stuck = [] if (in_flight or self._ready) else list(self._waiting)
+                if not in_flight:
+                    if not stuck:
+                        break
+                    # Dependencies that were never added: fail these tasks rather than hang
+                    for key in stuck:
+                        with self._lock:
+                            missing = [dep for dep in self._waiting.pop(key, ()) if dep not in self._tasks]
+                        self._complete(key, None, RuntimeError(f"unresolved dependencies {missing!r}"))
+                    continue
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key = in_flight.pop(future)
+                    error = future.exception()
+                    self._complete(key, None if error else future.result(), error)
+        self.finished_at = time.time()
+        return self._results
+
+    # --- Reporting ---
+
+    def simulate_makespan(self, policy="priority"):
+        """
+        Replay the finished task graph (dependencies plus the task whose completion
+        added each task) with the measured durations on `max_workers` workers.
+
+        Args:
+            policy (str): "priority" picks the highest-priority ready task (this scheduler),
+                          "fifo" picks ready tasks in the order they became ready, ties in
+                          the order they were added (a plain queue).
+
+        Returns:
+            float: Simulated makespan in seconds.
+        """
+        tasks = {key: task for key, task in self._tasks.items() if key in self.durations}
+        predecessors = {key: [dep for dep in task["deps"] if dep in tasks] + ([task["parent"]] if task["parent"] in tasks else [])
+                        for key, task in tasks.items()}
+        remaining = {key: len(preds) for key, preds in predecessors.items()}
+        successors = {key: [] for key in tasks}
+        for key, preds in predecessors.items():
+            for pred in preds:
+                successors[pred].append(key)
+
+        def order(key, ready_time):
+            if policy == "fifo":
+                return (ready_time, tasks[key]["sequence"])
+            return (-tasks[key]["priority"], tasks[key]["sequence"])
+
+        ready = [(order(key, 0.0), key) for key, count in remaining.items() if count == 0]
+        heapq.heapify(ready)
+        running = []  # heap of (finish_time, sequence, key)
+        now = 0.0
+        while ready or running:
+            while ready and len(running) < self.max_workers:
+                _, key = heapq.heappop(ready)
+                heapq.heappush(running, (now + self.durations[key], tasks[key]["sequence"], key))
+            now, _, key = heapq.heappop(running)
+            for successor in successors[key]:
+                remaining[successor] -= 1
+                if remaining[successor] == 0:
+                    heapq.heappush(ready, (order(successor, now), successor))
+        return now
+
+    def makespan_report(self):
+        """Actual wall time vs. simulated priority and FIFO orderings of the same tasks."""
+        simulated = self.simulate_makespan("priority")
+        fifo = self.simulate_makespan("fifo")
+        return {
+            "tasks": len(self.durations),
+            "workers": self.max_workers,
+            "actualSeconds": round((self.finished_at or time.time()) - (self.started_at or time.time()), 1),
+            "simulatedPrioritySeconds": round(simulated, 1),
+            "simulatedFifoSeconds": round(fifo, 1),
+            "improvementVsFifoPercent": round((fifo - simulated) / fifo * 100, 1) if fifo else 0.0,
+        }
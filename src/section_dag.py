@@ -0,0 +1,208 @@
+"""
+Section DAG module for ProfileDash
+Synthesis sections (SWOT, Sellside Positioning, Buyside Due Diligence) declare the
+earlier sections they build on via 'depends_on'. They are generated after those
+sections and receive their content as context (the HTML itself or a compact text
+digest of it). Sections with 'use_documents': False get only that context instead
+of the full document payload.
+"""
+
+import re
+from html.parser import HTMLParser
+
+SECTION_DAG_ENABLED = True
+UPSTREAM_CONTEXT_FORMAT = "digest"  # "digest" (compact text, keeps footnotes) or "html"
+UPSTREAM_DIGEST_MAX_CHARS = 6000    # per upstream section
+
+
+class _DigestParser(HTMLParser):
+    """Flattens section HTML into lines: headings, paragraphs, '- ' list items and ' | ' table rows."""
+    BLOCK_TAGS = {"p", "div", "h1", "h2", "h3", "h4", "h5", "li", "tr", "br", "table", "ul", "ol", "section", "footer"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.lines = []
+        self.current = []
+        self.row = None
+        self.skip = 0
+
+    def _flush(self):
+        text = re.sub(r'\s+', ' ', "".join(self.current)).strip()
+        if text:
+            self.lines.append(text)
+        self.current = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("script", "style"):
+            self.skip += 1
+        elif tag == "tr":
+            self._flush(); self.row = []
+        elif tag in ("td", "th") and self.row is not None:
+            self.current = []
+        elif tag in self.BLOCK_TAGS:
+            self._flush()
+            if tag == "li":
+                self.current.append("- ")
+
+    def handle_endtag(self, tag):
+        if tag in ("script", "style"):
+            self.skip = max(0, self.skip - 1)
+        elif tag in ("td", "th") and self.row is not None:
+            self.row.append(re.sub(r'\s+', ' ', "".join(self.current)).strip()); self.current = []
+        elif tag == "tr" and self.row is not None:
+            if any(self.row):
+                self.lines.append(" | ".join(self.row))
+            self.row = None
+        elif tag in self.BLOCK_TAGS:
+            self._flush()
+
+    def handle_data(self, data):
+        if not self.skip:
+            self.current.append(data)
+
+
+def html_to_digest(html, max_chars=UPSTREAM_DIGEST_MAX_CHARS):
+    """Compact plain-text digest of a section's HTML (tables kept as rows, footnotes kept)."""
+    parser = _DigestParser()
+    try:
+        parser.feed(html or "")
+        parser.close()
+        parser._flush()
+    except Exception:
+        return re.sub(r'<[^>]+>', ' ', html or "")[:max_chars]
+    digest = "\n".join(parser.lines)
+    if len(digest) > max_chars:
+        digest = digest[:max_chars].rsplit("\n", 1)[0] + "\n[... truncated]"
+    return digest
+
+
+def section_dependencies(section):
+    """Upstream section numbers of a section (empty if the DAG is disabled)."""
+    return list(section.get("depends_on", [])) if SECTION_DAG_ENABLED else []
+
+
+def uses_documents(section):
+    """False if the section is generated from its upstream sections only."""
+    return not section_dependencies(section) or section.get("use_documents", True)
+
+
+def validate_section_dag(section_defs):
+    """
+    Check every 'depends_on' refers to an existing, different section and that there
+    are no cycles. Returns the section numbers in a valid generation order; raises
+    ValueError otherwise.
+    """
+    by_num = {section["number"]: section for section in section_defs}
+    for section in section_defs:
+        for upstream in section_dependencies(section):
+            if upstream not in by_num or upstream == section["number"]:
+                raise ValueError(f"Section {section['number']} depends on unknown section {upstream}.")
+    order, state = [], {}
+    def visit(num, path):
+        if state.get(num) == "done":
+            return
+        if state.get(num) == "visiting":
+            raise ValueError(f"Section dependency cycle: {' -> '.join(map(str, path + [num]))}")
+        state[num] = "visiting"
+        for upstream in section_dependencies(by_num[num]):
+            visit(upstream, path + [num])
+        state[num] = "done"; order.append(num)
+    for section in section_defs:
+        visit(section["number"], [])
+    return order
+
+
+def downstream_sections(section_defs):
+    """Map of section number -> sections that depend on it directly."""
+    downstream = {section["number"]: [] for section in section_defs}
+    for section in section_defs:
+        for upstream in section_dependencies(section):
+            downstream[upstream].append(section)
+    return downstream
+
+
+def select_sections(section_defs, section_numbers=None):
+    """
+    The sections a partial run generates: `section_numbers` plus every section they build
+    on (directly or indirectly), in profile order. All sections if `section_numbers` is empty.
+    """
+    if not section_numbers:
+        return list(section_defs)
+    by_num = {section["number"]: section for section in section_defs}
+    selected, pending = set(), [num for num in section_numbers if num in by_num]
+    while pending:
+        num = pending.pop()
+        if num not in selected:
+            selected.add(num)
+            pending.extend(upstream for upstream in section_dependencies(by_num[num]) if upstream in by_num)
+    return [section for section in section_defs if section["number"] in selected]
+
+
+def affected_sections(section_defs, document_types, routing):
+    """
+    Sections to regenerate when documents of `document_types` were added or removed:
+    the sections `routing` maps each type to (every section for unrouted types) plus
+    all sections downstream of them, in profile order.
+    """
+    numbers = {section["number"] for section in section_defs}
+    affected = set()
+    for document_type in document_types:
+        affected.update(routing[document_type] if document_type in routing else numbers)
+    downstream = downstream_sections(section_defs)
+    pending = list(affected & numbers)
+    while pending:
+        for dependent in downstream.get(pending.pop(), []):
+            if dependent["number"] not in affected:
+                affected.add(dependent["number"]); pending.append(dependent["number"])
+    return sorted(affected & numbers)
+
+
+def parse_section_selection(selection, section_defs, groups=None):
+    """
+    Section numbers from a selection such as "7, 8, 9", "15-18" or a group name
+    ("financials", see section_groups in section_definitions.py). Accepts a string or a
+    list of numbers / "N. Title" labels. Raises ValueError on unknown sections.
+    """
+    items = selection if isinstance(selection, (list, tuple, set)) else re.split(r"[,\s]+", str(selection or ""))
+    valid, numbers = {section["number"] for section in section_defs}, set()
+    for item in items:
+        item = str(item).strip()
+        if not item:
+            continue
+        group = (groups or {}).get(item.lower())
+        range_match = re.fullmatch(r"(\d+)\s*-\s*(\d+)", item)
+        label_match = re.match(r"(\d+)(?:\.|$)", item)
+        if group:
+            numbers.update(group)
+        elif range_match:
+            numbers.update(range(int(range_match.group(1)), int(range_match.group(2)) + 1))
+        elif label_match:
+            numbers.add(int(label_match.group(1)))
+        else:
+            raise ValueError(f"Unknown section or group '{item}'." + (f" Groups: {', '.join(groups)}." if groups else ""))
+    unknown = sorted(numbers - valid)
+    if unknown:
+        raise ValueError(f"Unknown section numbers: {unknown}.")
+    return sorted(numbers)
+
+
+def build_upstream_context(section, upstream_results, section_defs, context_format=UPSTREAM_CONTEXT_FORMAT):
+    """
+    Context block of the upstream sections' content for a dependent section.
+
+    Args:
+        upstream_results (dict): section number -> generated HTML.
+
+    Returns:
+        tuple: (context text, list of upstream section numbers that are missing or failed)
+    """
+    by_num = {s["number"]: s for s in section_defs}
+    parts, missing = [], []
+    for upstream in section_dependencies(section):
+        html = upstream_results.get(upstream)
+        if not html or '<p class="error">' in html:
+            missing.append(upstream)
+            continue
+        content = html if context_format == "html" else html_to_digest(html)
+        parts.append(f"=== SECTION {upstream}: {by_num[upstream]['title']} ===\n{content}")
+    return "\n\n".join(parts), missing
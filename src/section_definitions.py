@@ -1,6 +1,10 @@
 """
 Section definitions for ProfileDash
-Contains descriptions of all profile sections
+Contains descriptions of all profile sections.
+Optional keys: "depends_on" (earlier sections whose content is passed in as context,
+see section_dag.py), "use_documents" (False: generate from that context only,
+without attaching the documents) and "batch" (sections sharing a batch name are
+generated together in as few calls as possible, see section_processor.py).
 """
 
 sections = [
@@ -395,6 +399,9 @@ sections = [
     {
         "number": 15,
         "title": "Strengths",
+        "batch": "swot",
+        "depends_on": [1, 2, 5, 6, 7, 8, 13],
+        "use_documents": False,
         "specs": "Describe the 3 most relevant strengths that enable the company to compete.\\n"
                 "Focus on existing strengths (not future plans or initiatives).\\n"
                 "Prioritize strengths by how much they enable the company to compete.\\n"
@@ -417,6 +424,9 @@ sections = [
     {
         "number": 16,
         "title": "Weaknesses",
+        "batch": "swot",
+        "depends_on": [1, 2, 3, 4, 5, 6, 7, 8, 9, 14],
+        "use_documents": False,
         "specs": "Describe the 3 most relevant weaknesses that prevent the Company from serving its customers or competing with its main competitors\\n"
                 "Focus on company-specific weaknesses versus competitors (not market threats)\\n"
                 "Prioritize weaknesses that are material to the company's ability to compete today\\n"
@@ -435,6 +445,9 @@ sections = [
     {
         "number": 17,
         "title": "Opportunities",
+        "batch": "swot",
+        "depends_on": [2, 5, 13, 14, 15],
+        "use_documents": False,
         "specs": "Describe 3 specific opportunities that are achievable within 12-24 months and could materially impact the Company's performance\\n"
                 "Focus only on opportunities where the Company has existing capabilities to capture value\\n"
                 "For each opportunity, quantify potential revenue, profit, and ROI where possible\\n"
@@ -452,6 +465,9 @@ sections = [
     {
         "number": 18,
         "title": "Threats",
+        "batch": "swot",
+        "depends_on": [5, 11, 13, 14, 16],
+        "use_documents": False,
         "specs": "Identify and analyze the 3 most significant threats to the Company's performance within the next 12-24 months.\\n"
                 "Prioritize threats based on potential financial impact and likelihood of occurrence.\\n"
                 "Include competitive threats, technological disruptions, regulatory changes, and other external factors.\\n"
@@ -469,6 +485,7 @@ sections = [
     {
         "number": 19,
         "title": "Sellside Positioning - Macro",
+        "batch": "sellside_positioning",
         "specs": "Describe 3 most important macro trends which support the Company's performance and prospects.\\n"
                 "Focus on economic indicators, not industry dynamics, because that's a separate question later. Positive trends only.\\n"
                 "Include relevant macro indicators such as economic growth, interest rates, labor costs, supply chain indicators, and global trade.\\n"
@@ -483,6 +500,7 @@ sections = [
     {
         "number": 20,
         "title": "Sellside Positioning - Industry",
+        "batch": "sellside_positioning",
         "specs": "Describe 3 most important industry trends which support the Company's performance and prospects.\\n"
                 "Focus on industry indicators, not macro indicators. Positive trends only.\\n"
                 "Include demand, supply, pricing, and industry growth drivers relevant to the Company.\\n"
@@ -497,6 +515,9 @@ sections = [
     {
         "number": 21,
         "title": "Sellside Positioning - Competitive Positioning",
+        "batch": "sellside_positioning",
+        "depends_on": [2, 3, 5, 15],
+        "use_documents": False,
         "specs": "Describe the 3 most important competitive advantages that materially impact the Company's economic performance over the next 12 months.\\n"
                 "Focus on specific, measurable advantages relative to named competitors in key markets and segments.\\n"
                 "Include both quantitative measures (market share, growth rates, margins, pricing power) and qualitative advantages (brand strength, customer relationships) supported by hard data.\n"
@@ -510,6 +531,9 @@ sections = [
     {
         "number": 22,
         "title": "Sellside Positioning - Operating Performance",
+        "batch": "sellside_positioning",
+        "depends_on": [6, 8],
+        "use_documents": False,
         "specs": "Describe the 3 most important operating performance metrics over the last 24 months that directly impact the Company's economic wellbeing.\\n"
                 "Focus on measurable KPIs such as market share evolution, volumes sold, pricing trends, revenue per customer or unit economics that show the Company in the best possible light.\\n"
                 "Highlight areas of particular strength and present data that demonstrates exceptional operating performance.\\n"
@@ -523,6 +547,9 @@ sections = [
     {
         "number": 23,
         "title": "Sellside Positioning - Financial Performance",
+        "batch": "sellside_positioning",
+        "depends_on": [7, 8, 9],
+        "use_documents": False,
         "specs": "Describe the 3 most important financial achievements of the Company over the last 24 months.\\n"
                 "Focus on metrics that demonstrate exceptional financial performance, particularly those related to cash flow generation.\\n"
                 "Present quarterly data where available to highlight positive trends.\\n"
@@ -536,6 +563,9 @@ sections = [
     {
         "number": 24,
         "title": "Sellside Positioning - Management",
+        "batch": "sellside_positioning",
+        "depends_on": [12, 13],
+        "use_documents": False,
         "specs": "Describe 3 facts about the Company's management team and Board that highlight their strengths and capabilities.\\n"
                 "Focus on both individual executives and the management team as a whole.\\n"
                 "Quantify management capabilities and how they contribute to the Company's success.\\n"
@@ -549,6 +579,8 @@ sections = [
     {
         "number": 25,
         "title": "Sellside Positioning - Potential Investor Concerns and Mitigants",
+        "depends_on": [9, 10, 11, 14, 16, 18],
+        "use_documents": False,
         "specs": "Describe the 5 most important potential investor concerns when considering investing in the Company.\\n"
                 "Focus on fundamental business concerns and valuation issues that could impact investor returns.\\n"
                 "For each concern, provide 2-3 bullet points explaining the issue, underpinned by specific data points.\\n"
@@ -563,6 +595,7 @@ sections = [
     {
         "number": 26,
         "title": "Buyside Due Diligence - Macro",
+        "batch": "buyside_due_diligence",
         "specs": "Describe the 3 most important macroeconomic trends that could materially impact the Company's economic performance over the next 12 months.\\n"
                 "Focus on downside risks, not upside opportunities. Provide a detailed analysis of potential negative impacts.\\n"
                 "For each trend, provide a quantitative assessment of the Company's sensitivity to these factors, \\n"
@@ -577,6 +610,7 @@ sections = [
     {
         "number": 27,
         "title": "Buyside Due Diligence - Industry",
+        "batch": "buyside_due_diligence",
         "specs": "Describe the 3 most important industry trends that could materially impact the Company's economic performance over the next 12-24 months.\\n"
                 "Focus on downside risks, not upside opportunities, including technology shifts, competitive dynamics, and regulatory changes.\\n"
                 "Provide a detailed analysis of potential negative impacts. \\"
@@ -592,6 +626,9 @@ sections = [
     {
         "number": 28,
         "title": "Buyside Due Diligence - Competitive Positioning",
+        "batch": "buyside_due_diligence",
+        "depends_on": [2, 3, 5, 16],
+        "use_documents": False,
         "specs": "Describe the Company's 3 most important quantifiable competitive weaknesses versus key competitors and industry benchmarks.\\n"
                  "Analyze market share trends over the past 24 months and describe whether the Company's position is deteriorating.\\n"
                  "Measure product/service differentiation using objective metrics, pricing power through realization rates and premiums, and customer loyalty through retention and satisfaction scores.\\n"
@@ -605,6 +642,9 @@ sections = [
     {
         "number": 29,
         "title": "Buyside Due Diligence - Operating Performance",
+        "batch": "buyside_due_diligence",
+        "depends_on": [6, 8],
+        "use_documents": False,
         "specs": "Describe the 3 most important operating metrics that materially impact the Company's economic performance over the last 24 months. \\n"
             "Prioritize metrics related to market share, volumes, unit pricing, revenue per user, unit margins, \\n"
             "customer acquisition costs, customer churn/retention, asset utilization, and unit economics. Not financial metrics. \\n"
@@ -624,6 +664,8 @@ sections = [
     {
         "number": 30,
         "title": "Buyside Due Diligence - Financial Performance",
+        "batch": "buyside_due_diligence",
+        "depends_on": [7, 8, 9],
         "specs": "Describe the 3 most important financial metrics and then identify and quantify material risks to these metrics and the Company's economic well-being over the next 12-24 months. \\n"
             "Analyse the underlying drivers, trends, and potential vulnerabilities. \\n"
             "For each metric:\\n"
@@ -642,6 +684,8 @@ sections = [
     {
         "number": 31,
         "title": "Buyside Due Diligence - Management",
+        "batch": "buyside_due_diligence",
+        "depends_on": [12],
         "specs": "Describe the key members of the management team and the Board of Directors, focusing on individual track records, experience, and potential risks.\n"
             "For each key individual (primarily C-suite and key Board members):\n"
             "  - Provide a brief overview of their current role and tenure at the Company.\n"
@@ -778,4 +822,23 @@ sections = [
                 "Present data in a logical sequence following standard financial reporting practices.\\n"
                 "Include detailed footnotes with exact sources, document references, page numbers, and sections for each data point."
     }
-]
\ No newline at end of file
+]
+# Named subsets for partial runs and regeneration (e.g. "financials"); dependent sections
+# also generate the sections they build on, see select_sections() in section_dag.py
+section_groups = {
+    "business": [1, 2, 3, 4, 5, 6],
+    "financials": [7, 8, 9, 23, 30],
+    "ownership": [10, 11, 12],
+    "strategy": [13, 14],
+    "swot": [15, 16, 17, 18],
+    "sellside": [19, 20, 21, 22, 23, 24, 25],
+    "buyside": [26, 27, 28, 29, 30, 31],
+}
+
+# Sections fed by each document type, for delta runs that add or drop documents (see
+# affected_sections() in section_dag.py). Sections building on these are redone as well;
+# types not listed here (annual reports, prospectuses, other) can affect every section.
+document_type_sections = {
+    "interim_report": [6, 7, 8, 9, 10, 11],
+    "investor_presentation": [1, 2, 5, 6, 7, 8, 13, 14, 19, 20, 26, 27],
+}
@@ -4,14 +4,15 @@ Section processor module for ProfileDash
 Handles processing of individual sections (Initial Generation Only for now)
 """
 
-import time
 import re
+import math
 import traceback # Import traceback for detailed errors
 
 # Use relative imports for modules within the src package
-from .api_client import cached_generate_content, create_insight_model # Keep create_fact_model if refinement might be added later
+from .api_client import cached_generate_content
 # Import from html_generator now using relative import
 from .html_generator import validate_html, repair_html, clean_llm_output
+from .section_dag import section_dependencies, uses_documents
 # Refinement functions are imported but refine_section_content is removed/commented
 # from .fact_refinement import get_fact_critique, fact_improvement_response
 # from .insight_refinement import get_insight_critique, insight_improvement_response
@@ -20,23 +21,19 @@ from .prompts import persona, analysis_specs, output_format
 
 # Removed utils import
 
-# --- Function to Generate ONLY the Initial Section ---
-def generate_initial_section(section, documents, persona, analysis_specs, output_format, model):
-    """
-    Generates, cleans, repairs, and returns the initial HTML content for a single section.
-    Accepts a pre-configured model instance.
-    """
+# --- Batched generation of closely related sections ('batch' key in section_definitions.py) ---
+SECTION_BATCHING_ENABLED = True
+MAX_SECTIONS_PER_BATCH = 3 # keeps a batch's combined HTML inside the model's 8192 output tokens
+
+# --- Prompt / Output Helpers (shared with map_reduce.py) ---
+def build_section_instruction(section, persona, analysis_specs, output_format, source_description="the provided documents"):
+    """Builds the text instruction for generating one section's HTML."""
     section_num = section["number"]
     section_title = section["title"]
     section_specs = section["specs"]
 
-    # Log entry into the function for this section
-    print(f"Section Processor: Section {section_num}: GENERATING initial content for '{section_title}'")
-
-    # Construct the full prompt including the document list (now base64 encoded PDFs)
-    # Gemini's generate_content can handle a list containing text and multimodal parts.
     # Structure: Persona, Core Instruction, Section Specifics, General Specs, Format, Final Reminder
-    section_instruction = f"""
+    return f"""
 {persona}
 
 Please create section {section_num}: "{section_title}" for a company profile, focusing *only* on this section.
@@ -50,9 +47,80 @@ GENERAL ANALYSIS SPECIFICATIONS (Apply to Section {section_num} content):
 OUTPUT FORMATTING INSTRUCTIONS (Apply to Section {section_num} content):
 {output_format}
 
-IMPORTANT: Generate *only* the HTML content for section {section_num}, starting exactly with '<div class="section" id="section-{section_num}">' and ending exactly with '</div>'. Base your analysis *strictly* on the provided documents.
+IMPORTANT: Generate *only* the HTML content for section {section_num}, starting exactly with '<div class="section" id="section-{section_num}">' and ending exactly with '</div>'. Base your analysis *strictly* on {source_description}.
 """
 
+
+def upstream_source_description(has_documents):
+    """What the model should base a section on when earlier sections are passed in as context."""
+    if has_documents:
+        return "the provided documents and the EARLIER PROFILE SECTIONS below (reuse their figures where they apply so the profile stays consistent)"
+    return "the EARLIER PROFILE SECTIONS below, which were compiled from the provided documents (carry their source references over into your footnotes)"
+
+
+def finalize_section_html(raw_content, section_num, section_title):
+    """Cleans, repairs and validates raw model output for a section. Returns HTML (error HTML if empty)."""
+    if not raw_content or not raw_content.strip():
+        print(f"Section Processor: Section {section_num}: Warning - API returned empty content.")
+        return f'<div class="section" id="section-{section_num}"><h2>{section_num}. {section_title}</h2><p class="error">Error: API returned empty content for this section.</p></div>'
+
+    print(f"Section Processor: Section {section_num}: Cleaning LLM output")
+    cleaned = clean_llm_output(raw_content, section_num, section_title)
+
+    print(f"Section Processor: Section {section_num}: Repairing HTML")
+    repaired = repair_html(cleaned, section_num, section_title)
+
+    # Final validation check after repair
+    if not validate_html(repaired):
+        print(f"Section Processor: Section {section_num}: Warning - Invalid HTML structure detected even after repair.")
+        # Fallback if repair still results in invalid or empty HTML
+        if not repaired or not repaired.strip():
+            repaired = f'<div class="section" id="section-{section_num}"><h2>{section_num}. {section_title}</h2><p class="error">Error: Failed to generate or repair valid HTML content.</p></div>'
+        # Keep the repaired (but potentially invalid) HTML if it's not empty
+        else:
+            print(f"Section Processor: Section {section_num}: Proceeding with repaired but potentially invalid HTML.")
+    return repaired
+
+
+def check_response_usable(response, section_num):
+    """Raises ValueError if an API response is missing, blocked or has no text."""
+    # Defensive check for response and text attribute
+    if response is None:
+        raise ValueError("API response object was None.")
+    # Check for feedback first, especially safety feedback
+    if hasattr(response, 'prompt_feedback') and response.prompt_feedback:
+        feedback = response.prompt_feedback
+        print(f"Section Processor: Section {section_num}: API Response Feedback: {feedback}")
+        if hasattr(feedback, 'block_reason') and feedback.block_reason:
+            raise ValueError(f"Content blocked for section {section_num}. Reason: {feedback.block_reason}. Safety Ratings: {getattr(feedback, 'safety_ratings', 'N/A')}")
+    # Now check for text attribute
+    if not hasattr(response, 'text'):
+        raise ValueError("API response object is valid but missing 'text' attribute.")
+
+
+# --- Function to Generate ONLY the Initial Section ---
+def generate_initial_section(section, documents, persona, analysis_specs, output_format, model, upstream_context=None):
+    """
+    Generates, cleans, repairs, and returns the initial HTML content for a single section.
+    Accepts a pre-configured model instance.
+    If `upstream_context` (content of the earlier sections this one depends on) is given,
+    it is added to the prompt; `documents` may then be empty.
+    """
+    section_num = section["number"]
+    section_title = section["title"]
+
+    # Log entry into the function for this section
+    print(f"Section Processor: Section {section_num}: GENERATING initial content for '{section_title}'")
+
+    # Construct the full prompt including the document list (now base64 encoded PDFs)
+    # Gemini's generate_content can handle a list containing text and multimodal parts.
+    if upstream_context:
+        source_description = upstream_source_description(bool(documents))
+        section_instruction = build_section_instruction(section, persona, analysis_specs, output_format, source_description=source_description)
+        section_instruction += f"\nEARLIER PROFILE SECTIONS (already generated for this profile):\n{upstream_context}\n"
+    else:
+        section_instruction = build_section_instruction(section, persona, analysis_specs, output_format)
+
     # Prepare the input list for generate_content: instruction text + document parts
     # The `documents` variable already holds the list of {'mime_type': 'application/pdf', 'data': 'base64...'} dicts
     api_input = [section_instruction] + documents
@@ -70,45 +138,11 @@ IMPORTANT: Generate *only* the HTML content for section {section_num}, starting
         # Timeout increased slightly as multi-modal processing can take longer
         section_response = cached_generate_content(model, api_input, section_num=section_num, cache_enabled=True, timeout=300)
 
-        # Defensive check for response and text attribute
-        if section_response is None:
-             raise ValueError("API response object was None.")
-        # Check for feedback first, especially safety feedback
-        if hasattr(section_response, 'prompt_feedback') and section_response.prompt_feedback:
-             feedback = section_response.prompt_feedback
-             print(f"Section Processor: Section {section_num}: API Response Feedback: {feedback}")
-             if hasattr(feedback, 'block_reason') and feedback.block_reason:
-                  raise ValueError(f"Content blocked for section {section_num}. Reason: {feedback.block_reason}. Safety Ratings: {getattr(feedback, 'safety_ratings', 'N/A')}")
-        # Now check for text attribute
-        if not hasattr(section_response, 'text'):
-             raise ValueError("API response object is valid but missing 'text' attribute.")
-
+        check_response_usable(section_response, section_num)
 
         initial_content_raw = section_response.text
         print(f"Section Processor: Section {section_num}: API call complete (received {len(initial_content_raw)} chars)")
-
-        if not initial_content_raw or not initial_content_raw.strip():
-             print(f"Section Processor: Section {section_num}: Warning - API returned empty content.")
-             # Create standard error HTML
-             initial_content_repaired = f'<div class="section" id="section-{section_num}"><h2>{section_num}. {section_title}</h2><p class="error">Error: API returned empty content for this section.</p></div>'
-        else:
-            # Proceed with cleaning and repair
-            print(f"Section Processor: Section {section_num}: Cleaning LLM output")
-            initial_content_cleaned = clean_llm_output(initial_content_raw, section_num, section_title)
-
-            print(f"Section Processor: Section {section_num}: Repairing HTML")
-            initial_content_repaired = repair_html(initial_content_cleaned, section_num, section_title)
-
-            # Final validation check after repair
-            if not validate_html(initial_content_repaired):
-                 print(f"Section Processor: Section {section_num}: Warning - Invalid HTML structure detected even after repair.")
-                 # Fallback if repair still results in invalid or empty HTML
-                 if not initial_content_repaired or not initial_content_repaired.strip():
-                      initial_content_repaired = f'<div class="section" id="section-{section_num}"><h2>{section_num}. {section_title}</h2><p class="error">Error: Failed to generate or repair valid HTML content.</p></div>'
-                 # Keep the repaired (but potentially invalid) HTML if it's not empty
-                 else:
-                      print(f"Section Processor: Section {section_num}: Proceeding with repaired but potentially invalid HTML.")
-
+        initial_content_repaired = finalize_section_html(initial_content_raw, section_num, section_title)
 
         print(f"Section Processor: Section {section_num}: Content generated and processed.")
         # Return the section number and the final HTML string (could be error HTML)
@@ -135,3 +169,116 @@ IMPORTANT: Generate *only* the HTML content for section {section_num}, starting
         error_content = f'<div class="section" id="section-{section_num}"><h2>{section_num}. {section_title}</h2><p class="error">ERROR: Could not generate initial content: {type(e).__name__}</p></div>'
         # Instead of re-raising, return the error content. App.py will check for <p class="error">.
         return section_num, error_content
+
+
+# --- Batched Initial Generation ---
+def section_batches(section_defs, eligible=None):
+    """
+    Groups sections sharing a 'batch' name into batches of at most MAX_SECTIONS_PER_BATCH
+    (split evenly, in definition order). Within a name, root sections and sections building on
+    earlier ones ('depends_on'), and sections with and without the documents ('use_documents'),
+    are batched separately, so a root section never waits for another's upstream chain and a
+    document-free section is never sent the documents. Groups are named 'name', 'name:<kind>'
+    when a name spans several kinds, and '...#k' when split by size.
+
+    Args:
+        eligible (callable): Optional filter; sections it rejects are left out of batching.
+
+    Returns:
+        dict: batch name -> list of sections (only batches with 2+ sections).
+    """
+    if not SECTION_BATCHING_ENABLED:
+        return {}
+    kinds = {}
+    for section in section_defs:
+        if section.get("batch") and (eligible is None or eligible(section)):
+            kind = ("dependent" if section_dependencies(section) else "root") + ("" if uses_documents(section) else "-nodocs")
+            kinds.setdefault(section["batch"], {}).setdefault(kind, []).append(section)
+    groups = {name if len(by_kind) == 1 else f"{name}:{kind}": members for name, by_kind in kinds.items() for kind, members in by_kind.items()}
+    batches = {}
+    for name, members in groups.items():
+        parts = math.ceil(len(members) / MAX_SECTIONS_PER_BATCH)
+        size = math.ceil(len(members) / parts)
+        for k in range(parts):
+            chunk = members[k * size:(k + 1) * size]
+            if len(chunk) > 1:
+                batches[name if parts == 1 else f"{name}#{k + 1}"] = chunk
+    return batches
+
+
+def build_batch_instruction(batch_sections, persona, analysis_specs, output_format, source_description="the provided documents"):
+    """Builds one instruction generating several sections, each wrapped in START/END delimiters."""
+    listing = ", ".join(f'section {s["number"]}: "{s["title"]}"' for s in batch_sections)
+    specs = "\n".join(f'SECTION SPECIFICATIONS FOR {s["number"]} ("{s["title"]}"):\n{s["specs"]}\n' for s in batch_sections)
+    contract = "\n".join(f'<!-- SECTION {s["number"]} START -->\n<div class="section" id="section-{s["number"]}">...</div>\n<!-- SECTION {s["number"]} END -->' for s in batch_sections)
+    return f"""
+{persona}
+
+Please create the following {len(batch_sections)} sections of a company profile in ONE response: {listing}.
+
+{specs}
+GENERAL ANALYSIS SPECIFICATIONS (Apply to every section):
+{analysis_specs}
+
+OUTPUT FORMATTING INSTRUCTIONS (Apply to every section):
+{output_format}
+
+IMPORTANT: Output the sections in the order listed, each wrapped exactly like this, and nothing outside these blocks:
+{contract}
+Each section must be complete and self-contained (its own footnotes); do not refer to the other sections. Base your analysis *strictly* on {source_description}.
+"""
+
+
+def split_batch_response(text, batch_sections):
+    """
+    Splits a batched response into raw per-section HTML. Only sections with both
+    delimiters are returned, so a truncated response yields the completed sections only.
+    """
+    wanted = {s["number"] for s in batch_sections}
+    parts = {}
+    for match in re.finditer(r'<!--\s*SECTION\s+(\d+)\s+START\s*-->(.*?)<!--\s*SECTION\s+\1\s+END\s*-->', text or "", re.DOTALL):
+        section_num = int(match.group(1))
+        if section_num in wanted and match.group(2).strip():
+            parts[section_num] = match.group(2).strip()
+    return parts
+
+
+def generate_section_batch(batch_sections, documents, persona, analysis_specs, output_format, model, upstream_context=None):
+    """
+    Generates several sections with one API call.
+
+    Returns:
+        dict: section number -> cleaned/repaired HTML for every section that came back
+              complete and usable. Missing sections (failed or truncated batch) are absent,
+              so the caller can fall back to per-section calls for them.
+    """
+    batch_label = f"{batch_sections[0]['number']}-{batch_sections[-1]['number']}"
+    print(f"Section Processor: Sections {batch_label}: GENERATING {len(batch_sections)} sections in one batched call")
+    if upstream_context:
+        source_description = upstream_source_description(bool(documents))
+        instruction = build_batch_instruction(batch_sections, persona, analysis_specs, output_format, source_description=source_description)
+        instruction += f"\nEARLIER PROFILE SECTIONS (already generated for this profile):\n{upstream_context}\n"
+    else:
+        instruction = build_batch_instruction(batch_sections, persona, analysis_specs, output_format)
+
+    try:
+        if not model:
+            raise ValueError("No valid model instance provided to generate_section_batch")
+        response = cached_generate_content(model, [instruction] + documents, section_num=batch_label, cache_enabled=True, timeout=300)
+        check_response_usable(response, batch_label)
+        parts = split_batch_response(response.text, batch_sections)
+    except Exception as e:
+        print(f"Section Processor: Sections {batch_label}: Batched call failed ({type(e).__name__} - {e}); falling back to per-section calls.")
+        return {}
+
+    results = {}
+    for section in batch_sections:
+        raw = parts.get(section["number"])
+        if raw is None:
+            print(f"Section Processor: Section {section['number']}: Missing or truncated in batched response.")
+            continue
+        html = finalize_section_html(raw, section["number"], section["title"])
+        if '<p class="error">' not in html:
+            results[section["number"]] = html
+    print(f"Section Processor: Sections {batch_label}: Batched call returned {len(results)}/{len(batch_sections)} usable sections.")
+    return results
@@ -0,0 +1,147 @@
+"""
+Section quality module for ProfileDash
+Cheap, local scoring of a section's HTML (no API calls), used to decide which
+sections are worth spending refinement calls on. The score (0-100) combines:
+    spec coverage     share of the spec's 'Key areas to consider' found in the text
+    tables            share of filled data cells (sections without tables get partial credit)
+    time periods      distinct period labels (FY2023, 1H24, Q3 2024, ...)
+    sources           footnotes and 'Source:' references
+    length            text length against the section's median in earlier runs (only
+                      once there is history; otherwise the other weights are rescaled)
+The refinement gate (select_sections_to_refine) sends only sections below a threshold,
+or the N lowest-scoring ones, into refinement.
+"""
+
+import os
+import re
+import json
+import threading
+import statistics
+
+from .html_generator import extract_text_from_html
+
+SCORE_WEIGHTS = {"specCoverage": 35, "tables": 20, "periods": 15, "sources": 15, "length": 15}
+TARGET_PERIOD_LABELS = 5     # distinct period labels for full credit
+TARGET_SOURCES = 3           # footnotes / source references for full credit
+NO_TABLE_CREDIT = 0.4        # share of the table score for a section without any table
+EMPTY_CELL_VALUES = {"", "-", "–", "—", "n/a", "na", "n.a.", "tbd", "not available", "not disclosed"}
+KEY_AREA_PATTERN = re.compile(r"^\s*[a-z]\.\s+(.+)$")
+PERIOD_PATTERN = re.compile(r"\b(?:FY|CY|[1-4]Q|Q[1-4]|[12]H|H[12]|9M|6M|3M|LTM|TTM)\s?'?\d{2,4}\b|\b(?:19|20)\d{2}\b", re.IGNORECASE)
+SOURCE_PATTERN = re.compile(r"<sup\b|class=\"footnote|\bSource:", re.IGNORECASE)
+CELL_PATTERN = re.compile(r"<td\b[^>]*>(.*?)</td>", re.IGNORECASE | re.DOTALL)
+SECTION_LENGTH_HISTORY_FILE = os.environ.get("PROFILEDASH_SECTION_LENGTH_HISTORY", "section_length_history.json")
+MAX_LENGTH_SAMPLES = 20      # most recent initial-section text lengths kept per section
+MIN_LENGTH_SAMPLES = 3       # samples needed before length counts towards the score
+# Refinement gate: refine only sections scoring below the threshold and/or the N lowest-scoring
+# sections (0 = off). Both off: every section is refined.
+REFINEMENT_GATE_SCORE = float(os.environ.get("PROFILEDASH_REFINEMENT_GATE_SCORE", "0"))
+REFINEMENT_GATE_BOTTOM_N = int(os.environ.get("PROFILEDASH_REFINEMENT_GATE_BOTTOM_N", "0"))
+STOPWORDS = {"their", "these", "those", "which", "where", "about", "other", "there", "with", "each", "from", "into", "such",
+             "any", "and", "the", "for", "its", "etc", "including", "associated", "whether", "main", "significant", "key"}
+
+
+def spec_key_areas(section_def):
+    """The lettered 'Key areas to consider' lines of a section's spec."""
+    lines = re.split(r"\\n|\n", section_def.get("specs", ""))
+    return [match.group(1).strip() for match in map(KEY_AREA_PATTERN.match, lines) if match]
+
+
+def _keywords(text):
+    return {word[:6] for word in re.findall(r"[a-z]{4,}", text.lower()) if word not in STOPWORDS}
+
+
+_length_history = None
+_length_history_lock = threading.Lock()
+
+
+def _load_length_history():
+    global _length_history
+    if _length_history is None:
+        _length_history = {}
+        if os.path.exists(SECTION_LENGTH_HISTORY_FILE):
+            try:
+                with open(SECTION_LENGTH_HISTORY_FILE, "r") as f:
+                    _length_history = json.load(f)
+            except Exception as e:
+                print(f"Section Quality Warning: Could not load {SECTION_LENGTH_HISTORY_FILE}. Error: {e}")
+                _length_history = {}
+    return _length_history
+
+
+def typical_section_length(section_num):
+    """Median text length of the section's initial content in earlier runs, or None without enough history."""
+    with _length_history_lock:
+        samples = list(_load_length_history().get(str(section_num), []))
+    return statistics.median(samples) if len(samples) >= MIN_LENGTH_SAMPLES else None
+
+
+def record_section_lengths(html_by_num):
+    """Add the text length of each usable section to the history and persist it."""
+    with _length_history_lock:
+        history = _load_length_history()
+        for section_num, html in html_by_num.items():
+            if html and '<p class="error">' not in html:
+                samples = history.setdefault(str(section_num), [])
+                samples.append(len(extract_text_from_html(html)))
+                del samples[:-MAX_LENGTH_SAMPLES]
+        try:
+            temp_path = f"{SECTION_LENGTH_HISTORY_FILE}.tmp"
+            with open(temp_path, "w") as f:
+                json.dump(history, f)
+            os.replace(temp_path, SECTION_LENGTH_HISTORY_FILE)
+        except Exception as e:
+            print(f"Section Quality Warning: Failed to save {SECTION_LENGTH_HISTORY_FILE}: {e}")
+
+
+def score_section_html(section_def, html, typical_length=None):
+    """
+    Score a section's HTML against its definition.
+
+    Args:
+        typical_length: The section's usual text length (see typical_section_length); None
+                        leaves length out of the score.
+
+    Returns:
+        dict: 'score' (0-100) plus the components ('specCoverage', 'tableFill', 'tables',
+              'periods', 'sources', 'lengthRatio'); an error section scores 0.
+    """
+    if not html or '<p class="error">' in html:
+        return {"score": 0.0, "specCoverage": 0.0, "tableFill": 0.0, "tables": 0, "periods": 0, "sources": 0, "lengthRatio": None}
+    text = extract_text_from_html(html)
+    text_words = _keywords(text)
+    areas = spec_key_areas(section_def)
+    covered = sum(1 for area in areas if _keywords(area) and len(_keywords(area) & text_words) * 2 >= len(_keywords(area)))
+    spec_coverage = covered / len(areas) if areas else 1.0
+    cells = [re.sub(r"<[^>]+>", "", cell).strip().lower() for cell in CELL_PATTERN.findall(html)]
+    tables = html.lower().count("<table")
+    table_fill = sum(1 for cell in cells if cell not in EMPTY_CELL_VALUES) / len(cells) if cells else 0.0
+    periods = len({label.upper().replace(" ", "").replace("'", "") for label in PERIOD_PATTERN.findall(html)})
+    sources = len(SOURCE_PATTERN.findall(html))
+    length_ratio = len(text) / typical_length if typical_length else None
+    credits = {
+        "specCoverage": spec_coverage,
+        "tables": table_fill if tables else NO_TABLE_CREDIT,
+        "periods": min(1.0, periods / TARGET_PERIOD_LABELS),
+        "sources": min(1.0, sources / TARGET_SOURCES),
+    }
+    if length_ratio is not None:
+        credits["length"] = min(1.0, length_ratio)
+    score = 100 * sum(SCORE_WEIGHTS[name] * credit for name, credit in credits.items()) / sum(SCORE_WEIGHTS[name] for name in credits)
+    return {"score": round(score, 1), "specCoverage": round(spec_coverage, 2), "tableFill": round(table_fill, 2),
+            "tables": tables, "periods": periods, "sources": sources, "lengthRatio": round(length_ratio, 2) if length_ratio is not None else None}
+
+
+def select_sections_to_refine(scores, threshold=None, bottom_n=None):
+    """
+    The refinement gate: section numbers worth refining, given {section number: score}.
+    A section is refined if it scores below `threshold` or is among the `bottom_n` lowest
+    scores (either 0/None = that rule off; both off = every section).
+    """
+    threshold = REFINEMENT_GATE_SCORE if threshold is None else threshold
+    bottom_n = REFINEMENT_GATE_BOTTOM_N if bottom_n is None else bottom_n
+    if not threshold and not bottom_n:
+        return set(scores)
+    selected = {num for num, score in scores.items() if threshold and score < threshold}
+    if bottom_n:
+        selected |= {num for num, _ in sorted(scores.items(), key=lambda item: (item[1], item[0]))[:bottom_n]}
+    return selected
@@ -0,0 +1,38 @@
+"""
+Tests for the HTML patch module (python -m pytest src/test_html_patch.py)
+"""
+
+import pytest
+
+from .html_patch import HtmlPatchError, apply_html_patch
+
+
+SECTION = '<div class="section" id="section-7"><h2>7. Revenue</h2><p>Revenue grew 5%.</p><div id="note">FY2023</div></div>'
+
+
+def test_exact_span_is_replaced():
+    edits = [{"op": "replace", "find": "<p>Revenue grew 5%.</p>", "html": "<p>Revenue grew 6%.</p>"}]
+    assert "<p>Revenue grew 6%.</p>" in apply_html_patch(SECTION, edits)
+
+
+def test_whitespace_between_tags_may_be_missing_in_the_html():
+    edits = [{"op": "replace", "find": "<p>Revenue grew 5%.</p>\n<div id=\"note\">", "html": "<p>Revenue grew 6%.</p><div id=\"note\">"}]
+    assert apply_html_patch(SECTION, edits) == SECTION.replace("5%", "6%")
+
+
+def test_whitespace_between_tags_may_be_added_in_the_html():
+    html = SECTION.replace("</p><div", "</p>\n  <div")
+    edits = [{"op": "delete", "find": "</h2><p>Revenue grew 5%.</p><div id=\"note\">FY2023</div>"}]
+    assert apply_html_patch(html, edits) == '<div class="section" id="section-7"><h2>7. Revenue</div>'
+
+
+def test_whitespace_inside_text_still_requires_whitespace():
+    edits = [{"op": "replace", "find": "Revenue  grew\n5%.", "html": "Revenue grew 6%."}]
+    assert "Revenue grew 6%." in apply_html_patch(SECTION, edits)
+    with pytest.raises(HtmlPatchError):
+        apply_html_patch(SECTION, [{"op": "replace", "find": "Revenuegrew 5%.", "html": ""}])
+
+
+def test_ambiguous_span_is_rejected():
+    with pytest.raises(HtmlPatchError):
+        apply_html_patch(SECTION, [{"op": "delete", "find": "Revenue"}])
@@ -0,0 +1,122 @@
+"""
+Worker module for ProfileDash
+Runs profile generation outside the Gradio process: claims runs from the durable
+queue (src/durable_queue.py), executes execute_full_profile_workflow and reports
+progress back through the queue. Start as many workers as needed, on this host or
+on others sharing the queue, run store and document store directories.
+
+Usage:
+    python -m src.worker [--concurrency 1] [--queue-dir queue] [--poll-seconds 5] [--once]
+
+Needs the same secrets as the app in its environment: GOOGLE_API_KEY,
+SENDGRID_API_KEY and HF_DATA_TOKEN.
+"""
+
+import os
+import sys
+import time
+import uuid
+import socket
+import argparse
+import threading
+import traceback
+
+from .durable_queue import DurableJobQueue, HEARTBEAT_SECONDS
+from .background_processor import execute_full_profile_workflow
+
+
+def create_service_clients():
+    """SendGrid and Hugging Face clients from the environment (None where a secret is missing)."""
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        pass
+    sg_client = hf_api_client = None
+    sendgrid_api_key = os.getenv("SENDGRID_API_KEY")
+    if sendgrid_api_key:
+        try:
+            import sendgrid
+            sg_client = sendgrid.SendGridAPIClient(api_key=sendgrid_api_key)
+        except Exception as sg_init_e:
+            print(f"Worker: Error initializing SendGrid client: {sg_init_e}")
+    else:
+        print("Worker Warning: SENDGRID_API_KEY not found. Emails will not be sent.")
+    hf_token = os.environ.get("HF_DATA_TOKEN")
+    try:
+        from huggingface_hub import HfApi
+        hf_api_client = HfApi(token=hf_token) if hf_token else HfApi()
+    except Exception as api_init_e:
+        print(f"Worker: Error initializing HfApi: {api_init_e}")
+    return {"sg_client": sg_client, "hf_api_client": hf_api_client, "hf_token": hf_token, "api_key": os.getenv("GOOGLE_API_KEY")}
+
+
+def run_job(job_queue, job_id, payload, clients):
+    """Execute one claimed run. The workflow reports its own failures by email; only crashes mark the job failed."""
+    try:
+        execute_full_profile_workflow(
+            payload["run_id"], payload["user_email"], clients["api_key"], payload["file_paths"],
+            clients["sg_client"], clients["hf_api_client"], clients["hf_token"], payload["dataset_repo_id"],
+            payload["sender_email"], payload["app_version"], payload["max_workers"], payload["max_upload_bytes"],
+            progress_func=lambda message: job_queue.set_progress(job_id, message), output_dir=payload.get("output_dir"),
+            section_numbers=payload.get("section_numbers"), base_run_id=payload.get("base_run_id"),
+            force_regenerate=payload.get("force_regenerate", False), sla_minutes=payload.get("sla_minutes")
+        )
+        job_queue.finish(job_id, "done")
+    except Exception as e:
+        print(f"Worker: Run {job_id} crashed: {type(e).__name__} - {e}")
+        traceback.print_exc()
+        job_queue.finish(job_id, "failed", error=f"{type(e).__name__}: {e}")
+
+
+def run_worker(queue_dir=None, concurrency=1, poll_seconds=5.0, once=False, worker_id=None):
+    """
+    Claim and run jobs until interrupted (or, with `once`, until the queue is empty).
+    Runs at most `concurrency` jobs at a time, each on its own thread.
+    """
+    job_queue = DurableJobQueue(queue_dir, name="Worker Queue")
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    clients = create_service_clients()
+    if not clients["api_key"]:
+        print("Worker Warning: GOOGLE_API_KEY not found. Profile generation will fail.")
+    running = {}  # job_id -> thread
+    job_queue.register_worker(worker_id, concurrency)
+    print(f"Worker {worker_id}: Started with {concurrency} run slots on {job_queue.db_path}.")
+    last_heartbeat = 0.0
+    try:
+        while True:
+            for job_id, thread in list(running.items()):
+                if not thread.is_alive():
+                    del running[job_id]
+            if time.time() - last_heartbeat >= HEARTBEAT_SECONDS:
+                job_queue.heartbeat(worker_id, list(running)); last_heartbeat = time.time()
+            claimed = job_queue.claim(worker_id) if len(running) < concurrency else None
+            if claimed:
+                job_id, user, payload = claimed
+                thread = threading.Thread(target=run_job, args=(job_queue, job_id, payload, clients), daemon=True)
+                thread.start()
+                running[job_id] = thread
+                continue
+            if once and not running:
+                break
+            time.sleep(poll_seconds if not running else min(poll_seconds, 1.0))
+    except KeyboardInterrupt:
+        print(f"Worker {worker_id}: Interrupted. {len(running)} runs in progress will be re-queued once their heartbeat goes stale.")
+    finally:
+        job_queue.unregister_worker(worker_id)
+    return 0
+
+
+def main(argv=None):
+    """Command-line entry point for a worker process."""
+    parser = argparse.ArgumentParser(prog="python -m src.worker", description="Run ProfileDash profile generation jobs from the durable queue.")
+    parser.add_argument("--queue-dir", default=None, help="Queue directory (default: PROFILEDASH_QUEUE_DIR or 'queue')")
+    parser.add_argument("--concurrency", type=int, default=1, help="Runs executed at the same time by this worker")
+    parser.add_argument("--poll-seconds", type=float, default=5.0, help="Wait between queue checks when idle")
+    parser.add_argument("--once", action="store_true", help="Exit once the queue is empty and all claimed runs are done")
+    args = parser.parse_args(argv)
+    return run_worker(args.queue_dir, max(1, args.concurrency), args.poll_seconds, args.once)
+
+
+if __name__ == "__main__":
+    sys.exit(main())